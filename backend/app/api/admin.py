@@ -6,6 +6,7 @@ from app.models.database import get_db
 from app.models import schemas
 from app.services.admin_service import AdminService
 from app.services.validation_service import ValidationService
+from app.services.question_catalog import question_catalog_registry
 import secrets
 import os
 
@@ -381,6 +382,7 @@ async def migrate_derivable_questions(
                 added_count += 1
 
         db.commit()
+        question_catalog_registry.invalidate()
 
         return {
             "success": True,
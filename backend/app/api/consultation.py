@@ -1,26 +1,63 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from app.models.database import get_db
+from app.models.database import SessionLocal, get_db
 from app.models import schemas
-from app.services.inference_engine import InferenceEngine
-from app.models.models import Question
+from app.services.consultation_service import (
+    BATCH_MAX_CASES,
+    ConsultationSession,
+    create_session,
+    diagnose_case,
+    get_session,
+    restore_session,
+    session_store,
+)
+from app.services.knowledge_base import VISA_TYPES, knowledge_base_registry
+from app.services.question_catalog import question_catalog_registry
+from app.services.session_codec import StaleStateError, StateTokenError
+from pydantic import ValidationError
+import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/consultation", tags=["consultation"])
 
-# Global state (single user for now)
-_current_engine = None
-_question_history = []  # List of question texts
-_state_snapshots = []  # List of engine state snapshots (parallel to _question_history)
-_visa_type = None
-_current_question_fact = None
 
-# Multi-visa diagnosis state
-_all_visa_mode = False  # True when diagnosing all visa types
-_visa_types_to_diagnose = []  # List of visa types to diagnose (e.g., ["E", "L", "B", "H-1B", "J-1"])
-_current_visa_index = 0  # Index of current visa type being diagnosed
-_all_engines = {}  # Dict of visa_type -> InferenceEngine
-_all_conclusions = {}  # Dict of visa_type -> conclusions list
-_shared_answers = {}  # Dict of fact_name -> answer (shared across all visa types)
+def _find_session(
+    session_id: Optional[str], state: Optional[str] = None, db: Optional[Session] = None
+) -> Optional[ConsultationSession]:
+    """
+    session_idからセッションを取得（存在しない場合はNone）
+
+    状態トークン（ステートレスモード）があればそこからセッションを取得する
+    （状態が不正なら400、知識ベースが更新されていれば409）
+    """
+    try:
+        if state is not None:
+            return restore_session(db, state)
+        return get_session(session_id, db) if session_id else None
+    except StaleStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except StateTokenError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _require_session(
+    session_id: Optional[str], state: Optional[str] = None, db: Optional[Session] = None
+) -> ConsultationSession:
+    """session_idからセッションを取得（存在しない場合は404）"""
+    session = _find_session(session_id, state, db)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found. Please start consultation first.")
+    return session
+
+
+def _check_visa_type(visa_type: str):
+    """ビザタイプが診断できるものか確認（不明なら422。レジストリに未知のキーを作らせない）"""
+    if visa_type not in VISA_TYPES:
+        raise HTTPException(status_code=422, detail=f"Unknown visa_type: {visa_type}")
 
 
 @router.post("/start", response_model=schemas.ConsultationResponse)
@@ -29,67 +66,12 @@ async def start_consultation(
     db: Session = Depends(get_db),
 ):
     """診断を開始"""
-    global _current_engine, _question_history, _state_snapshots, _visa_type, _current_question_fact
-    global _all_visa_mode, _visa_types_to_diagnose, _current_visa_index, _all_engines, _all_conclusions, _shared_answers
-
-    # Check if "ALL" mode
-    if request_data.visa_type == "ALL":
-        _all_visa_mode = True
-        _visa_types_to_diagnose = ["E", "L", "B"]  # Only visa types with questions
-        _current_visa_index = 0
-        _all_engines = {}
-        _all_conclusions = {}
-        _shared_answers = {}
-
-        # Initialize first visa type engine
-        _visa_type = _visa_types_to_diagnose[0]
-        _current_engine = InferenceEngine(db, _visa_type)
-        _all_engines[_visa_type] = _current_engine
-    else:
-        _all_visa_mode = False
-        _visa_types_to_diagnose = []
-        _current_visa_index = 0
-        _all_engines = {}
-        _all_conclusions = {}
-        _shared_answers = {}
-
-        _visa_type = request_data.visa_type
-        _current_engine = InferenceEngine(db, request_data.visa_type)
-
-    _question_history = []
-    _state_snapshots = []
-
-    # Save initial snapshot (empty state)
-    initial_snapshot = _current_engine.save_snapshot()
-    _state_snapshots.append(initial_snapshot)
-
-    # Get first question
-    next_question_fact = _current_engine.get_next_question()
-    _current_question_fact = next_question_fact
-    next_question = None
-    is_derivable = True
-
-    if next_question_fact:
-        question = db.query(Question).filter(Question.fact_name == next_question_fact).first()
-        next_question = question.question_text if question else next_question_fact
-        _question_history.append(next_question)
-        # 導出可能かチェック
-        is_derivable = _current_engine._is_derivable(next_question_fact)
-
-    if _all_visa_mode:
-        print(f"[DEBUG START] ALL mode: visa_type={_visa_type}, next_question_fact={next_question_fact}, next_question={next_question}")
-
-    return schemas.ConsultationResponse(
-        next_question=next_question,
-        is_derivable=is_derivable,
-        conclusions=[],
-        is_finished=next_question is None,
-        unknown_facts=list(_current_engine.unknown_facts),
-        insufficient_info=False,
-        missing_critical_info=[],
-        current_visa_type=_visa_type if _all_visa_mode else None,
-        all_visa_mode=_all_visa_mode
-    )
+    _check_visa_type(request_data.visa_type)
+    session = create_session(db, request_data.visa_type)
+    with session.lock:
+        result = session.start(lookahead=request_data.lookahead)
+        session_store.update(session)
+    return schemas.ConsultationResponse(**result)
 
 
 @router.post("/answer", response_model=schemas.ConsultationResponse)
@@ -98,240 +80,235 @@ async def answer_question(
     db: Session = Depends(get_db),
 ):
     """質問に回答"""
-    global _current_engine, _question_history, _state_snapshots, _current_question_fact
-    global _all_visa_mode, _visa_types_to_diagnose, _current_visa_index, _all_engines, _all_conclusions, _shared_answers, _visa_type
-
-    if not _current_engine:
-        raise HTTPException(status_code=404, detail="Session not found. Please start consultation first.")
-
-    # Update db session and clear cache to avoid connection pool exhaustion
-    # Close old session first to prevent connection leaks
-    if _current_engine.db:
-        try:
-            _current_engine.db.close()
-        except:
-            pass
-    _current_engine.db = db
-    _current_engine.all_rules = None
-    _current_engine.rules_by_conclusion.clear()
-
-    # Get fact name from question text
-    question = db.query(Question).filter(Question.question_text == request_data.question).first()
-    fact_name = question.fact_name if question else request_data.question
-
-    # Save answer to shared answers (for all-visa mode)
-    if _all_visa_mode:
-        _shared_answers[fact_name] = request_data.answer
-
-    # Add fact and run forward chaining
-    if request_data.answer is not None:
-        _current_engine.add_fact(fact_name, request_data.answer)
-        _current_engine.forward_chain()
-    else:
-        # If answer is None ("分からない")
-        is_fact_derivable = _current_engine._is_derivable(fact_name)
-        if not is_fact_derivable:
-            # 導出不可能な質問 → uncertain_factsに追加（後で確定）
-            _current_engine.add_uncertain_fact(fact_name, True)
-            # まだforward_chainは呼ばない（確定していないので）
-        else:
-            # 導出可能な質問 → unknown_factsに追加のみ
-            _current_engine.add_unknown_fact(fact_name)
-
-    # Save snapshot AFTER answering the question
-    snapshot = _current_engine.save_snapshot()
-    _state_snapshots.append(snapshot)
-
-    # Get next question
-    next_question_fact = _current_engine.get_next_question()
-    _current_question_fact = next_question_fact
-    next_question = None
-    is_derivable = True
-
-    if next_question_fact:
-        question = db.query(Question).filter(Question.fact_name == next_question_fact).first()
-        next_question = question.question_text if question else next_question_fact
-        if next_question not in _question_history:
-            _question_history.append(next_question)
-        # 導出可能かチェック
-        is_derivable = _current_engine._is_derivable(next_question_fact)
-
-    # Check if consultation is finished
-    is_finished = _current_engine.is_consultation_finished()
-
-    # If finished, finalize diagnosis with uncertain facts
-    if is_finished:
-        _current_engine.finalize_diagnosis()
-
-    # Get conclusions
-    conclusions = _current_engine.get_conclusions()
-
-    # ALL VISA MODE: Handle transition to next visa type
-    if _all_visa_mode and is_finished:
-        # Save current visa type conclusions
-        _all_conclusions[_visa_type] = conclusions
-
-        # Move to next visa type
-        _current_visa_index += 1
-
-        if _current_visa_index < len(_visa_types_to_diagnose):
-            # Start diagnosis for next visa type
-            _visa_type = _visa_types_to_diagnose[_current_visa_index]
-            _current_engine = InferenceEngine(db, _visa_type)
-            _all_engines[_visa_type] = _current_engine
-
-            # Apply shared answers to new engine
-            for shared_fact_name, shared_answer in _shared_answers.items():
-                if shared_answer is not None:
-                    _current_engine.add_fact(shared_fact_name, shared_answer)
-                else:
-                    is_fact_derivable = _current_engine._is_derivable(shared_fact_name)
-                    if not is_fact_derivable:
-                        _current_engine.add_uncertain_fact(shared_fact_name, True)
-                    else:
-                        _current_engine.add_unknown_fact(shared_fact_name)
-
-            # Run forward chaining with shared answers
-            _current_engine.forward_chain()
-
-            # Get first question for this visa type
-            next_question_fact = _current_engine.get_next_question()
-            _current_question_fact = next_question_fact
-
-            if next_question_fact:
-                question = db.query(Question).filter(Question.fact_name == next_question_fact).first()
-                next_question = question.question_text if question else next_question_fact
-                if next_question not in _question_history:
-                    _question_history.append(next_question)
-                is_derivable = _current_engine._is_derivable(next_question_fact)
-
-            is_finished = False  # Not finished yet, still have more visa types
-            conclusions = []  # Clear current conclusions
-
-    # Check if diagnosis failed due to insufficient information
-    goal_achieved = _current_engine.goal in _current_engine.facts and _current_engine.facts[_current_engine.goal]
-    insufficient_info = is_finished and not goal_achieved and len(_current_engine.unknown_facts) > 0
-
-    # Get missing critical information (uncertain_facts - 導出不可能な質問で「わからない」と答えたもの)
-    # 診断成功・失敗に関わらず、常に取得して表示する
-    missing_critical_info = []
-    uncertain_facts_logic = {}
-    if is_finished and not _all_visa_mode:
-        # Update db session and clear cache before checking derivability
-        # Close old session first to prevent connection leaks
-        if _current_engine.db:
-            try:
-                _current_engine.db.close()
-            except:
-                pass
-        _current_engine.db = db
-        _current_engine.all_rules = None
-        _current_engine.rules_by_conclusion.clear()
-        missing_critical_info = _current_engine.get_missing_critical_info()
-        uncertain_facts_logic = _current_engine.get_uncertain_facts_logic()
-
-    # If all visa types are finished, return all conclusions
-    final_all_conclusions = {}
-    if _all_visa_mode and is_finished:
-        # Save last visa type conclusion
-        _all_conclusions[_visa_type] = conclusions
-        final_all_conclusions = _all_conclusions
-
-    return schemas.ConsultationResponse(
-        next_question=next_question,
-        is_derivable=is_derivable,
-        conclusions=conclusions,
-        is_finished=is_finished and (_current_visa_index >= len(_visa_types_to_diagnose) if _all_visa_mode else True),
-        unknown_facts=list(_current_engine.unknown_facts),
-        insufficient_info=insufficient_info,
-        missing_critical_info=missing_critical_info,
-        uncertain_facts_logic=uncertain_facts_logic,
-        current_visa_type=_visa_type if _all_visa_mode else None,
-        all_visa_mode=_all_visa_mode,
-        all_conclusions=final_all_conclusions if _all_visa_mode and is_finished else {}
-    )
+    session = _require_session(request_data.session_id, request_data.state, db)
+    with session.lock:
+        result = session.answer(
+            db, request_data.question, request_data.answer, lookahead=request_data.lookahead, step=request_data.step
+        )
+        session_store.update(session)
+    return schemas.ConsultationResponse(**result)
 
 
 @router.post("/back")
-async def go_back(db: Session = Depends(get_db)):
+async def go_back(
+    request_data: schemas.BackRequest,
+    db: Session = Depends(get_db),
+):
     """前の質問に戻る"""
-    global _current_engine, _question_history, _state_snapshots, _current_question_fact
-
-    if not _current_engine:
-        raise HTTPException(status_code=404, detail="Session not found. Please start consultation first.")
-
-    if len(_question_history) <= 1:
-        # Already at first question or no questions yet
-        current_question = _question_history[0] if _question_history else None
-        if current_question:
-            question = db.query(Question).filter(Question.question_text == current_question).first()
-            _current_question_fact = question.fact_name if question else current_question
-        
-        # Restore to initial state (first snapshot)
-        if _state_snapshots:
-            _current_engine.restore_snapshot(_state_snapshots[0])
-            # Update db session after restoration
-            # Close old session first to prevent connection leaks
-            if _current_engine.db:
-                try:
-                    _current_engine.db.close()
-                except:
-                    pass
-            _current_engine.db = db
-            _current_engine.all_rules = None
-            _current_engine.rules_by_conclusion.clear()
-        
-        return {"current_question": current_question}
-
-    # Remove last question and its snapshot
-    _question_history.pop()
-    _state_snapshots.pop()
-
-    # Get current question (now the last one in history)
-    current_question = _question_history[-1] if _question_history else None
-
-    # Restore engine state from the last snapshot
-    if _state_snapshots:
-        _current_engine.restore_snapshot(_state_snapshots[-1])
-        # Update db session after restoration
-        # Close old session first to prevent connection leaks
-        if _current_engine.db:
-            try:
-                _current_engine.db.close()
-            except:
-                pass
-        _current_engine.db = db
-        _current_engine.all_rules = None
-        _current_engine.rules_by_conclusion.clear()
-
-    # Update current question fact
-    if current_question:
-        question = db.query(Question).filter(Question.question_text == current_question).first()
-        _current_question_fact = question.fact_name if question else current_question
-
-    return {"current_question": current_question}
+    session = _require_session(request_data.session_id, request_data.state, db)
+    with session.lock:
+        result = session.back(db, request_data.steps, step=request_data.step)
+        session_store.update(session)
+    return result
 
 
 @router.get("/visualization", response_model=schemas.VisualizationResponse)
-async def get_visualization(db: Session = Depends(get_db)):
+async def get_visualization(
+    session_id: Optional[str] = None,
+    state: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
     """推論過程の可視化データを取得"""
-    global _current_engine, _current_question_fact
-
-    if not _current_engine:
+    session = _find_session(session_id, state, db)
+    if not session:
         # Return empty visualization if no session
         return schemas.VisualizationResponse(rules=[], fired_rules=[], current_question_fact=None)
 
-    # Update db session and clear cache to avoid lazy loading issues
-    # Close old session first to prevent connection leaks
-    if _current_engine.db:
-        try:
-            _current_engine.db.close()
-        except:
-            pass
-    _current_engine.db = db
-    _current_engine.all_rules = None
-    _current_engine.rules_by_conclusion.clear()
-
-    result = _current_engine.get_rule_visualization()
-    result["current_question_fact"] = _current_question_fact
+    with session.lock:
+        result = session.get_visualization(db)
     return schemas.VisualizationResponse(**result)
+
+
+@router.get(
+    "/visualization/delta",
+    response_model=schemas.VisualizationDeltaResponse,
+    responses={304: {"description": "Not modified since the given version"}},
+)
+async def get_visualization_delta(
+    session_id: Optional[str] = None,
+    since: Optional[int] = None,
+    state: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    推論過程の可視化データの差分を取得
+
+    since（前回受け取った version）以降に表示が変わったルールのみを返す。
+    変化がなければ 304 Not Modified、since がなければ全件を返す。
+    """
+    session = _find_session(session_id, state, db)
+    if not session:
+        return schemas.VisualizationDeltaResponse(version=0, full=True, rules=[], fired_rules=[])
+
+    with session.lock:
+        result = session.get_visualization_delta(db, since)
+    if result is None:
+        return Response(status_code=304)
+    return schemas.VisualizationDeltaResponse(**result)
+
+
+@router.get(
+    "/visualization/status",
+    response_model=schemas.VisualizationStatusResponse,
+    responses={304: {"description": "Not modified since the given version"}},
+)
+async def get_visualization_status(
+    session_id: Optional[str] = None,
+    since: Optional[int] = None,
+    state: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    推論過程の可視化の状態をコンパクトな配列で取得（ルールの文字列は含まない）
+
+    ルールの構造は graph_visa_type / graph_version のルールグラフ（/consultation/graph）から1度だけ取得し、
+    状態の配列はそのルールの index に対応させて使う。since の扱いは /visualization/delta と同じ。
+    """
+    session = _require_session(session_id, state, db)
+    with session.lock:
+        result = session.get_visualization_status(db, since)
+    if result is None:
+        return Response(status_code=304)
+    return schemas.VisualizationStatusResponse(**result)
+
+
+@router.get("/graph/{visa_type}/{kb_version}", responses={304: {"description": "Not modified"}})
+async def get_rule_graph(
+    visa_type: str,
+    kb_version: str,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """
+    知識ベースのバージョンごとのルールグラフ（ルールID・演算子・条件・結論・導出可能か）
+
+    内容はバージョンごとに不変なので、強いETagと immutable でキャッシュさせる。
+    """
+    _check_visa_type(visa_type)
+    knowledge_base = knowledge_base_registry.get_version(visa_type, kb_version)
+    if knowledge_base is None:
+        current = knowledge_base_registry.get(db, visa_type)
+        if current.version != kb_version:
+            raise HTTPException(status_code=404, detail="Knowledge base version not found")
+        knowledge_base = current
+
+    etag = f'"{knowledge_base.version}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=knowledge_base.graph_json(), media_type="application/json", headers=headers)
+
+
+@router.websocket("/ws")
+async def consultation_channel(websocket: WebSocket):
+    """
+    診断のWebSocketチャネル（回答と可視化の差分を1往復で返す）
+
+    クライアントは {"type": "start" | "resume" | "answer" | "back", ...}（ChannelMessage）を送り、
+    サーバーは診断の結果（start/answer は ConsultationResponse、back は current_question）と、
+    前回送った状態からの可視化の差分（/visualization/status と同じ形式、変化がなければnull）を
+    1つのメッセージで返す。DBセッションは接続ごとに1つを使い回す。
+    """
+    await websocket.accept()
+    db = SessionLocal()
+    channel = {"session": None, "visualization_version": None}
+    try:
+        while True:
+            text = await websocket.receive_text()
+            data = None
+            try:
+                data = json.loads(text)
+                message = schemas.ChannelMessage.model_validate(data)
+                reply = _handle_channel_message(db, channel, message)
+            except ValueError as e:  # JSONDecodeError, ValidationError
+                reply = {"type": "error", "detail": json.loads(e.json()) if isinstance(e, ValidationError) else str(e)}
+            except HTTPException as e:
+                reply = {"type": "error", "detail": e.detail}
+            except Exception:
+                # 予期しないエラーもこのメッセージのエラーとして返し、接続は維持する
+                logger.exception("Consultation channel message failed")
+                reply = {"type": "error", "detail": "Internal server error"}
+            finally:
+                db.close()  # コネクションはメッセージごとにプールへ返す
+            reply["id"] = data.get("id") if isinstance(data, dict) else None
+            await websocket.send_json(reply)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        db.close()
+
+
+def _handle_channel_message(db: Session, channel: dict, message: schemas.ChannelMessage) -> dict:
+    """WebSocketチャネルの1メッセージを処理して応答を返す"""
+    if message.type == "start":
+        if not message.visa_type:
+            raise HTTPException(status_code=422, detail="visa_type is required")
+        _check_visa_type(message.visa_type)
+        session = create_session(db, message.visa_type)
+        channel["session"], channel["visualization_version"] = session, None
+    elif message.type == "resume":
+        session = _require_session(message.session_id, message.state, db)
+        channel["session"], channel["visualization_version"] = session, None
+    elif message.type in ("answer", "back"):
+        if channel["session"] is None:
+            raise HTTPException(status_code=404, detail="Session not found. Please start consultation first.")
+        # セッションバックエンドの使用時は、別のワーカーでの更新を取り込むために毎回取得し直す
+        session = _require_session(channel["session"].session_id, db=db)
+        if session is not channel["session"]:
+            channel["session"], channel["visualization_version"] = session, None
+    else:
+        raise HTTPException(status_code=422, detail=f"Unknown message type: {message.type}")
+
+    reply = {"type": message.type, "session_id": session.session_id}
+    with session.lock:
+        if message.type == "start":
+            reply["consultation"] = schemas.ConsultationResponse(**session.start(message.lookahead)).model_dump()
+        elif message.type == "answer":
+            if message.question is None:
+                raise HTTPException(status_code=422, detail="question is required")
+            result = session.answer(db, message.question, message.answer, lookahead=message.lookahead, step=message.step)
+            reply["consultation"] = schemas.ConsultationResponse(**result).model_dump()
+        elif message.type == "back":
+            reply.update(session.back(db, message.steps, step=message.step))
+
+        visualization = session.get_visualization_status(db, channel["visualization_version"])
+        if visualization is not None:
+            channel["visualization_version"] = visualization["version"]
+            visualization = schemas.VisualizationStatusResponse(**visualization).model_dump()
+        reply["visualization"] = visualization
+        session_store.update(session)
+    return reply
+
+
+@router.post("/batch")
+async def batch_diagnose(
+    request_data: schemas.BatchRequest,
+    db: Session = Depends(get_db),
+):
+    """
+    複数件を一括診断（回答済みの問診票など、対話なしの評価用）
+
+    結果は1件ごとに1行のNDJSON（BatchCaseResult）として順次返す。
+    ただし入力のJSONはストリーミングの前に全件をパース・検証するので、メモリ使用量はリクエストの大きさに比例する。
+    そのため件数の上限は BATCH_MAX_CASES（超えると422）。大量の件数は batch_diagnose.py で処理する。
+    知識ベースと質問カタログは最初に1度だけ取得し、各件の診断ではDBにアクセスしない。
+    不明なビザタイプの件はその行に error を返す。
+    """
+    if len(request_data.cases) > BATCH_MAX_CASES:
+        raise HTTPException(status_code=422, detail=f"Too many cases: at most {BATCH_MAX_CASES} per request")
+    visa_types = {case.visa_type for case in request_data.cases if case.visa_type in VISA_TYPES}
+    knowledge_bases = {visa_type: knowledge_base_registry.get(db, visa_type) for visa_type in visa_types}
+    question_catalog = question_catalog_registry.get(db)
+
+    def generate():
+        for index, case in enumerate(request_data.cases):
+            case_id = case.case_id if case.case_id is not None else str(index)
+            try:
+                if case.visa_type not in knowledge_bases:
+                    raise ValueError(f"Unknown visa_type: {case.visa_type}")
+                result = diagnose_case(case.visa_type, case.answers, knowledge_bases[case.visa_type], question_catalog)
+            except Exception as e:
+                result = {"visa_type": case.visa_type, "error": str(e)}
+            yield json.dumps({"case_id": case_id, **result}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
@@ -6,14 +6,33 @@ from datetime import datetime
 # Consultation Schemas
 class StartConsultationRequest(BaseModel):
     visa_type: str = Field(..., description="E, L, B, H-1B, or J-1")
+    lookahead: bool = False  # 次の質問の回答ごとの、その次の質問を先読みして返す
 
 
 class AnswerRequest(BaseModel):
+    session_id: Optional[str] = None  # /start で返されたセッションID
+    state: Optional[str] = None  # 直前の応答の状態トークン（ステートレスモード。session_id より優先）
     question: str
     answer: Optional[bool]  # True=はい, False=いいえ, None=分からない
+    lookahead: bool = False  # 次の質問の回答ごとの、その次の質問を先読みして返す
+    step: Optional[int] = None  # 直前の応答の step（反映済みの回答の再送なら回答を繰り返さない）
+
+
+class BackRequest(BaseModel):
+    session_id: Optional[str] = None  # /start で返されたセッションID
+    state: Optional[str] = None  # 直前の応答の状態トークン（ステートレスモード。session_id より優先）
+    steps: int = Field(1, ge=1)  # 戻る質問数
+    step: Optional[int] = None  # 直前の応答の step（反映済みの戻る操作の再送なら繰り返さない）
+
+
+class LookaheadQuestion(BaseModel):
+    next_question: Optional[str] = None  # その回答をした場合の次の質問
+    is_derivable: bool = True
+    is_finished: bool = False  # その回答で質問が終わる
 
 
 class ConsultationResponse(BaseModel):
+    session_id: Optional[str] = None  # 以降のリクエストで指定するセッションID
     next_question: Optional[str] = None
     is_derivable: bool = True  # 現在の質問が他の質問から導出可能か（Falseの時のみ「わからない」選択肢を表示）
     conclusions: List[str] = []
@@ -25,6 +44,49 @@ class ConsultationResponse(BaseModel):
     current_visa_type: Optional[str] = None  # 現在診断中のビザタイプ（全ビザモード時）
     all_visa_mode: bool = False  # 全ビザタイプを診断するモードかどうか
     all_conclusions: Dict[str, List[str]] = {}  # 全ビザタイプの結論（visa_type -> conclusions）
+    lookahead: Optional[Dict[str, LookaheadQuestion]] = None  # 先読み（"yes" / "no" / "unknown" -> 次の質問）
+    state: Optional[str] = None  # 状態トークン（ステートレスモード時。次のリクエストにそのまま指定する）
+    step: int = 0  # 反映済みの回答数（次の回答のリクエストにそのまま指定する）
+
+
+class ChannelMessage(BaseModel):
+    """WebSocket（/consultation/ws）でクライアントから送るメッセージ"""
+
+    type: str = Field(..., description="start, resume, answer, or back")
+    id: Optional[Any] = None  # 応答にそのまま返す（リクエストとの対応付け用）
+    visa_type: Optional[str] = None  # start
+    session_id: Optional[str] = None  # resume
+    state: Optional[str] = None  # resume: 状態トークン（ステートレスモード）
+    question: Optional[str] = None  # answer
+    answer: Optional[bool] = None  # answer: True=はい, False=いいえ, None=分からない
+    step: Optional[int] = None  # answer, back: 直前の応答の step
+    steps: int = Field(1, ge=1)  # back
+    lookahead: bool = False  # start, answer
+
+
+class BatchCase(BaseModel):
+    case_id: Optional[str] = None  # 結果の対応付け用（省略時は0始まりの連番）
+    visa_type: str = Field(..., description="E, L, B, or ALL")
+    answers: Dict[str, Optional[bool]] = {}  # fact_name（または質問文） -> True=はい, False=いいえ, None=分からない
+
+
+class BatchRequest(BaseModel):
+    cases: List[BatchCase]
+
+
+class BatchCaseResult(BaseModel):
+    """一括診断の1件分の結果（NDJSONの1行）"""
+    case_id: Optional[str] = None
+    visa_type: str
+    is_finished: bool = False  # 全ての質問に回答済みで診断が完了したか
+    conclusions: List[str] = []
+    all_conclusions: Dict[str, List[str]] = {}  # 全ビザモードの結論（visa_type -> conclusions）
+    missing_critical_info: List[str] = []
+    insufficient_info: bool = False
+    next_question: Optional[str] = None  # 最初の未回答の質問（診断が完了していない場合）
+    next_question_fact: Optional[str] = None
+    current_visa_type: Optional[str] = None  # 未回答の質問のビザタイプ（全ビザモード時）
+    error: Optional[str] = None
 
 
 class VisualizationCondition(BaseModel):
@@ -47,6 +109,29 @@ class VisualizationResponse(BaseModel):
     rules: List[VisualizationRule]
     fired_rules: List[str] = []
     current_question_fact: Optional[str] = None
+    version: int = 0  # 可視化のバージョン（差分の取得に使う）
+
+
+class VisualizationDeltaRule(VisualizationRule):
+    index: int  # 可視化の全件のルール一覧での位置
+
+
+class VisualizationDeltaResponse(BaseModel):
+    version: int
+    full: bool = False  # True なら rules は全件（差分ではない）
+    rules: List[VisualizationDeltaRule]
+    fired_rules: List[str] = []
+    current_question_fact: Optional[str] = None
+
+
+class VisualizationStatusResponse(BaseModel):
+    graph_visa_type: str  # ルールグラフ（/consultation/graph/{graph_visa_type}/{graph_version}）
+    graph_version: str
+    version: int
+    full: bool = False  # True なら rules は全ルール分
+    rules: List[List[Any]]  # [ルールのindex, フラグ（1:結論導出済み 2:発火済み 4:発火可能）, 条件の状態のコード（0:未回答 1:満たす 2:満たさない 3:わからない）]
+    fired_rules: List[int] = []  # 発火したルールのindex（発火順）
+    current_question_fact: Optional[str] = None
 
 
 # Admin Schemas
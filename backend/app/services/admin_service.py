@@ -2,6 +2,8 @@ from typing import List, Optional
 from sqlalchemy.orm import Session
 from app.models.models import Rule, Condition, Question, RuleHistory
 from app.models import schemas
+from app.services.knowledge_base import knowledge_base_registry
+from app.services.question_catalog import question_catalog_registry
 from datetime import datetime
 
 
@@ -57,6 +59,7 @@ class AdminService:
         self.db.add(history)
 
         self.db.commit()
+        knowledge_base_registry.invalidate()
         self.db.refresh(rule)
         return rule
 
@@ -125,6 +128,7 @@ class AdminService:
             self.db.add(history)
 
         self.db.commit()
+        knowledge_base_registry.invalidate()
         self.db.refresh(rule)
         return rule
 
@@ -147,6 +151,7 @@ class AdminService:
         # Delete rule (cascade will delete conditions and history)
         self.db.delete(rule)
         self.db.commit()
+        knowledge_base_registry.invalidate()
         return True
 
     def get_rule_history(self, rule_id: int) -> List[RuleHistory]:
@@ -181,6 +186,7 @@ class AdminService:
         )
         self.db.add(question)
         self.db.commit()
+        question_catalog_registry.invalidate()
         self.db.refresh(question)
         return question
 
@@ -204,6 +210,7 @@ class AdminService:
         question.updated_at = datetime.utcnow()
 
         self.db.commit()
+        question_catalog_registry.invalidate()
         self.db.refresh(question)
         return question
 
@@ -215,4 +222,5 @@ class AdminService:
 
         self.db.delete(question)
         self.db.commit()
+        question_catalog_registry.invalidate()
         return True
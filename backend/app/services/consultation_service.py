@@ -1,115 +1,888 @@
-from typing import Dict, Optional
+from collections import OrderedDict, deque
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from sqlalchemy.orm import Session
 from app.services.inference_engine import InferenceEngine
-from app.models.models import Question
+from app.services.knowledge_base import KnowledgeBase, knowledge_base_registry
+from app.services.question_catalog import QuestionCatalog, question_catalog_registry
+from app.services import session_codec
+from app.services.session_backend import (
+    CONSULTATION_SESSION_BACKEND_URL,
+    CONSULTATION_SESSION_SPILL_PATH,
+    SessionBackend,
+    SqliteSessionBackend,
+    create_session_backend,
+)
+from app.services.session_codec import SessionState, StaleStateError, StateTokenError, pack_state, unpack_state
+from app.services.session_template import SessionTemplate, session_template_registry
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# セッションストアの設定
+SESSION_TTL_SECONDS = float(os.getenv("CONSULTATION_SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX_COUNT = int(os.getenv("CONSULTATION_SESSION_MAX_COUNT", "1000"))
+SESSION_MAX_MEMORY_MB = float(os.getenv("CONSULTATION_SESSION_MAX_MEMORY_MB", "64"))
+# この時間（秒）アクセスのないセッションは退避先（spill）に移す（0で上限を超えた場合のみ）
+SESSION_IDLE_SECONDS = float(os.getenv("CONSULTATION_SESSION_IDLE_SECONDS", "300"))
+
+# 一括診断（/batch）の1リクエストの最大件数。リクエスト全体をメモリ上で検証するため。
+# 大量の件数は batch_diagnose.py で処理する
+BATCH_MAX_CASES = int(os.getenv("BATCH_MAX_CASES", "1000"))
+
+# 可視化の差分のために保持する変更履歴の件数（これより古いバージョンからは全件を返す）
+VISUALIZATION_LOG_SIZE = int(os.getenv("VISUALIZATION_LOG_SIZE", "64"))
+
+
+# 先読みする回答（レスポンスのキー -> 回答）
+LOOKAHEAD_ANSWERS = (("yes", True), ("no", False), ("unknown", None))
+
+
+def apply_answer(engine: InferenceEngine, fact_name: str, answer: Optional[bool]):
+    """回答をエンジンに反映（forward_chainは呼び出し側で実行する）"""
+    if answer is not None:
+        engine.add_fact(fact_name, answer)
+    elif not engine._is_derivable(fact_name):
+        # 導出不可能な質問 → uncertain_factsに追加（後で確定）
+        engine.add_uncertain_fact(fact_name, True)
+    else:
+        # 導出可能な質問 → unknown_factsに追加のみ
+        engine.add_unknown_fact(fact_name)
+
+
+def answer_question(engine: InferenceEngine, fact_name: str, answer: Optional[bool]) -> Tuple[Optional[str], bool]:
+    """
+    対話の診断の1回の回答をエンジンに反映し、次の質問を求める
+
+    回答ごとにエンジンのフレームを1つ積むので、engine.undo() でこの回答を取り消せる。
+    回答済みの質問への再回答は、前の回答とそれに依存する結論だけを取り消してから反映する。
+
+    Returns:
+        (次の質問のfact_name, 診断が終了したか)
+    """
+    # Start an undo frame: everything this answer changes can be popped by back()
+    engine.push_frame()
+
+    # 回答済みの質問への再回答：前の回答とそれに依存する結論だけを取り消す
+    if fact_name in engine.asked_questions:
+        engine.remove_fact(fact_name)
+
+    # Add fact and run forward chaining
+    apply_answer(engine, fact_name, answer)
+    if answer is not None:
+        # 「分からない」の場合はまだforward_chainは呼ばない（確定していないので）
+        engine.forward_chain()
+
+    # Get next question
+    next_question_fact = engine.get_next_question()
+
+    # Check if consultation is finished
+    is_finished = engine.is_consultation_finished()
+
+    # If finished, finalize diagnosis with uncertain facts
+    if is_finished:
+        engine.finalize_diagnosis()
+    return next_question_fact, is_finished
+
+
+class AnswerStep(NamedTuple):
+    """1回の回答の記録（戻る操作と状態トークン用。状態の変更自体はエンジンのトレイルに記録される）"""
+
+    fact_name: str
+    answer: Optional[bool]
 
 
 class ConsultationSession:
-    """診断セッション管理"""
+    """診断セッション管理（1件の診断の状態を保持）"""
 
-    def __init__(self, session_id: str, db: Session, visa_type: str):
+    def __init__(
+        self,
+        session_id: str,
+        db: Session,
+        visa_type: str,
+        knowledge_base: Optional[KnowledgeBase] = None,
+        template: Optional[SessionTemplate] = None,
+    ):
         self.session_id = session_id
         self.db = db
+        self.lock = threading.RLock()  # Per-session lock (one request at a time)
+        self.last_accessed = time.monotonic()
+        self.size_bytes = 0  # Estimated memory usage (updated by the store)
+
+        self.question_history: List[str] = []  # 表示した質問の fact_name（質問文は応答時に質問カタログから引く）
+        self.answer_steps: List[AnswerStep] = []  # One entry per answer (undo frames live in the engines)
+        self.current_question_fact: Optional[str] = None
+
+        # 全ビザモード：1つのエンジンが全ビザタイプのルールの和集合と全てのゴールを持ち、
+        # 事実を共有したまま、より多くのゴールを前進させる質問から聞く
+        self.all_visa_mode = visa_type == "ALL"  # True when diagnosing all visa types
         self.visa_type = visa_type
-        self.engine = InferenceEngine(db, visa_type)
-        self.question_history = []  # Track questions in order
+        self.current_visa_type: Optional[str] = None  # Visa type the current question advances (全ビザモード)
+        # テンプレートがあれば、その回答前のエンジンを複製して使う（最初の質問・初期状態の可視化も共有する）
+        self._template = template
+        if template is not None:
+            self.engine = template.create_engine(db)
+        else:
+            self.engine = InferenceEngine(db, visa_type, knowledge_base=knowledge_base)
 
-    def start(self) -> Dict:
+        # 可視化のバージョン（表示が変わるたびに1増える）と、バージョンごとの変更されたルールのビットセット
+        self.visualization_version = 0
+        self._visualization_log: "deque[tuple]" = deque(maxlen=VISUALIZATION_LOG_SIZE)
+        self._visualized_question_fact: Optional[str] = None
+
+        # ステートレスモードで最後に発行した状態トークンと、セッションバックエンドに最後に保存した状態
+        # （同じトークン・状態で来たリクエストは再構築せずにこのオブジェクトを使う）
+        self.state_token: Optional[str] = None
+        self.saved_state: Optional[bytes] = None
+
+    def start(self, lookahead: bool = False) -> Dict:
         """診断を開始"""
-        next_question = self._get_next_question_text()
-        if next_question:
-            self.question_history.append(next_question)
+        template = self._template
+        if template is not None and not self.answer_steps:
+            # 最初の質問はテンプレートで計算済み
+            next_question_fact = template.question_fact
+            next_question = template.question_text
+            is_derivable = template.is_derivable
+            if next_question_fact:
+                self.question_history.append(next_question_fact)
+            self.current_visa_type = template.current_visa_type
+        else:
+            # Get first question
+            next_question_fact = self.engine.get_next_question()
+            next_question = None
+            is_derivable = True
 
-        return {
+            if next_question_fact:
+                next_question = self._get_question_text(next_question_fact)
+                self.question_history.append(next_question_fact)
+                # 導出可能かチェック
+                is_derivable = self.engine._is_derivable(next_question_fact)
+            self._update_current_visa_type(next_question_fact)
+        self.current_question_fact = next_question_fact
+
+        result = {
+            "session_id": self.session_id,
             "next_question": next_question,
+            "is_derivable": is_derivable,
             "conclusions": [],
             "is_finished": next_question is None,
+            "unknown_facts": list(self.engine.unknown_facts),
+            "insufficient_info": False,
+            "missing_critical_info": [],
+            "current_visa_type": self.current_visa_type,
+            "all_visa_mode": self.all_visa_mode,
+            "step": len(self.answer_steps),
         }
+        if lookahead and next_question_fact:
+            result["lookahead"] = self.get_lookahead(next_question_fact)
+        if session_codec.state_codec is not None:
+            result["state"] = self.issue_state_token()
+        return result
+
+    def answer(
+        self, db: Session, question_text: str, answer: Optional[bool], lookahead: bool = False, step: Optional[int] = None
+    ) -> Dict:
+        """
+        質問に回答
+
+        step はクライアントが直前の応答で受け取った反映済みの回答数。それより多くの回答が反映済みなら、
+        この回答は再送（応答が届かずに送り直したもの）なので、回答を繰り返さずに現在の状態を返す。
+        """
+        self._attach_db(db)
 
-    def answer(self, question_text: str, answer: bool) -> Dict:
-        """質問に回答"""
         # Get fact name from question text
         fact_name = self._get_fact_name_from_question(question_text)
 
-        if fact_name:
-            self.engine.add_fact(fact_name, answer)
-            self.engine.forward_chain()
+        if step is not None and step < len(self.answer_steps):
+            next_question_fact, is_finished = self.current_question_fact, self.engine.is_consultation_finished()
+        else:
+            next_question_fact, is_finished = self._apply_answer(fact_name, answer)
+        self.current_question_fact = next_question_fact
+        next_question = None
+        is_derivable = True
 
-        # Get next question
-        next_question = self._get_next_question_text()
-        if next_question and next_question not in self.question_history:
-            self.question_history.append(next_question)
+        if next_question_fact:
+            next_question = self._get_question_text(next_question_fact)
+            if next_question_fact not in self.question_history:
+                self.question_history.append(next_question_fact)
+            # 導出可能かチェック
+            is_derivable = self.engine._is_derivable(next_question_fact)
+        self._update_current_visa_type(next_question_fact)
 
+        # Get conclusions
         conclusions = self.engine.get_conclusions()
-        is_finished = self.engine.is_consultation_finished()
 
-        return {
+        # Check if diagnosis failed due to insufficient information
+        goal_achieved = self.engine.is_goal_achieved()
+        insufficient_info = is_finished and not goal_achieved and len(self.engine.unknown_facts) > 0
+
+        # Get missing critical information (uncertain_facts - 導出不可能な質問で「わからない」と答えたもの)
+        # 診断成功・失敗に関わらず、常に取得して表示する
+        missing_critical_info = []
+        uncertain_facts_logic = {}
+        if is_finished and not self.all_visa_mode:
+            missing_critical_info = self.engine.get_missing_critical_info()
+            uncertain_facts_logic = self.engine.get_uncertain_facts_logic()
+
+        # 全ビザモード：結論を導出したルールのビザタイプごとに分類
+        all_conclusions = {}
+        if self.all_visa_mode and is_finished:
+            all_conclusions = self.engine.get_conclusions_by_visa_type()
+
+        result = {
+            "session_id": self.session_id,
             "next_question": next_question,
+            "is_derivable": is_derivable,
             "conclusions": conclusions,
             "is_finished": is_finished,
+            "unknown_facts": list(self.engine.unknown_facts),
+            "insufficient_info": insufficient_info,
+            "missing_critical_info": missing_critical_info,
+            "uncertain_facts_logic": uncertain_facts_logic,
+            "current_visa_type": self.current_visa_type,
+            "all_visa_mode": self.all_visa_mode,
+            "all_conclusions": all_conclusions,
+            "step": len(self.answer_steps),
         }
+        if lookahead and next_question_fact and not is_finished:
+            result["lookahead"] = self.get_lookahead(next_question_fact)
+        if session_codec.state_codec is not None:
+            result["state"] = self.issue_state_token()
+        return result
+
+    def _apply_answer(self, fact_name: str, answer: Optional[bool]) -> Tuple[Optional[str], bool]:
+        """
+        回答をエンジンに反映し、次の質問を求める（状態トークンからの再構築でも同じ手順で再生する）
+
+        Returns:
+            (次の質問のfact_name, 診断が終了したか)
+        """
+        self.answer_steps.append(AnswerStep(fact_name, answer))
+        return answer_question(self.engine, fact_name, answer)
+
+    def get_lookahead(self, fact_name: str) -> Dict[str, Dict]:
+        """
+        質問への回答（はい/いいえ/分からない）ごとに、その次の質問を先読みする
 
-    def back(self) -> Dict:
-        """前の質問に戻る"""
+        回答を試行的に反映して次の質問を求め、エンジンのトレイルで元に戻す。
+        求めた次の質問は次の質問のキャッシュにも入るので、実際の回答時の探索も省略される。
+        """
+        lookahead = {}
+        for key, answer in LOOKAHEAD_ANSWERS:
+            with self.engine.speculate() as engine:
+                if fact_name in engine.asked_questions:
+                    engine.remove_fact(fact_name)
+                apply_answer(engine, fact_name, answer)
+                if answer is not None:
+                    engine.forward_chain()
+                next_question_fact = engine.get_next_question()
+                lookahead[key] = {
+                    "next_question": self._get_question_text(next_question_fact) if next_question_fact else None,
+                    "is_derivable": engine._is_derivable(next_question_fact) if next_question_fact else True,
+                    "is_finished": next_question_fact is None,
+                }
+        return lookahead
+
+    def back(self, db: Session, steps: int = 1, step: Optional[int] = None) -> Dict:
+        """前の質問に戻る（steps 問分。step は answer と同様で、反映済みの回答数が減っていれば再送として繰り返さない）"""
+        self._attach_db(db)
+
+        if step is not None and step > len(self.answer_steps):
+            current_question_fact = self.question_history[-1] if self.question_history else None
+        else:
+            current_question_fact = None
+            for _ in range(steps):
+                current_question_fact = self._back_one_step()
+        self._update_current_visa_type(self.current_question_fact)
+        current_question = self._get_question_text(current_question_fact) if current_question_fact else None
+        result = {"current_question": current_question, "step": len(self.answer_steps)}
+        if session_codec.state_codec is not None:
+            result["state"] = self.issue_state_token()
+        return result
+
+    def _back_one_step(self) -> Optional[str]:
+        """1問戻り、戻った先の質問の fact_name を返す"""
         if len(self.question_history) <= 1:
-            return {"current_question": self.question_history[0] if self.question_history else None}
+            # Already at first question or no questions yet
+            current_question_fact = self.question_history[0] if self.question_history else None
+            if current_question_fact:
+                self.current_question_fact = current_question_fact
 
-        # Remove last question from history
-        last_question = self.question_history.pop()
+            # Restore to initial state
+            while self.answer_steps:
+                self._undo_answer()
 
-        # Get fact name and remove it
-        fact_name = self._get_fact_name_from_question(last_question)
-        if fact_name:
-            self.engine.remove_fact(fact_name)
-            self.engine.forward_chain()
+            return current_question_fact
 
-        # Return current question
-        current_question = self.question_history[-1] if self.question_history else None
+        # Remove last question and undo its answer
+        self.question_history.pop()
+        if self.answer_steps:
+            self._undo_answer()
 
-        return {"current_question": current_question}
+        # Get current question (now the last one in history)
+        current_question_fact = self.question_history[-1] if self.question_history else None
+        if current_question_fact:
+            self.current_question_fact = current_question_fact
 
-    def get_visualization(self) -> Dict:
+        return current_question_fact
+
+    def _undo_answer(self):
+        """直近の回答を取り消す（エンジンのトレイルを1フレーム戻す）"""
+        self.answer_steps.pop()
+        self.engine.undo()
+
+    def _update_current_visa_type(self, next_question_fact: Optional[str]):
+        """全ビザモードで、次の質問が判定を進めるビザタイプを記録（診断終了時は最後の値のまま）"""
+        if self.all_visa_mode and next_question_fact:
+            self.current_visa_type = self.engine.get_question_visa_type(next_question_fact) or self.current_visa_type
+
+    def get_visualization(self, db: Session) -> Dict:
         """推論過程の可視化データを取得"""
-        return self.engine.get_rule_visualization()
+        self._attach_db(db)
+        self._update_visualization_version()
 
-    def _get_next_question_text(self) -> Optional[str]:
-        """次の質問のテキストを取得"""
-        fact_name = self.engine.get_next_question()
-        if not fact_name:
+        if self._is_initial_state():
+            result = dict(self._template.visualization)
+        else:
+            result = self.engine.get_rule_visualization()
+        result["current_question_fact"] = self.current_question_fact
+        result["version"] = self.visualization_version
+        return result
+
+    def get_visualization_delta(self, db: Session, since: Optional[int]) -> Optional[Dict]:
+        """
+        バージョン since 以降に表示が変わったルールのみの可視化データを取得
+
+        Returns:
+            変更がなければNone。since が履歴より古い（または不明な）場合は全件（full=True）
+        """
+        changes = self._get_visualization_changes(db, since)
+        if changes is None:
             return None
+        full, rule_mask = changes
+        return {
+            "version": self.visualization_version,
+            "full": full,
+            "rules": (
+                self._template.get_rule_visualization_delta(rule_mask)
+                if self._is_initial_state()
+                else self.engine.get_rule_visualization_delta(rule_mask)
+            ),
+            "fired_rules": self.engine.fired_rules,
+            "current_question_fact": self.current_question_fact,
+        }
 
-        question = self.db.query(Question).filter(Question.fact_name == fact_name).first()
+    def get_visualization_status(self, db: Session, since: Optional[int]) -> Optional[Dict]:
+        """
+        get_visualization_delta のコンパクト版（ルールの文字列を含まない状態配列）
 
-        if question:
-            return question.question_text
-        else:
-            # Fallback to fact name if no question defined
-            return fact_name
+        ルールの構造は知識ベースのバージョンごとのルールグラフ（/consultation/graph）から取得し、
+        ここではそのルールの index に対応する状態のみを返す。
+        """
+        changes = self._get_visualization_changes(db, since)
+        if changes is None:
+            return None
+        full, rule_mask = changes
+        knowledge_base = self.engine.knowledge_base
+        return {
+            "graph_visa_type": knowledge_base.visa_type,
+            "graph_version": knowledge_base.version,
+            "version": self.visualization_version,
+            "full": full,
+            "rules": (
+                self._template.get_rule_status_delta(rule_mask)
+                if self._is_initial_state()
+                else self.engine.get_rule_status_delta(rule_mask)
+            ),
+            "fired_rules": [knowledge_base.rule_indices[rule_id] for rule_id in self.engine.fired_rules],
+            "current_question_fact": self.current_question_fact,
+        }
+
+    def _get_visualization_changes(self, db: Session, since: Optional[int]) -> Optional[tuple]:
+        """
+        バージョン since 以降に表示が変わったルール
+
+        Returns:
+            (全件かどうか, ルールindexのビットセット)。変更がなければNone
+        """
+        self._attach_db(db)
+        self._update_visualization_version()
+
+        if since == self.visualization_version:
+            return None
+
+        log = self._visualization_log
+        if since is None or since > self.visualization_version or not log or since < log[0][0] - 1:
+            return True, (1 << len(self.engine._get_applicable_rules())) - 1
+
+        rule_mask = 0
+        for version, changed in log:
+            if version > since:
+                rule_mask |= changed
+        return False, rule_mask
+
+    def _is_initial_state(self) -> bool:
+        """エンジンが回答前の状態（テンプレートと同じ状態）か。最初に戻った後も回答前の状態に戻っている"""
+        return self._template is not None and not self.answer_steps
 
-    def _get_fact_name_from_question(self, question_text: str) -> Optional[str]:
+    def _update_visualization_version(self):
+        """前回の可視化以降の変更を取り込み、表示が変わっていればバージョンを進める"""
+        changed = self.engine.get_changed_rules()
+        if changed or self.current_question_fact != self._visualized_question_fact:
+            self.visualization_version += 1
+            self._visualization_log.append((self.visualization_version, changed))
+            self._visualized_question_fact = self.current_question_fact
+
+    def issue_state_token(self) -> str:
+        """
+        現在の状態の状態トークンを発行（ステートレスモード）
+
+        可視化のバージョンを先に進めておくことで、トークンを発行してから次の変更までの間に
+        クライアントが受け取る可視化のバージョンは、トークンに含まれるバージョンと一致する
+        """
+        self._update_visualization_version()
+        self.state_token = session_codec.state_codec.encode(self.to_state(), self.engine.knowledge_base)
+        return self.state_token
+
+    def save_state(self) -> bytes:
+        """セッションバックエンドに保存する状態（issue_state_token と同様に可視化のバージョンを先に進める）"""
+        self._update_visualization_version()
+        self.saved_state = pack_state(self.to_state(), self.engine.knowledge_base)
+        return self.saved_state
+
+    def to_state(self) -> SessionState:
+        """状態トークンに含める状態（DBにアクセスしないので、リクエスト外のスレッドからも呼べる）"""
+        return SessionState(
+            session_id=self.session_id,
+            visa_type=self.visa_type,
+            answers=[(step.fact_name, step.answer) for step in self.answer_steps],
+            question_history=list(self.question_history),
+            current_question_fact=self.current_question_fact,
+            current_visa_type=self.current_visa_type,
+            visualization_version=self.visualization_version,
+            visualization_changes=(
+                self._visualization_log[-1][1]
+                if self._visualization_log and self._visualization_log[-1][0] == self.visualization_version
+                else 0
+            ),
+            fingerprint=self.engine._fingerprint,
+        )
+
+    @classmethod
+    def from_state(cls, db: Session, state: SessionState, knowledge_base: KnowledgeBase) -> "ConsultationSession":
+        """
+        状態トークンの状態からセッションを再構築（回答を同じ手順で再生するので、戻る操作もそのまま使える）
+
+        Raises:
+            StateTokenError: 再生した結果がトークンの状態と一致しない
+        """
+        template = session_template_registry.find(db, knowledge_base)
+        session = cls(state.session_id, db, state.visa_type, knowledge_base=knowledge_base, template=template)
+        for fact_name, answer in state.answers:
+            session._apply_answer(fact_name, answer)
+        if session.engine._fingerprint & ((1 << 64) - 1) != state.fingerprint:
+            raise StateTokenError("Consultation state does not match the knowledge base")
+
+        session.question_history = list(state.question_history)
+        session.current_question_fact = state.current_question_fact
+        session.current_visa_type = state.current_visa_type
+        # クライアントは保存した時点の可視化を受け取っているので、そこからの差分を返す
+        # （直前のバージョンからの変更も保存してあるので、1つ前のバージョンからの差分も返せる）
+        session.engine.get_changed_rules()
+        session.visualization_version = state.visualization_version
+        if state.visualization_version:
+            session._visualization_log.append((state.visualization_version, state.visualization_changes))
+        session._visualized_question_fact = state.current_question_fact
+        return session
+
+    def estimate_size(self) -> int:
+        """
+        セッションのおおよそのメモリ使用量（バイト）を見積もる
+
+        事実名などの文字列は知識ベースと共有されているため、コンテナ自体のサイズのみを数える
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.question_history)
+        size += sys.getsizeof(self.answer_steps) + len(self.answer_steps) * sys.getsizeof(AnswerStep("", None))
+        size += self.engine.estimate_memory()
+        return size
+
+    def _attach_db(self, db: Session):
+        """リクエストのDBセッションを設定（ルールと質問はキャッシュから取得するため、通常は使われない）"""
+        self.db = db
+        self.engine.db = db
+
+    def _get_question_text(self, fact_name: str) -> str:
+        """fact_nameから質問文を取得"""
+        # Fallback to fact name if no question defined
+        return question_catalog_registry.get(self.db).get_question_text(fact_name)
+
+    def _get_fact_name_from_question(self, question_text: str) -> str:
         """質問文からfact_nameを取得"""
-        question = self.db.query(Question).filter(Question.question_text == question_text).first()
-        return question.fact_name if question else question_text
+        return question_catalog_registry.get(self.db).get_fact_name(question_text)
+
+
+class SessionStore:
+    """
+    診断セッションのストア
+
+    session_id -> ConsultationSession を保持し、最終アクセスから ttl_seconds を過ぎたセッションと、
+    件数・メモリの上限を超えた分の最も長く使われていないセッション（LRU）を追い出す。
+
+    backend（SessionBackend）があれば、各ステップの後に状態をコンパクトなバイナリで保存し（set）、
+    取得時には保存された状態を読む（get）。このプロセスのセッションがその状態を保存したものなら
+    そのまま使い、そうでなければ（別のワーカーが更新した・再起動・追い出し後）状態から再構築する。
+
+    spill（ローカルの退避先）があれば、idle_seconds を過ぎたセッションと上限を超えて追い出すセッションを
+    破棄せずに同じバイナリで退避し、次のアクセスで再構築してメモリに戻す。
+    退避するセッションはストアのロックの中で選んで取り除くだけで、状態の保存と書き込みはロックの外で行う
+    （書き込みに失敗したセッションはメモリに戻す）。
+    backend があれば状態は常に保存されているので、spill は使わない。
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = SESSION_TTL_SECONDS,
+        max_sessions: int = SESSION_MAX_COUNT,
+        max_bytes: int = int(SESSION_MAX_MEMORY_MB * 1024 * 1024),
+        backend: Optional[SessionBackend] = None,
+        spill: Optional[SessionBackend] = None,
+        idle_seconds: float = SESSION_IDLE_SECONDS,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.spill = spill if backend is None else None
+        self.idle_seconds = idle_seconds
+        self.spilled = 0  # 退避したセッション数（累計）
+        self.rehydrated = 0  # 退避先から戻したセッション数（累計）
+        self._sessions: "OrderedDict[str, ConsultationSession]" = OrderedDict()
+        self._spilling: Dict[str, ConsultationSession] = {}  # 取り除いて退避先に書き込み中のセッション
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._rehydrate_lock = threading.Lock()
+
+    def create(self, db: Session, visa_type: str) -> ConsultationSession:
+        """Create new consultation session"""
+        template = session_template_registry.get(db, visa_type)
+        session = ConsultationSession(secrets.token_urlsafe(16), db, visa_type, template=template)
+        self.add(session)
+        return session
+
+    def add(self, session: ConsultationSession):
+        """セッションを追加（同じsession_idのセッションがあれば置き換える）"""
+        with self._lock:
+            self._remove(session.session_id)
+            self._sessions[session.session_id] = session
+            victims = self._evict_expired()
+        self._spill(victims)
+
+    def get(self, session_id: str, db: Optional[Session] = None) -> Optional[ConsultationSession]:
+        """
+        Get existing session (None if missing or expired)
+
+        Raises:
+            StaleStateError: 保存された状態の知識ベースのバージョンがもう使われていない（バックエンド使用時）
+        """
+        if self.backend is None:
+            session = self._get_local(session_id)
+            if session is None and self.spill is not None:
+                session = self._rehydrate(session_id, db)
+            return session
+
+        data = self.backend.get(session_id)
+        if data is None:
+            self._discard(session_id)
+            return None
+        session = self._get_local(session_id)
+        if session is not None and session.saved_state == data:
+            return session
+
+        session = self._load(db, data)
+        self.add(session)
+        return session
+
+    def _rehydrate(self, session_id: str, db: Optional[Session]) -> Optional[ConsultationSession]:
+        """退避先のセッションを再構築してメモリに戻す（なければNone）"""
+        self._wait_for_spill(session_id)
+        with self._rehydrate_lock:
+            session = self._get_local(session_id)  # 他のスレッドが先に戻した
+            if session is not None:
+                return session
+            data = self.spill.get(session_id)
+            if data is None:
+                return None
+            session = self._load(db, data)
+            self.spill.delete(session_id)
+            self.rehydrated += 1
+            self.add(session)
+            return session
+
+    @staticmethod
+    def _load(db: Optional[Session], data: bytes) -> ConsultationSession:
+        """保存された状態からセッションを再構築"""
+        knowledge_base, state = unpack_state(data, lambda v, version: _get_state_knowledge_base(db, v, version))
+        session = ConsultationSession.from_state(db, state, knowledge_base)
+        session.saved_state = data
+        return session
+
+    def _get_local(self, session_id: str) -> Optional[ConsultationSession]:
+        """このプロセスのセッションを取得（None if missing or expired）"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self._is_expired(session):
+                self._remove(session_id)
+                return None
+            session.last_accessed = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def get_issued(self, session_id: str, state_token: str) -> Optional[ConsultationSession]:
+        """このプロセスのセッションのうち、最後に発行した状態トークンが state_token のもの（なければNone）"""
+        session = self._get_local(session_id)
+        return session if session is not None and session.state_token == state_token else None
+
+    def update(self, session: ConsultationSession):
+        """セッションの状態変更後に呼び出す（バックエンドに保存し、メモリ使用量を更新して上限を超えた分を追い出す）"""
+        if self.backend is not None:
+            self.backend.set(session.session_id, session.save_state(), self.ttl_seconds)
+        size = session.estimate_size()
+        with self._lock:
+            if session.session_id not in self._sessions:
+                return
+            self._total_bytes += size - session.size_bytes
+            session.size_bytes = size
+            session.last_accessed = time.monotonic()
+            self._sessions.move_to_end(session.session_id)
+            victims = self._evict_over_capacity(keep=session.session_id)
+        self._spill(victims)
 
+    def delete(self, session_id: str):
+        """Delete consultation session"""
+        if self.backend is not None:
+            self.backend.delete(session_id)
+        if self.spill is not None:
+            self._wait_for_spill(session_id)
+            self.spill.delete(session_id)
+        self._discard(session_id)
 
-# Global session storage (in-memory for now)
-# TODO: Upgrade to Redis or database-backed sessions for production
-_sessions: Dict[str, ConsultationSession] = {}
+    def _wait_for_spill(self, session_id: str):
+        """そのセッションを退避先に書き込み中なら、書き込みが終わるのを待つ"""
+        with self._lock:
+            pending = self._spilling.get(session_id)
+        if pending is not None:
+            with pending.lock:
+                pass
 
+    def _discard(self, session_id: str):
+        """このプロセスのセッションのみを削除"""
+        with self._lock:
+            self._remove(session_id)
 
-def get_session(session_id: str) -> Optional[ConsultationSession]:
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _evict_expired(self) -> List[ConsultationSession]:
+        """
+        期限切れのセッションを削除し、アイドルのセッションを退避するために取り除く（ストアのロックの中で呼ぶ）
+
+        Returns:
+            退避するセッション（_spill に渡す）
+        """
+        # OrderedDict is kept in access order, so expired (and idle) sessions are at the front
+        now = time.monotonic()
+        victims = []
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if self._is_expired(session):
+                self._remove(session_id)
+                continue
+            if self.spill is None or self.idle_seconds <= 0 or now - session.last_accessed <= self.idle_seconds:
+                break
+            if not self._take_for_spill(session):
+                break
+            victims.append(session)
+        return victims
+
+    def _evict_over_capacity(self, keep: str) -> List[ConsultationSession]:
+        """件数・メモリの上限を超えた分を追い出す（ストアのロックの中で呼ぶ。退避するセッションを返す）"""
+        victims = self._evict_expired()
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or self._total_bytes > self.max_bytes
+        ):
+            session_id, session = next(iter(self._sessions.items()))
+            if session_id == keep:
+                break
+            if self.spill is None:
+                self._remove(session_id)
+            elif self._take_for_spill(session):
+                victims.append(session)
+            else:
+                break
+        return victims
+
+    def _take_for_spill(self, session: ConsultationSession) -> bool:
+        """
+        退避するセッションをメモリから取り除く（ストアのロックの中で呼ぶ。セッションのロックは _spill で解放する）
+
+        Returns:
+            リクエストの処理中（セッションのロックが取れない）で取り除かなかった場合はFalse
+        """
+        if not session.lock.acquire(blocking=False):
+            return False
+        self._remove(session.session_id)
+        self._spilling[session.session_id] = session
+        return True
+
+    def _spill(self, victims: List[ConsultationSession]):
+        """取り除いたセッションを退避先に書き込む（ストアのロックの外で呼ぶ。失敗したセッションはメモリに戻す）"""
+        for session in victims:
+            spilled = False
+            try:
+                ttl = 0.0  # 退避先でもセッションの残りのTTLで期限切れにする
+                if self.ttl_seconds > 0:
+                    ttl = max(self.ttl_seconds - (time.monotonic() - session.last_accessed), 0.001)
+                self.spill.set(session.session_id, session.save_state(), ttl)
+                spilled = True
+            except Exception:
+                logger.warning("Failed to spill session %s; keeping it in memory", session.session_id, exc_info=True)
+            finally:
+                with self._lock:
+                    self._spilling.pop(session.session_id, None)
+                    if spilled:
+                        self.spilled += 1
+                    elif session.session_id not in self._sessions:
+                        self._sessions[session.session_id] = session
+                        self._sessions.move_to_end(session.session_id, last=False)
+                        self._total_bytes += session.size_bytes
+                session.lock.release()
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._total_bytes -= session.size_bytes
+
+    def _is_expired(self, session: ConsultationSession) -> bool:
+        return self.ttl_seconds > 0 and time.monotonic() - session.last_accessed > self.ttl_seconds
+
+
+# Global session storage (in-memory per process, shared through the backend if configured)
+session_store = SessionStore(
+    backend=create_session_backend(CONSULTATION_SESSION_BACKEND_URL),
+    spill=SqliteSessionBackend(CONSULTATION_SESSION_SPILL_PATH) if CONSULTATION_SESSION_SPILL_PATH else None,
+)
+
+
+def get_session(session_id: str, db: Optional[Session] = None) -> Optional[ConsultationSession]:
     """Get existing session"""
-    return _sessions.get(session_id)
+    return session_store.get(session_id, db)
 
 
-def create_session(session_id: str, db: Session, visa_type: str) -> ConsultationSession:
+def create_session(db: Session, visa_type: str) -> ConsultationSession:
     """Create new consultation session"""
-    session = ConsultationSession(session_id, db, visa_type)
-    _sessions[session_id] = session
-    return session
+    return session_store.create(db, visa_type)
 
 
 def delete_session(session_id: str):
     """Delete consultation session"""
-    if session_id in _sessions:
-        del _sessions[session_id]
+    session_store.delete(session_id)
+
+
+def _get_state_knowledge_base(db: Session, visa_type: str, version: str) -> KnowledgeBase:
+    """保存された状態の知識ベース（そのバージョンがもう使われていなければ StaleStateError）"""
+    knowledge_base = knowledge_base_registry.get_version(visa_type, version)
+    if knowledge_base is None:
+        knowledge_base = knowledge_base_registry.get(db, visa_type)
+        if knowledge_base.version != version:
+            raise StaleStateError("The knowledge base has been updated. Please start consultation again.")
+    return knowledge_base
+
+
+def restore_session(db: Session, state_token: str) -> ConsultationSession:
+    """
+    状態トークンからセッションを取得（ステートレスモード）
+
+    このプロセスにそのトークンを発行したセッションがあればそれを使い、
+    なければ（別のワーカーが発行した・追い出された・古いトークン）トークンから再構築してストアに入れる。
+
+    Raises:
+        StateTokenError: ステートレスモードが無効、またはトークンが不正
+        StaleStateError: トークンの知識ベースのバージョンがもう使われていない
+    """
+    codec = session_codec.state_codec
+    if codec is None:
+        raise StateTokenError("Stateless consultation is not enabled")
+
+    knowledge_base, state = codec.decode(state_token, lambda v, version: _get_state_knowledge_base(db, v, version))
+    session = session_store.get_issued(state.session_id, state_token)
+    if session is not None:
+        return session
+
+    session = ConsultationSession.from_state(db, state, knowledge_base)
+    session.state_token = state_token
+    session_store.add(session)
+    return session
+
+
+def diagnose_case(
+    visa_type: str,
+    answers: Dict[str, Optional[bool]],
+    knowledge_base: KnowledgeBase,
+    question_catalog: QuestionCatalog,
+) -> Dict:
+    """
+    あらかじめ用意された回答で1件を診断（一括診断用）
+
+    対話の診断と同じ順序で質問をたどり、回答があれば反映し、
+    回答のない質問に到達したらそこで止める。
+    知識ベースと質問カタログは呼び出し側で用意したものを使い、DBにはアクセスしない。
+
+    Args:
+        visa_type: ビザタイプ（"ALL"で全ビザタイプ）
+        answers: fact_name（または質問文）-> 回答（True=はい, False=いいえ, None=分からない）
+        knowledge_base: visa_type のコンパイル済み知識ベース（"ALL"なら全ビザタイプの和集合）
+        question_catalog: 質問カタログ
+
+    Returns:
+        結論・不足している重要情報・次の未回答の質問
+    """
+    all_visa_mode = visa_type == "ALL"
+    answers = {question_catalog.get_fact_name(key): value for key, value in answers.items()}
+    engine = InferenceEngine(None, visa_type, knowledge_base=knowledge_base, question_catalog=question_catalog)
+
+    next_question_fact = engine.get_next_question()
+    while next_question_fact is not None and next_question_fact in answers:
+        answer = answers[next_question_fact]
+        apply_answer(engine, next_question_fact, answer)
+        if answer is not None:
+            engine.forward_chain()
+        next_question_fact = engine.get_next_question()
+
+    is_finished = next_question_fact is None
+    if is_finished:
+        engine.finalize_diagnosis()
+
+    return {
+        "visa_type": visa_type,
+        "is_finished": is_finished,
+        "conclusions": engine.get_conclusions() if is_finished else [],
+        "all_conclusions": engine.get_conclusions_by_visa_type() if all_visa_mode and is_finished else {},
+        "missing_critical_info": engine.get_missing_critical_info() if is_finished else [],
+        "insufficient_info": is_finished and not engine.is_goal_achieved() and len(engine.unknown_facts) > 0,
+        "next_question": question_catalog.get_question_text(next_question_fact) if next_question_fact else None,
+        "next_question_fact": next_question_fact,
+        "current_visa_type": (
+            engine.get_question_visa_type(next_question_fact) if all_visa_mode and next_question_fact else None
+        ),
+    }
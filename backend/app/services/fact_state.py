@@ -0,0 +1,75 @@
+from collections.abc import Mapping, Set
+from typing import Iterator
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """ビットセットの立っているビットの位置（事実ID）を昇順に列挙"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class FactMapView(Mapping):
+    """
+    ビットセットで保持された事実を fact_name -> bool の読み取り専用マッピングとして見せるビュー
+
+    エンジンの (既知ビット, 値ビット) の属性を参照するので、状態の変化は即座に反映される。
+    文字列への変換はAPIの境界（このビュー）でのみ行う。
+    """
+
+    __slots__ = ("_engine", "_known_attr", "_values_attr")
+
+    def __init__(self, engine, known_attr: str, values_attr: str):
+        self._engine = engine
+        self._known_attr = known_attr
+        self._values_attr = values_attr
+
+    def __getitem__(self, fact_name: str) -> bool:
+        fact_id = self._engine._lookup_fact_id(fact_name)
+        if fact_id is None or not getattr(self._engine, self._known_attr) >> fact_id & 1:
+            raise KeyError(fact_name)
+        return bool(getattr(self._engine, self._values_attr) >> fact_id & 1)
+
+    def __contains__(self, fact_name) -> bool:
+        fact_id = self._engine._lookup_fact_id(fact_name)
+        return fact_id is not None and bool(getattr(self._engine, self._known_attr) >> fact_id & 1)
+
+    def __iter__(self) -> Iterator[str]:
+        fact_name = self._engine._fact_name
+        return (fact_name(fact_id) for fact_id in iter_bits(getattr(self._engine, self._known_attr)))
+
+    def __len__(self) -> int:
+        return getattr(self._engine, self._known_attr).bit_count()
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class FactSetView(Set):
+    """ビットセットで保持された事実を fact_name の読み取り専用集合として見せるビュー"""
+
+    __slots__ = ("_engine", "_attr")
+
+    def __init__(self, engine, attr: str):
+        self._engine = engine
+        self._attr = attr
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # 集合演算の結果は通常の set
+        return set(iterable)
+
+    def __contains__(self, fact_name) -> bool:
+        fact_id = self._engine._lookup_fact_id(fact_name)
+        return fact_id is not None and bool(getattr(self._engine, self._attr) >> fact_id & 1)
+
+    def __iter__(self) -> Iterator[str]:
+        fact_name = self._engine._fact_name
+        return (fact_name(fact_id) for fact_id in iter_bits(getattr(self._engine, self._attr)))
+
+    def __len__(self) -> int:
+        return getattr(self._engine, self._attr).bit_count()
+
+    def __repr__(self) -> str:
+        return repr(set(self))
@@ -1,156 +1,697 @@
-from typing import Dict, List, Optional, Set, Tuple
-from sqlalchemy.orm import Session, joinedload
-from app.models.models import Rule, Condition, Question
-import copy
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+from app.services.fact_state import FactMapView, FactSetView, iter_bits
+from app.services.knowledge_base import (
+    ALL_VISA_TYPES,
+    ZOBRIST_ASKED,
+    ZOBRIST_FALSE,
+    ZOBRIST_TRUE,
+    ZOBRIST_UNCERTAIN,
+    ZOBRIST_UNKNOWN,
+    CompiledRule,
+    KnowledgeBase,
+    knowledge_base_registry,
+)
+from app.services.question_cache import NextQuestionCache, next_question_cache
+from app.services.question_catalog import QuestionCatalog, question_catalog_registry
+from app.services.rete_matcher import FACT_FALSE, FACT_TRUE, OPEN, ReteMatcher, rete_network_registry
+from app.services.rule_compiler import RuleCheck, rule_evaluator_registry
+import heapq
+import os
+import sys
+import time
+
+
+_MISSING = object()  # Marker for "fact was not set" in the undo trail
+
+# 後向き推論の1回の探索で展開するルール・条件の数と時間（秒）の上限（0で無制限）。
+# 超えた場合は探索を打ち切り、線形走査で近似の質問を求める
+BACKWARD_CHAINING_MAX_NODES = int(os.getenv("BACKWARD_CHAINING_MAX_NODES", "200000"))
+BACKWARD_CHAINING_MAX_SECONDS = float(os.getenv("BACKWARD_CHAINING_MAX_SECONDS", "0.5"))
+_SEARCH_CLOCK_INTERVAL = 256  # 経過時間はこのノード数ごとに確認する
+
+# ルールの条件の照合方式（"naive": 事実を条件に持つルールごとに評価、"rete": 条件を共有するネットワーク）
+RULE_MATCHER = os.getenv("RULE_MATCHER", "naive")
+
+# 集合の状態の種類 -> (ビットセットの属性名, フィンガープリントの状態の種類)
+# 導出済みかどうかは次の質問の探索に影響しないのでフィンガープリントに含めない
+_SET_ATTRS = {
+    "derived": ("_derived", None),
+    "asked": ("_asked", ZOBRIST_ASKED),
+    "unknown": ("_unknown", ZOBRIST_UNKNOWN),
+}
+
+
+# 可視化の条件の状態のコード（コンパクトな状態配列用。文字列の1文字が1つの条件）
+CONDITION_STATUS_CODES = {"unknown": "0", "satisfied": "1", "not_satisfied": "2", "uncertain": "3"}
+
+# 可視化のルールの状態のフラグ
+RULE_CONCLUSION_DERIVED = 1
+RULE_FIRED = 2
+RULE_FIREABLE = 4
+
+
+class _TrailFrame:
+    """アンドゥ用の1ステップ分の変更記録"""
+
+    __slots__ = ("changes", "agenda")
+
+    def __init__(self, agenda: Set[int]):
+        self.changes: List[tuple] = []  # (kind, key, old value) in the order they were applied
+        self.agenda = agenda  # Agenda at the start of the step
 
 
 class InferenceEngine:
     """後向き推論エンジン（Backward Chaining）- ゴール指向推論"""
 
-    def __init__(self, db: Session, visa_type: str):
+    def __init__(
+        self,
+        db: Session,
+        visa_type: str,
+        knowledge_base: Optional[KnowledgeBase] = None,
+        question_catalog: Optional[QuestionCatalog] = None,
+        question_cache: Optional[NextQuestionCache] = None,
+        matcher: Optional[str] = None,
+    ):
         self.db = db
         self.visa_type = visa_type
-        self.facts: Dict[str, bool] = {}  # Known facts (confirmed)
-        self.uncertain_facts: Dict[str, bool] = {}  # Facts set from "わからない" (not confirmed)
-        self.derived_facts: Set[str] = set()  # Facts derived from rules (not asked)
-        self.asked_questions: Set[str] = set()  # Questions already asked to user
+        self.knowledge_base = knowledge_base  # Shared compiled rules (loaded from the registry if None)
+        self.question_catalog = question_catalog  # Question master (current registry catalog if None)
+        self.question_cache = question_cache if question_cache is not None else next_question_cache  # Next question cache shared across sessions
+        self.matcher = matcher or RULE_MATCHER  # Rule condition matcher ("naive" or "rete")
+        if self.matcher not in ("naive", "rete"):
+            raise ValueError(f"Unknown rule matcher: {self.matcher}")
+
+        # 事実の状態は知識ベースの事実IDのビットセットで保持する
+        self._known = 0  # 確定した事実
+        self._values = 0  # 確定した事実の値（True のビット）
+        self._uncertain_known = 0  # 「わからない」で仮置きした事実
+        self._uncertain_values = 0
+        self._derived = 0
+        self._asked = 0
+        self._unknown = 0
+        self._fired = 0  # 発火済みルール（ルールindexのビット）
+        # 発火不可能になったルール（_is_rule_impossible、ルールindexのビット）。条件の事実が変わるたびに差分で更新し、
+        # 後向き推論と前向き推論はこれらのルールを評価せずに飛ばす
+        self._dead = 0
+        # 次の質問の探索に影響する状態（確定した事実と値・不確実・わからない・質問済み・発火済み）の
+        # Zobristハッシュ。状態の変更ごとに差分で更新する
+        self._fingerprint = 0
+        # 前回の get_changed_rules() 以降に状態が変化した事実と発火状態が変化したルール（可視化の差分用）
+        self._changed_facts = 0
+        self._changed_rules = 0
+        # 知識ベースにない事実（ルールに出てこない質問など）のセッション固有の事実ID
+        self._extra_fact_ids: Dict[str, int] = {}
+        self._extra_fact_names: List[str] = []
+
+        # 外部向けには fact_name（文字列）で見せる読み取り専用ビュー
+        self.facts = FactMapView(self, "_known", "_values")  # Known facts (confirmed)
+        self.uncertain_facts = FactMapView(self, "_uncertain_known", "_uncertain_values")  # Facts set from "わからない" (not confirmed)
+        self.derived_facts = FactSetView(self, "_derived")  # Facts derived from rules (not asked)
+        self.asked_questions = FactSetView(self, "_asked")  # Questions already asked to user
         self.fired_rules: List[str] = []  # Rules that have been applied
-        self.unknown_facts: Set[str] = set()  # Facts answered as "分からない"
-        self.goal = f"{visa_type}ビザでの申請ができます"  # Final goal
+        self.unknown_facts = FactSetView(self, "_unknown")  # Facts answered as "分からない"
+        # 診断するビザタイプとゴール（"ALL" では全ビザタイプのゴールを1つのエンジンで同時に追う）
+        self.visa_types: List[str] = list(ALL_VISA_TYPES) if visa_type == "ALL" else [visa_type]
+        self.goals: List[str] = [f"{v}ビザでの申請ができます" for v in self.visa_types]
+        self.goal = self.goals[0]  # Final goal (the first goal in ALL mode)
         self.all_rules = None  # Cache for all rules
         self.rules_by_conclusion = {}  # Cache: conclusion -> rules
+        self.rules_by_conclusion_id: Tuple[Tuple[CompiledRule, ...], ...] = ()  # Cache: fact id -> rules
+        self.rules_by_fact: Tuple[Tuple[int, ...], ...] = ()  # Cache: fact id -> rule indices
+        # ルールindex -> 評価関数 (known, values) -> bool（知識ベースのバージョンごとに生成したコード）
+        self._holds: Tuple[RuleCheck, ...] = ()  # 条件が満たされているか
+        self._impossible: Tuple[RuleCheck, ...] = ()  # 発火不可能か
+        # matcher="rete" のみ：条件を共有するネットワークの状態（満たされた・発火不可能なルールを事実の変化ごとに差分で保持）
+        self._rete: Optional[ReteMatcher] = None
+
+        self._justifications: Dict[int, List[int]] = {}  # 結論の事実ID -> それを導出した発火済みルール（発火順）
+        self._overridden: Dict[int, bool] = {}  # 導出値で上書きされたユーザーの回答
+
+        # アジェンダ（前向き推論の発火候補）
+        self._agenda: Set[int] = set()  # 次回の forward_chain で評価するルール
+        self._chain_cursor: Optional[int] = None  # forward_chain 実行中のみ：現在評価中のルールの評価順序
+        self._current_pass: List[int] = []
+        self._next_pass: List[int] = []
+
+        # 後向き推論の探索の上限（展開するルール・条件の数と時間、0で無制限）
+        self.max_search_nodes = BACKWARD_CHAINING_MAX_NODES
+        self.max_search_seconds = BACKWARD_CHAINING_MAX_SECONDS
+        self._search_truncated = False  # 直前の探索を上限で打ち切ったか
+
+        # アンドゥ用のトレイル（ステップごとに追加された事実・導出・発火ルールのみを記録）
+        self._trail: List[_TrailFrame] = []
+        self._undoing = False
 
     def add_fact(self, fact_name: str, value: bool):
         """Add a fact to the knowledge base"""
-        self.facts[fact_name] = value
-        if fact_name not in self.asked_questions:
-            self.asked_questions.add(fact_name)
+        fact_id = self._fact_id(fact_name)
+        self._set_fact(fact_id, value)
+        self._add_to_set("asked", fact_id)
 
     def add_uncertain_fact(self, fact_name: str, value: bool):
         """Add an uncertain fact (from '分からない' answer)"""
-        self.uncertain_facts[fact_name] = value
-        self.unknown_facts.add(fact_name)
-        if fact_name not in self.asked_questions:
-            self.asked_questions.add(fact_name)
+        fact_id = self._fact_id(fact_name)
+        self._set_uncertain(fact_id, value)
+        self._add_to_set("unknown", fact_id)
+        self._add_to_set("asked", fact_id)
 
     def add_unknown_fact(self, fact_name: str):
         """Mark a fact as unknown (user answered '分からない')"""
-        self.unknown_facts.add(fact_name)
-        if fact_name not in self.asked_questions:
-            self.asked_questions.add(fact_name)
+        fact_id = self._fact_id(fact_name)
+        self._add_to_set("unknown", fact_id)
+        self._add_to_set("asked", fact_id)
 
     def remove_fact(self, fact_name: str):
-        """Remove a fact and all derived facts that depend on it"""
-        if fact_name in self.facts:
-            del self.facts[fact_name]
-        if fact_name in self.asked_questions:
-            self.asked_questions.remove(fact_name)
-        if fact_name in self.unknown_facts:
-            self.unknown_facts.remove(fact_name)
-
-        # Remove derived facts that may depend on this
-        # This is a simplified approach - clear all derived facts
-        self.derived_facts.clear()
-        self.fired_rules.clear()
-
-        # Clear caches (for backward chaining)
-        self.all_rules = None
-        self.rules_by_conclusion.clear()
-
-        # Re-derive facts from remaining known facts
+        """
+        Remove a fact and all derived facts that depend on it
+
+        発火したルールを導出の根拠（justification）として記録しているため、
+        取り消した事実に依存する結論だけを再帰的に取り消す。
+        他の発火ルールにも支えられている結論はそのまま残る。
+        """
+        fact_id = self._fact_id(fact_name)
+        self._remove_from_set("asked", fact_id)
+        self._remove_from_set("unknown", fact_id)
+        if self._uncertain_known >> fact_id & 1:
+            self._set_uncertain(fact_id, _MISSING)
+
+        # ユーザーの回答を取り消す（ルールで導出されている場合は導出値に戻る）
+        self._drop_overridden(fact_id)
+        if self._reconcile_fact(fact_id):
+            self._propagate_retraction(fact_id)
+
+        # 取り消しで発火可能になったルールだけを評価
         self.forward_chain()
 
     def forward_chain(self) -> Dict[str, bool]:
         """
         前向き推論を実行
         既知の事実から新しい事実を導出
-        """
-        changed = True
-        while changed:
-            changed = False
-            rules = self._get_applicable_rules()
 
-            for rule in rules:
-                if rule.rule_id in self.fired_rules:
+        事実が変化したときに、その事実を条件に持つルールだけをアジェンダに積み、
+        知識ベースの評価順序（依存の深さ順）で評価する。
+        ルールの依存関係が非巡回なら、発火で積まれるルールは必ず現在位置より後ろなので1パスで終わる。
+        循環がある知識ベースでは評価順序は優先度順で、従来どおり変化がなくなるまでパスを繰り返す：
+        現在のパスで未評価のルールは同じパスで、評価済みのルールは次のパスで評価する。
+        """
+        rules = self._get_applicable_rules()
+        evaluation_order = self.knowledge_base.evaluation_order
+
+        self._current_pass = [rules[index].position for index in self._agenda]
+        heapq.heapify(self._current_pass)
+        self._next_pass = []
+        self._agenda = set()
+        self._chain_cursor = -1
+
+        try:
+            while self._current_pass or self._next_pass:
+                if not self._current_pass:
+                    # 次のパスへ（先頭から再評価、循環がある場合のみ）
+                    self._current_pass, self._next_pass = self._next_pass, []
+                    heapq.heapify(self._current_pass)
+                    self._chain_cursor = -1
+
+                position = heapq.heappop(self._current_pass)
+                self._chain_cursor = position
+                rule = evaluation_order[position]
+                if self._fired >> rule.index & 1:
                     continue
 
-                can_fire, all_conditions_known = self._can_fire_rule(rule)
-
                 # OR条件：1つでも満たされたら即座に発火
                 # AND条件：全ての条件が既知で満たされている時のみ発火
-                should_fire = False
-                if rule.operator == "OR":
-                    should_fire = can_fire  # 1つでも満たされたら発火
-                else:  # AND
-                    should_fire = all_conditions_known and can_fire  # 全条件が既知かつ満たされている
-
-                if should_fire:
-                    # Fire the rule
-                    self.facts[rule.conclusion] = rule.conclusion_value
-                    self.derived_facts.add(rule.conclusion)
-                    self.fired_rules.append(rule.rule_id)
-                    changed = True
+                if self._rete is not None:
+                    if self._rete.holds >> rule.index & 1:
+                        self._fire_rule(rule.index)
+                elif self._holds[rule.index](self._known, self._values):
+                    self._fire_rule(rule.index)
+        finally:
+            self._chain_cursor = None
+            self._current_pass = []
+            self._next_pass = []
 
         return self.facts
 
-    def _get_applicable_rules(self) -> List[Rule]:
-        """Get rules for the current visa type (cached)"""
-        if self.all_rules is None:
-            self.all_rules = (
-                self.db.query(Rule)
-                .options(joinedload(Rule.conditions))  # Eager load conditions
-                .filter(Rule.visa_type == self.visa_type)
-                .order_by(Rule.priority.desc())
-                .all()
-            )
-            # Build conclusion -> rules cache
-            for rule in self.all_rules:
-                if rule.conclusion not in self.rules_by_conclusion:
-                    self.rules_by_conclusion[rule.conclusion] = []
-                self.rules_by_conclusion[rule.conclusion].append(rule)
-        return self.all_rules
+    def _fact_id(self, fact_name: str) -> int:
+        """fact_nameを事実IDに変換（知識ベースにない事実にはセッション固有のIDを割り当てる）"""
+        self._get_applicable_rules()
+        fact_id = self.knowledge_base.fact_ids.get(fact_name)
+        if fact_id is None:
+            fact_id = self._extra_fact_ids.get(fact_name)
+            if fact_id is None:
+                fact_id = len(self.knowledge_base.fact_names) + len(self._extra_fact_names)
+                self._extra_fact_ids[fact_name] = fact_id
+                self._extra_fact_names.append(fact_name)
+        return fact_id
+
+    def _lookup_fact_id(self, fact_name: str) -> Optional[int]:
+        """fact_nameの事実IDを取得（IDが未割り当てならNone）"""
+        if self.knowledge_base is None:
+            return None
+        fact_id = self.knowledge_base.fact_ids.get(fact_name)
+        if fact_id is None:
+            fact_id = self._extra_fact_ids.get(fact_name)
+        return fact_id
+
+    def _fact_name(self, fact_id: int) -> str:
+        """事実IDをfact_nameに変換"""
+        fact_names = self.knowledge_base.fact_names
+        if fact_id < len(fact_names):
+            return fact_names[fact_id]
+        return self._extra_fact_names[fact_id - len(fact_names)]
+
+    def _fact_value(self, fact_id: int):
+        """確定した事実の値（未確定なら _MISSING）"""
+        if not self._known >> fact_id & 1:
+            return _MISSING
+        return bool(self._values >> fact_id & 1)
+
+    def _fire_rule(self, index: int):
+        """ルールを発火し、結論の根拠として記録"""
+        rule = self.all_rules[index]
+        self._record(("fired", rule.rule_id, index))
+        self.fired_rules.append(rule.rule_id)
+        self._flip_fired(index)
+
+        conclusion_id = rule.conclusion_id
+        justifications = self._justifications.setdefault(conclusion_id, [])
+        if not justifications and self._known >> conclusion_id & 1 and conclusion_id not in self._overridden:
+            # ユーザーの回答を導出値で上書きする：取り消し時に戻せるよう保存
+            self._record(("overridden", conclusion_id, _MISSING))
+            self._overridden[conclusion_id] = bool(self._values >> conclusion_id & 1)
+        justifications.append(index)
+
+        self._add_to_set("derived", conclusion_id)
+        self._set_fact(conclusion_id, rule.conclusion_value)
+
+    def _unfire_rule(self, index: int):
+        """発火済みルールを取り消し、結論の根拠から外す"""
+        rule = self.all_rules[index]
+        position = self.fired_rules.index(rule.rule_id)
+        del self.fired_rules[position]
+        self._flip_fired(index)
+
+        justifications = self._justifications[rule.conclusion_id]
+        justification_position = justifications.index(index)
+        del justifications[justification_position]
+        self._record(("unfired", rule.rule_id, (index, position, justification_position)))
+
+    def _drop_overridden(self, fact_id: int):
+        """導出値で上書きされたユーザーの回答を破棄"""
+        if fact_id in self._overridden:
+            self._record(("overridden", fact_id, self._overridden.pop(fact_id)))
+
+    def _reconcile_fact(self, fact_id: int) -> bool:
+        """
+        事実の値を現在の根拠に合わせる
 
-    def _get_rules_with_conclusion(self, conclusion: str) -> List[Rule]:
-        """Get all rules that have the given conclusion"""
-        if not self.rules_by_conclusion:
-            self._get_applicable_rules()  # Initialize cache
-        return self.rules_by_conclusion.get(conclusion, [])
+        発火ルールが残っていれば最後に発火したルールの結論値、なければ上書き前のユーザーの回答、
+        どちらもなければ未知に戻す。
 
-    def _can_fire_rule(self, rule: Rule) -> Tuple[bool, bool]:
+        Returns:
+            事実の値が変化したかどうか
         """
-        Check if a rule can fire (using only confirmed facts, not uncertain)
-        Returns: (can_fire, all_conditions_known)
+        justifications = self._justifications.get(fact_id)
+        if justifications:
+            value = self.all_rules[justifications[-1]].conclusion_value
+        else:
+            self._remove_from_set("derived", fact_id)
+            value = self._overridden.get(fact_id, _MISSING)
+            self._drop_overridden(fact_id)
+
+        old_value = self._fact_value(fact_id)
+        if value is _MISSING:
+            if old_value is _MISSING:
+                return False
+            self._unset_fact(fact_id)
+            return True
+        if old_value is not _MISSING and old_value == value:
+            return False
+        self._set_fact(fact_id, value)
+        return True
+
+    def _propagate_retraction(self, fact_id: int):
+        """変化した事実を条件に持つ発火済みルールのうち、条件を満たさなくなったものを再帰的に取り消す"""
+        pending = [fact_id]
+        while pending:
+            changed = pending.pop()
+            for index in self._rules_using(changed):
+                if not self._fired >> index & 1 or self._conditions_hold(index):
+                    continue
+                self._unfire_rule(index)
+                conclusion_id = self.all_rules[index].conclusion_id
+                if self._reconcile_fact(conclusion_id):
+                    pending.append(conclusion_id)
+
+    def _set_fact(self, fact_id: int, value: bool):
+        """事実を設定し、その事実を条件に持つルールをアジェンダの候補として評価"""
+        old_value = self._fact_value(fact_id)
+        self._record(("fact", fact_id, old_value))
+        if old_value is not _MISSING:
+            self._toggle_fingerprint(ZOBRIST_TRUE if old_value else ZOBRIST_FALSE, fact_id)
+        self._toggle_fingerprint(ZOBRIST_TRUE if value else ZOBRIST_FALSE, fact_id)
+        bit = 1 << fact_id
+        self._known |= bit
+        if value:
+            self._values |= bit
+        else:
+            self._values &= ~bit
+        self._changed_facts |= bit
+
+        if self._rete is not None:
+            old_state = OPEN if old_value is _MISSING else FACT_TRUE if old_value else FACT_FALSE
+            for index in self._rete.update(fact_id, old_state, FACT_TRUE if value else FACT_FALSE):
+                if not self._fired >> index & 1:
+                    self._schedule(index)
+            self._dead = self._rete.dead
+            return
+
+        # _update_dead_rule と _schedule_if_fireable をまとめて評価（条件を持つルールが多い事実で呼び出しが支配的になる）
+        known, values = self._known, self._values
+        holds, impossible = self._holds, self._impossible
+        for index in self._rules_using(fact_id):
+            if impossible[index](known, values):
+                self._dead |= 1 << index
+                continue
+            self._dead &= ~(1 << index)
+            if not self._fired >> index & 1 and holds[index](known, values):
+                self._schedule(index)
+
+    def _unset_fact(self, fact_id: int):
+        """事実を削除"""
+        old_value = self._fact_value(fact_id)
+        self._record(("fact", fact_id, old_value))
+        self._toggle_fingerprint(ZOBRIST_TRUE if old_value else ZOBRIST_FALSE, fact_id)
+        mask = ~(1 << fact_id)
+        self._known &= mask
+        self._values &= mask
+        self._changed_facts |= 1 << fact_id
+
+        if self._rete is not None:
+            # 事実の削除で新たに条件が満たされるルールはない
+            self._rete.update(fact_id, FACT_TRUE if old_value else FACT_FALSE, OPEN)
+            self._dead = self._rete.dead
+            return
+        for index in self._rules_using(fact_id):
+            self._update_dead_rule(index)
+
+    def _update_dead_rule(self, index: int):
+        """ルールの発火不可能の印を現在の事実に合わせる（事実から決まるのでトレイルには記録しない）"""
+        if self._impossible[index](self._known, self._values):
+            self._dead |= 1 << index
+        else:
+            self._dead &= ~(1 << index)
+
+    def _set_uncertain(self, fact_id: int, value):
+        """不確実な事実を設定（_MISSING なら削除）"""
+        bit = 1 << fact_id
+        old_value = bool(self._uncertain_values & bit) if self._uncertain_known & bit else _MISSING
+        self._record(("uncertain", fact_id, old_value))
+        if (old_value is _MISSING) != (value is _MISSING):
+            self._toggle_fingerprint(ZOBRIST_UNCERTAIN, fact_id)
+        if value is _MISSING:
+            self._uncertain_known &= ~bit
+            self._uncertain_values &= ~bit
+            return
+        self._uncertain_known |= bit
+        if value:
+            self._uncertain_values |= bit
+        else:
+            self._uncertain_values &= ~bit
+
+    def _add_to_set(self, kind: str, fact_id: int):
+        """状態の集合に要素を追加（新規の場合のみトレイルに記録）"""
+        if not getattr(self, _SET_ATTRS[kind][0]) >> fact_id & 1:
+            self._record((kind, fact_id, None))
+            self._flip(kind, fact_id)
+
+    def _remove_from_set(self, kind: str, fact_id: int):
+        """状態の集合から要素を削除（存在した場合のみトレイルに記録）"""
+        if getattr(self, _SET_ATTRS[kind][0]) >> fact_id & 1:
+            self._record((kind + "_removed", fact_id, None))
+            self._flip(kind, fact_id)
+
+    def _flip(self, kind: str, fact_id: int):
+        """状態の集合の要素を反転し、フィンガープリントを更新"""
+        attr, zobrist_state = _SET_ATTRS[kind]
+        setattr(self, attr, getattr(self, attr) ^ (1 << fact_id))
+        self._changed_facts |= 1 << fact_id
+        if zobrist_state is not None:
+            self._toggle_fingerprint(zobrist_state, fact_id)
+
+    def _flip_fired(self, index: int):
+        """ルールの発火済みビットを反転し、フィンガープリントを更新"""
+        self._fired ^= 1 << index
+        self._fingerprint ^= self.knowledge_base.zobrist_rule_keys[index]
+        self._changed_rules |= 1 << index
+
+    def _toggle_fingerprint(self, zobrist_state: int, fact_id: int):
+        """事実の状態をフィンガープリントに加える/取り除く（XORなので同じ操作で元に戻る）"""
+        keys = self.knowledge_base.zobrist_fact_keys[zobrist_state]
+        # 知識ベースにない事実はルールに出てこないので、次の質問に影響しない
+        if fact_id < len(keys):
+            self._fingerprint ^= keys[fact_id]
+
+    def _compute_fingerprint(self) -> int:
+        """現在の状態からフィンガープリントを計算（差分更新の結果と一致する）"""
+        zobrist_fact_keys = self.knowledge_base.zobrist_fact_keys
+        fact_count = len(self.knowledge_base.fact_names)
+        kb_mask = (1 << fact_count) - 1
+        fingerprint = 0
+        for zobrist_state, mask in (
+            (ZOBRIST_TRUE, self._known & self._values),
+            (ZOBRIST_FALSE, self._known & ~self._values),
+            (ZOBRIST_UNCERTAIN, self._uncertain_known),
+            (ZOBRIST_UNKNOWN, self._unknown),
+            (ZOBRIST_ASKED, self._asked),
+        ):
+            for fact_id in iter_bits(mask & kb_mask):
+                fingerprint ^= zobrist_fact_keys[zobrist_state][fact_id]
+        for index in iter_bits(self._fired):
+            fingerprint ^= self.knowledge_base.zobrist_rule_keys[index]
+        return fingerprint
+
+    def _record(self, change: tuple):
+        """現在のステップの変更をトレイルに記録"""
+        if self._trail and not self._undoing:
+            self._trail[-1].changes.append(change)
+
+    def push_frame(self):
         """
-        if rule.operator == "AND":
-            all_conditions_known = True
-            can_fire = True
+        アンドゥ用の新しいステップを開始
 
-            for condition in rule.conditions:
-                # Only use confirmed facts (not uncertain_facts)
-                if condition.fact_name not in self.facts:
-                    all_conditions_known = False
-                    can_fire = False
-                    break
+        以降の変更は、次の push_frame() までこのステップに記録され、undo() で取り消せる
+        """
+        self._trail.append(_TrailFrame(set(self._agenda)))
 
-                if self.facts[condition.fact_name] != condition.expected_value:
-                    can_fire = False
-                    break
+    def undo(self, steps: int = 1) -> int:
+        """
+        直近のステップを取り消す（ステップの変更量に比例するコストで、コピーは行わない）
 
-            return can_fire, all_conditions_known
+        Returns:
+            実際に取り消したステップ数
+        """
+        undone = 0
+        self._undoing = True
+        try:
+            while undone < steps and self._trail:
+                frame = self._trail.pop()
+                for kind, key, old in reversed(frame.changes):
+                    self._revert_change(kind, key, old)
+                self._agenda |= frame.agenda
+                undone += 1
+        finally:
+            self._undoing = False
+        return undone
+
+    @contextmanager
+    def speculate(self) -> Iterator["InferenceEngine"]:
+        """
+        試行的に状態を変更し、ブロックを抜けると元に戻す（先読み用）
 
-        else:  # OR
-            # Check if all conditions are known (in facts)
-            all_conditions_known = all(
-                condition.fact_name in self.facts for condition in rule.conditions
-            )
-            # Can only fire if at least one confirmed fact satisfies the condition
-            can_fire = any(
-                condition.fact_name in self.facts
-                and self.facts[condition.fact_name] == condition.expected_value
-                for condition in rule.conditions
+        トレイルの1ステップとして記録して undo() で戻すので、状態のコピーは作らない。
+        可視化の差分用の変更記録も元に戻す（試行の変更は表示に影響しない）。
+        """
+        changed_facts, changed_rules = self._changed_facts, self._changed_rules
+        self.push_frame()
+        depth = len(self._trail)
+        try:
+            yield self
+        finally:
+            self.undo(len(self._trail) - depth + 1)
+            self._changed_facts, self._changed_rules = changed_facts, changed_rules
+
+    @property
+    def trail_depth(self) -> int:
+        """取り消し可能なステップ数"""
+        return len(self._trail)
+
+    def clone(self) -> "InferenceEngine":
+        """
+        現在の状態を持つ新しいエンジンを作成（セッションのテンプレートからの複製用）
+
+        事実の状態のビットセットは不変の整数なので共有し（書き込み時にそれぞれのエンジンで置き換わる）、
+        可変のコンテナのみをコピーする。トレイルは複製しない（複製以前のステップには戻れない）。
+        """
+        self._get_applicable_rules()
+        engine = object.__new__(InferenceEngine)
+        engine.__dict__.update(self.__dict__)
+        engine.facts = FactMapView(engine, "_known", "_values")
+        engine.uncertain_facts = FactMapView(engine, "_uncertain_known", "_uncertain_values")
+        engine.derived_facts = FactSetView(engine, "_derived")
+        engine.asked_questions = FactSetView(engine, "_asked")
+        engine.unknown_facts = FactSetView(engine, "_unknown")
+        engine.fired_rules = list(self.fired_rules)
+        engine._extra_fact_ids = dict(self._extra_fact_ids)
+        engine._extra_fact_names = list(self._extra_fact_names)
+        engine._justifications = {fact_id: list(rules) for fact_id, rules in self._justifications.items()}
+        engine._overridden = dict(self._overridden)
+        engine._agenda = set(self._agenda)
+        engine._rete = self._rete.copy() if self._rete is not None else None
+        engine._chain_cursor = None
+        engine._current_pass = []
+        engine._next_pass = []
+        engine._trail = []
+        engine._undoing = False
+        return engine
+
+    def _revert_change(self, kind: str, key, old):
+        if kind == "fact":
+            if old is _MISSING:
+                self._unset_fact(key)
+            else:
+                self._set_fact(key, old)
+        elif kind == "uncertain":
+            self._set_uncertain(key, old)
+        elif kind in _SET_ATTRS:
+            self._flip(kind, key)
+        elif kind.endswith("_removed"):
+            self._flip(kind[: -len("_removed")], key)
+        elif kind == "fired":
+            self.fired_rules.pop()
+            self._flip_fired(old)
+            self._justifications[self.all_rules[old].conclusion_id].pop()
+        elif kind == "unfired":
+            index, position, justification_position = old
+            self.fired_rules.insert(position, key)
+            self._flip_fired(index)
+            self._justifications[self.all_rules[index].conclusion_id].insert(justification_position, index)
+        elif kind == "overridden":
+            if old is _MISSING:
+                del self._overridden[key]
+            else:
+                self._overridden[key] = old
+
+    def estimate_memory(self) -> int:
+        """状態とトレイルのおおよそのメモリ使用量（バイト、共有される文字列は除く）"""
+        size = sum(
+            sys.getsizeof(state)
+            for state in (
+                self._known,
+                self._values,
+                self._uncertain_known,
+                self._uncertain_values,
+                self._derived,
+                self._asked,
+                self._unknown,
+                self._fired,
+                self._dead,
+                self.fired_rules,
+                self._justifications,
+                self._overridden,
+                self._extra_fact_ids,
+                self._extra_fact_names,
+                self._trail,
             )
+        )
+        for frame in self._trail:
+            size += sys.getsizeof(frame.changes) + len(frame.changes) * sys.getsizeof((None, None, None))
+        if self._rete is not None:
+            size += self._rete.estimate_memory()
+        return size
+
+    def _schedule_if_fireable(self, index: int):
+        """条件が満たされている未発火のルールをアジェンダに積む"""
+        if self._fired >> index & 1 or self._dead >> index & 1 or not self._conditions_hold(index):
+            return
+        self._schedule(index)
+
+    def _schedule(self, index: int):
+        """ルールをアジェンダに積む（forward_chain 実行中なら評価順序に応じて今回または次のパスへ）"""
+        position = self.all_rules[index].position
+        if self._chain_cursor is None:
+            self._agenda.add(index)
+        elif position > self._chain_cursor:
+            heapq.heappush(self._current_pass, position)
+        else:
+            heapq.heappush(self._next_pass, position)
+
+    def _conditions_hold(self, index: int) -> bool:
+        """ルールの条件が満たされているか（OR: 1つ以上、AND: 全て）"""
+        if self._rete is not None:
+            return self._rete.holds >> index & 1 == 1
+        return self._holds[index](self._known, self._values)
+
+    def _rules_using(self, fact_id: int) -> Tuple[int, ...]:
+        """事実を条件に持つルールのindex（知識ベースにない事実は空）"""
+        if fact_id < len(self.rules_by_fact):
+            return self.rules_by_fact[fact_id]
+        return ()
+
+    def _rebuild_rule_index(self):
+        """現在の事実から結論の根拠とアジェンダを再構築"""
+        self._agenda = set()
+
+        # 発火済みルールから結論の根拠を再構築
+        self._fired = 0
+        self._justifications = {}
+        for rule_id in self.fired_rules:
+            index = self.knowledge_base.rule_indices.get(rule_id)
+            if index is not None:
+                self._fired |= 1 << index
+                self._justifications.setdefault(self.all_rules[index].conclusion_id, []).append(index)
+        self._fingerprint = self._compute_fingerprint()
+        self._changed_rules = (1 << len(self.all_rules)) - 1  # 全てのルールの表示が変わりうる
+
+        if self._rete is not None:
+            self._rete.reset(self._known, self._values)
+            self._dead = self._rete.dead
+            for index in iter_bits(self._rete.holds & ~self._fired & ~self._dead):
+                self._schedule(index)
+            return
+        self._dead = 0
+        for index in range(len(self.all_rules)):
+            self._update_dead_rule(index)
+            self._schedule_if_fireable(index)
+
+    def _get_applicable_rules(self) -> List[CompiledRule]:
+        """Get rules for the current visa type (shared compiled knowledge base)"""
+        if self.all_rules is None:
+            if self.knowledge_base is None:
+                self.knowledge_base = knowledge_base_registry.get(self.db, self.visa_type)
+            self.all_rules = self.knowledge_base.rules
+            self.rules_by_conclusion = self.knowledge_base.rules_by_conclusion
+            self.rules_by_conclusion_id = self.knowledge_base.rules_by_conclusion_id
+            self.rules_by_fact = self.knowledge_base.rules_by_fact
+            evaluators = rule_evaluator_registry.get(self.knowledge_base)
+            self._holds, self._impossible = evaluators.holds, evaluators.impossible
+            if self.matcher == "rete":
+                self._rete = ReteMatcher(rete_network_registry.get(self.knowledge_base))
+            self._rebuild_rule_index()
+        return self.all_rules
+
+    def _get_rules_with_conclusion(self, conclusion: str) -> List[CompiledRule]:
+        """Get all rules that have the given conclusion"""
+        if self.all_rules is None:
+            self._get_applicable_rules()  # Initialize cache
+        return self.rules_by_conclusion.get(conclusion, [])
 
-            return can_fire, all_conditions_known
+    def _get_rules_with_conclusion_id(self, fact_id: int) -> Tuple[CompiledRule, ...]:
+        """事実IDを結論とするルール（優先度順）"""
+        if fact_id < len(self.rules_by_conclusion_id):
+            return self.rules_by_conclusion_id[fact_id]
+        return ()
 
     def get_next_question(self) -> Optional[str]:
         """
@@ -161,57 +702,208 @@ class InferenceEngine:
         2. そのルールの条件を満たすために必要な事実を探す
         3. 事実が導出可能なら、再帰的にその事実をゴールとして探索
         4. 導出不可能なら、ユーザーに質問
+
+        探索結果は状態のフィンガープリントをキーにプロセス全体でキャッシュされ、
+        同じ回答をたどった別のセッションでは探索を省略する。
+        """
+        self._get_applicable_rules()
+        key = (
+            self.visa_type,
+            self.knowledge_base.version,
+            self.get_question_catalog().version,
+            self._fingerprint,
+        )
+        question = self.question_cache.get(key, _MISSING)
+        if question is _MISSING:
+            self._search_truncated = False
+            question_id = self._find_question_for_goals()
+            question = self._fact_name(question_id) if question_id is not None else None
+            if not self._search_truncated:
+                # 上限で打ち切った近似の結果はキャッシュしない
+                self.question_cache.put(key, question)
+        return question
+
+    def _find_question_for_goals(self) -> Optional[int]:
         """
-        return self._find_question_for_goal(self.goal)
+        全てのゴールについて次の質問の候補を探し、最も多くのゴールを前進させるものを選ぶ
 
-    def _find_question_for_goal(self, goal: str, visited: Set[str] = None) -> Optional[str]:
+        各ゴールの候補のうち、質問の残っている他のゴールの到達範囲（KnowledgeBase.cone_mask）にも
+        含まれる数が最も多いものを選ぶ（同数ならゴールの順序で先のもの）。
+        1つの回答で複数のビザタイプの判定が進むので、全ビザモードの質問数が減る。
         """
-        指定されたゴールを達成するために必要な質問を探す（再帰的）
+        goal_ids = [self._fact_id(goal) for goal in self.goals]
+        if len(goal_ids) == 1:
+            return self._find_question_for_goal(goal_ids[0])
+
+        candidates = []  # (goal, question)
+        for goal in goal_ids:
+            question = self._find_question_for_goal(goal)
+            if question is not None:
+                candidates.append((goal, question))
+
+        best_question = None
+        best_score = 0
+        for _, question in candidates:
+            score = sum(1 for goal, _ in candidates if self.knowledge_base.cone_mask(goal) >> question & 1)
+            if score > best_score:
+                best_question, best_score = question, score
+        return best_question
+
+    def get_question_visa_type(self, fact_name: str) -> Optional[str]:
+        """質問が判定を進めるビザタイプ（未達成のゴールのうち、到達範囲に質問を含む最初のもの）"""
+        self._get_applicable_rules()
+        fact_id = self._lookup_fact_id(fact_name)
+        if fact_id is None:
+            return None
+        for visa_type, goal_name in zip(self.visa_types, self.goals):
+            goal = self._lookup_fact_id(goal_name)
+            if goal is None or self._known >> goal & 1:
+                continue
+            if self.knowledge_base.cone_mask(goal) >> fact_id & 1:
+                return visa_type
+        return None
+
+    def _find_question_for_goal(self, goal: int) -> Optional[int]:
+        """
+        指定されたゴールを達成するために必要な質問を探す（明示的なスタックによる深さ優先探索）
+
+        ゴールのフレームはルールを優先度順に（「わからない」条件を含まないルールを先に）試し、
+        ルールのフレームは条件を順にたどって、「わからない」と回答された導出可能な条件があれば
+        その事実をゴールとするフレームを積む。質問が見つかった時点で探索を終える。
+
+        訪問済みのゴールは探索全体で共有する印で管理し、ルールの探索が質問なしで終わったら、
+        そのルールの探索中に付けた印だけを取り消す（代替のルールごとに訪問済みの集合を
+        コピーしていた再帰版と同じ順序で質問を返す）。
+
+        展開したルール・条件の数（max_search_nodes）または経過時間（max_search_seconds）が
+        上限を超えたら、探索を打ち切って線形走査（_scan_question_for_goal）の結果を返す。
 
         Args:
-            goal: 達成したいゴール（結論）
-            visited: 循環参照を避けるための訪問済みゴールセット
+            goal: 達成したいゴール（結論）の事実ID
 
         Returns:
-            次に質問すべきfact_name、またはNone
+            次に質問すべき事実ID、またはNone
         """
-        if visited is None:
-            visited = set()
+        visited = bytearray(len(self.knowledge_base.fact_names))  # 訪問済みのゴールの印
+        marked: List[int] = []  # 印を付けたゴール（付けた順）
 
-        # 循環参照を避ける
-        if goal in visited:
-            return None
-        visited.add(goal)
+        question, rules = self._expand_goal(goal, visited, marked)
+        if not rules:
+            return question
+
+        max_nodes = self.max_search_nodes
+        deadline = time.perf_counter() + self.max_search_seconds if self.max_search_seconds > 0 else 0.0
+        nodes = 0
+
+        # フレーム: [ルールのフレームか, ルール（ゴール）または条件（ルール）の列, 次の位置, ルールの開始時の印の数]
+        stack = [[False, rules, 0, 0]]
+        while stack:
+            frame = stack[-1]
+            is_rule, items, position, mark = frame
+            if position == len(items):
+                stack.pop()
+                if is_rule:
+                    # このルールでは質問が見つからなかった：ルールの探索中に付けた印を取り消す
+                    while len(marked) > mark:
+                        visited[marked.pop()] = 0
+                continue
+            frame[2] = position + 1
+
+            nodes += 1
+            if (max_nodes > 0 and nodes > max_nodes) or (
+                deadline and nodes % _SEARCH_CLOCK_INTERVAL == 0 and time.perf_counter() > deadline
+            ):
+                # 探索の上限を超えた：近似の結果を返す（キャッシュしない）
+                self._search_truncated = True
+                return self._scan_question_for_goal(goal)
+
+            if not is_rule:
+                stack.append([True, items[position].conditions, 0, len(marked)])
+                continue
+
+            fact_id = items[position].fact_id
+
+            # 既に分かっている事実（「はい」「いいえ」で回答済み、確定）
+            if self._known >> fact_id & 1:
+                continue
+
+            # 「わからない」で不確実な事実として記録されている場合
+            if self._uncertain_known >> fact_id & 1:
+                # AND条件の場合はスキップ（他の条件も聞く必要がある）
+                # OR条件の場合は次の選択肢も聞く（確定した事実がないため）
+                continue
+
+            # 「わからない」で保留中（導出可能な質問の場合）→ 詳細質問に進む
+            if self._unknown >> fact_id & 1:
+                # この条件が導出可能なら、詳細な質問を探す
+                if self._get_rules_with_conclusion_id(fact_id):
+                    question, rules = self._expand_goal(fact_id, visited, marked)
+                    if question is not None:
+                        return question
+                    if rules:
+                        stack.append([False, rules, 0, 0])
+                # 導出できない場合は次の条件へ
+                continue
+
+            # この条件は他のルールで導出可能か？
+            if self._get_rules_with_conclusion_id(fact_id):
+                # 導出可能な質問（中間質問）は、まだ聞いていなければまず先に聞く
+                # ユーザーが「はい」と答えれば詳細質問をスキップできる（効率化）
+                # ユーザーが「わからない」と答えればunknown_factsに追加され、次回は詳細質問に進む
+                if not self._asked >> fact_id & 1:
+                    return fact_id
+
+                # 既に聞いた場合は、次の条件へ
+                # （「はい」「いいえ」で答えられていれば確定済みとしてスキップ済み）
+                # （「わからない」で答えられていればunknown_factsとして処理済み）
+                continue
+
+            # 導出不可能なので、直接質問する
+            return fact_id
+
+        # このゴールを達成するための質問が見つからない
+        return None
+
+    def _expand_goal(self, goal: int, visited: bytearray, marked: List[int]) -> Tuple[Optional[int], List[CompiledRule]]:
+        """
+        ゴールを訪問し、試すルールを求める（訪問済み・達成済み・導出不可能なら空）
+
+        Returns:
+            (直接質問する事実ID（高優先度の導出可能な質問）またはNone, 試すルールの列)
+        """
+        # 循環参照を避ける（知識ベースにない事実はルールがないので印は不要）
+        if goal < len(visited):
+            if visited[goal]:
+                return None, []
+            visited[goal] = 1
+            marked.append(goal)
 
         # 既にゴールが達成されている場合
-        if goal in self.facts:
-            return None
+        if self._known >> goal & 1:
+            return None, []
 
         # このゴールを達成するためのルールを取得（優先度順）
-        rules = self._get_rules_with_conclusion(goal)
+        rules = self._get_rules_with_conclusion_id(goal)
         if not rules:
             # このゴールを達成するルールがない（導出不可能）
-            return None
+            return None, []
 
         # 重要：このゴール自体が高優先度の質問かチェック
         # 導出可能でも、優先度が高ければ直接質問する
-        if goal not in self.asked_questions:
-            goal_priority = self._get_question_priority(goal)
+        if not self._asked >> goal & 1:
+            goal_priority = self._get_question_priority(self._fact_name(goal))
             if goal_priority >= 80:
                 # 高優先度の導出可能な質問は直接聞く
-                return goal
+                return goal, []
 
         # 代替パスを評価：未評価でないルールを優先
         available_rules = []
         uncertain_rules = []
+        inactive = self._fired | self._dead  # 発火済み・発火不可能なルール
 
         for rule in rules:
-            # 既にこのルールが発火している
-            if rule.rule_id in self.fired_rules:
-                continue
-
-            # このルールが発火不可能かチェック
-            if self._is_rule_impossible(rule):
+            # 既にこのルールが発火している、または発火不可能
+            if inactive >> rule.index & 1:
                 continue
 
             # このルールが「わからない」条件を含むかチェック
@@ -220,77 +912,52 @@ class InferenceEngine:
             else:
                 available_rules.append(rule)
 
-        # まず「わからない」条件を含まないルールを試す（代替パス）
-        for rule in available_rules:
-            question = self._find_question_for_rule(rule, visited.copy())
-            if question:
-                return question
-
-        # 代替パスがない場合、「わからない」条件を含むルールも試す
-        for rule in uncertain_rules:
-            question = self._find_question_for_rule(rule, visited.copy())
-            if question:
-                return question
+        # まず「わからない」条件を含まないルールを試し（代替パス）、なければ「わからない」条件を含むルールも試す
+        return None, available_rules + uncertain_rules
 
-        # このゴールを達成するための質問が見つからない
+    def _scan_question_for_goal(self, goal: int) -> Optional[int]:
+        """
+        探索の上限を超えた場合の近似：ゴールの生きているスライス（_live_rules）のルールを優先度順に1度だけ走査し、
+        結論が未確定のルールのうち最初の、未確定かつ未回答の条件を質問する（スライスのルール数に比例するコスト）
+        """
+        if self._known >> goal & 1:
+            return None
+        settled = self._known | self._uncertain_known | self._asked
+        for index in iter_bits(self._live_rules(goal)):
+            rule = self.all_rules[index]
+            if self._known >> rule.conclusion_id & 1:
+                continue
+            for condition in rule.conditions:
+                if not settled >> condition.fact_id & 1:
+                    return condition.fact_id
         return None
 
-    def _find_question_for_rule(self, rule: Rule, visited: Set[str]) -> Optional[str]:
+    def _live_rules(self, goal: int) -> int:
         """
-        指定されたルールを発火させるために必要な質問を探す
+        ゴールの判定にまだ影響しうるルールのビットセット（実行時に絞り込んだスライス）
 
-        Args:
-            rule: 評価するルール
-            visited: 循環参照を避けるための訪問済みゴールセット
-
-        Returns:
-            次に質問すべきfact_name、またはNone
+        コンパイル時のスライス（KnowledgeBase.cone_rule_mask）のうち、ゴールから未確定の事実をたどって
+        到達できる未発火・発火不可能でないルール。発火不可能になった分岐の先のルールは含まない
         """
-        for condition in rule.conditions:
-            fact_name = condition.fact_name
-
-            # 既に分かっている事実（「はい」「いいえ」で回答済み、確定）
-            if fact_name in self.facts:
+        inactive = self._fired | self._dead
+        if not self.knowledge_base.cone_rule_mask(goal) & ~inactive:
+            return 0
+
+        live = 0
+        reached = 1 << goal
+        pending = [goal]
+        while pending:
+            fact_id = pending.pop()
+            if self._known >> fact_id & 1:
                 continue
-
-            # 「わからない」で不確実な事実として記録されている場合
-            if fact_name in self.uncertain_facts:
-                # AND条件の場合はスキップ（他の条件も聞く必要がある）
-                if rule.operator == "AND":
+            for rule in self._get_rules_with_conclusion_id(fact_id):
+                if inactive >> rule.index & 1:
                     continue
-                # OR条件の場合は次の選択肢も聞く（確定した事実がないため）
-                # → continueせずに次のループへ
-                continue
-
-            # 「わからない」で保留中（導出可能な質問の場合）→ 詳細質問に進む
-            if fact_name in self.unknown_facts:
-                # この条件が導出可能なら、詳細な質問を探す
-                if self._is_derivable(fact_name):
-                    question = self._find_question_for_goal(fact_name, visited)
-                    if question:
-                        return question
-                # 導出できない場合は次の条件へ
-                continue
-
-            # この条件は他のルールで導出可能か？
-            if self._is_derivable(fact_name):
-                # 導出可能な質問（中間質問）は、まだ聞いていなければまず先に聞く
-                # ユーザーが「はい」と答えれば詳細質問をスキップできる（効率化）
-                # ユーザーが「わからない」と答えればunknown_factsに追加され、次回は詳細質問に進む
-                if fact_name not in self.asked_questions:
-                    return fact_name
-
-                # 既に聞いた場合は、次の条件へ
-                # （「はい」「いいえ」で答えられていればfactsに入っているのでline 253でスキップ済み）
-                # （「わからない」で答えられていればunknown_factsに入っているのでline 266-273で処理済み）
-                # ここに到達することはないはずだが、念のためcontinue
-                continue
-
-            # 導出不可能なので、直接質問する
-            return fact_name
-
-        # このルールの全条件が既知または導出不可能
-        return None
+                live |= 1 << rule.index
+                new = rule.condition_mask & ~reached
+                reached |= new
+                pending.extend(iter_bits(new))
+        return live
 
     def _is_derivable(self, fact_name: str) -> bool:
         """指定された事実が他のルールの結論として導出可能か"""
@@ -306,54 +973,57 @@ class InferenceEngine:
         Returns:
             優先度（数値が大きいほど優先度が高い）、デフォルトは0
         """
-        question = self.db.query(Question).filter(Question.fact_name == fact_name).first()
-        return question.priority if question else 0
+        return self.get_question_catalog().get_priority(fact_name)
 
-    def _has_unknown_conditions(self, rule: Rule) -> bool:
+    def get_question_catalog(self) -> QuestionCatalog:
+        """質問カタログを取得（指定がなければプロセス共有のカタログ）"""
+        if self.question_catalog is not None:
+            return self.question_catalog
+        return question_catalog_registry.get(self.db)
+
+    def _has_unknown_conditions(self, rule: CompiledRule) -> bool:
         """ルールが「わからない」と回答された条件を含むかチェック"""
-        for condition in rule.conditions:
-            if condition.fact_name in self.unknown_facts:
-                return True
-        return False
+        return self._unknown & rule.condition_mask != 0
 
-    def _is_rule_impossible(self, rule: Rule) -> bool:
+    def _is_rule_impossible(self, rule: CompiledRule) -> bool:
         """
         ルールが発火不可能か判定（ANDルールで1つでもFalse、ORルールで全てFalse）
         """
-        if rule.operator == "AND":
-            # ANDの場合、1つでも条件がFalseなら発火不可能
-            for condition in rule.conditions:
-                if condition.fact_name in self.facts:
-                    if self.facts[condition.fact_name] != condition.expected_value:
-                        return True
-            return False
-        else:  # OR
-            # ORの場合、全ての既知条件がFalseなら発火不可能
-            has_known_condition = False
-            for condition in rule.conditions:
-                if condition.fact_name in self.facts:
-                    has_known_condition = True
-                    if self.facts[condition.fact_name] == condition.expected_value:
-                        return False  # 1つでも満たされているので発火可能
-            # 全ての既知条件が不一致、かつ未知の条件がない場合のみ不可能
-            if has_known_condition:
-                # 未知の条件があるかチェック
-                has_unknown = any(c.fact_name not in self.facts for c in rule.conditions)
-                return not has_unknown
-            return False
+        if self._rete is not None:
+            return self._rete.dead >> rule.index & 1 == 1
+        return self._impossible[rule.index](self._known, self._values)
 
 
     def get_conclusions(self) -> List[str]:
         """Get final visa application conclusions only (not intermediate facts)"""
-        conclusions = []
-        for fact_name, value in self.facts.items():
-            if fact_name in self.derived_facts and value:
-                # Only return final conclusions (visa application results)
-                # These end with "ビザでの申請ができます" or "ビザの申請ができます"
-                if "申請ができます" in fact_name or "申請が可能です" in fact_name:
-                    conclusions.append(fact_name)
+        return [self._fact_name(fact_id) for fact_id in self._conclusion_ids()]
+
+    def get_conclusions_by_visa_type(self) -> Dict[str, List[str]]:
+        """結論をビザタイプごとに分類（結論を導出したルールのビザタイプで判定）"""
+        conclusions: Dict[str, List[str]] = {visa_type: [] for visa_type in self.visa_types}
+        for fact_id in self._conclusion_ids():
+            rules = [self.all_rules[index] for index in self._justifications.get(fact_id, ())]
+            rules = rules or self._get_rules_with_conclusion_id(fact_id)
+            for visa_type, visa_conclusions in conclusions.items():
+                if any(rule.visa_type == visa_type for rule in rules):
+                    visa_conclusions.append(self._fact_name(fact_id))
         return conclusions
 
+    def _conclusion_ids(self) -> List[int]:
+        """導出された最終結論の事実ID"""
+        conclusion_ids = []
+        for fact_id in iter_bits(self._known & self._values & self._derived):
+            fact_name = self._fact_name(fact_id)
+            # Only return final conclusions (visa application results)
+            # These end with "ビザでの申請ができます" or "ビザの申請ができます"
+            if "申請ができます" in fact_name or "申請が可能です" in fact_name:
+                conclusion_ids.append(fact_id)
+        return conclusion_ids
+
+    def is_goal_achieved(self) -> bool:
+        """いずれかのゴールが達成されたか"""
+        return any(self.facts.get(goal, False) for goal in self.goals)
+
     def is_consultation_finished(self) -> bool:
         """Check if consultation is finished (no more questions to ask)"""
         return self.get_next_question() is None
@@ -363,13 +1033,12 @@ class InferenceEngine:
         診断終了時に不確実な事実を確定させて最終判定
         uncertain_factsの内容をfactsに移してforward_chainを実行
         """
-        if not self.uncertain_facts:
+        if not self._uncertain_known:
             return
 
-        # uncertain_factsをfactsに移す
-        for fact_name, value in self.uncertain_facts.items():
-            if fact_name not in self.facts:  # 既に確定している場合は上書きしない
-                self.facts[fact_name] = value
+        # uncertain_factsをfactsに移す（既に確定している場合は上書きしない）
+        for fact_id in iter_bits(self._uncertain_known & ~self._known):
+            self._set_fact(fact_id, bool(self._uncertain_values >> fact_id & 1))
 
         # 最終的なforward_chainを実行
         self.forward_chain()
@@ -405,145 +1074,153 @@ class InferenceEngine:
                 ]
             }
         """
-        from app.models.models import Rule
+        # uncertain_factsを条件に持つルールを知識ベースの転置インデックスから集める（DBにはアクセスしない）
+        self._get_applicable_rules()
+        uncertain = self._uncertain_known
+        indices = set()
+        for fact_id in iter_bits(uncertain):
+            indices.update(self._rules_using(fact_id))
 
-        # uncertain_factsがどのルールに属しているか調査
         groups = []
         processed_rules = set()
 
-        for fact_name in self.uncertain_facts.keys():
-            # このfact_nameを条件として持つルールを探す
-            rules = self.db.query(Rule).filter(
-                Rule.visa_type == self.visa_type
-            ).all()
-
-            for rule in rules:
-                if rule.rule_id in processed_rules:
-                    continue
-
-                # このルールがuncertain_factsを条件として持っているか確認
-                uncertain_conditions = []
-                for condition in rule.conditions:
-                    if condition.fact_name in self.uncertain_facts:
-                        uncertain_conditions.append(condition.fact_name)
-
-                if uncertain_conditions:
-                    groups.append({
-                        "rule_id": rule.rule_id,
-                        "conclusion": rule.conclusion,
-                        "operator": rule.operator,
-                        "uncertain_conditions": uncertain_conditions
-                    })
-                    processed_rules.add(rule.rule_id)
-
-        return {"groups": groups}
-
-    def _can_derive_from_alternative(self, fact_name: str) -> bool:
-        """
-        指定された事実を代替パスで導出できるかチェック
-
-        Args:
-            fact_name: チェックする事実名
-
-        Returns:
-            代替パスで導出可能ならTrue
-        """
-        # この事実を結論とするルールがあるか
-        rules = self._get_rules_with_conclusion(fact_name)
-
-        for rule in rules:
-            # このルールが発火可能かチェック
-            if self._is_rule_impossible(rule):
+        # ルールの登録順（DBのid順）
+        for rule in sorted((self.all_rules[index] for index in indices), key=lambda rule: rule.id):
+            if rule.rule_id in processed_rules:
                 continue
 
-            # このルールが「わからない」条件を含まないかチェック
-            has_unknown = False
-            all_known = True
-
-            for condition in rule.conditions:
-                if condition.fact_name in self.unknown_facts:
-                    has_unknown = True
-                if condition.fact_name not in self.facts:
-                    all_known = False
-
-            # 「わからない」条件がなく、まだ未確定の条件があれば代替可能
-            if not has_unknown and not all_known:
-                return True
+            # このルールのuncertain_factsである条件
+            uncertain_conditions = [
+                condition.fact_name
+                for condition in rule.conditions
+                if uncertain >> condition.fact_id & 1
+            ]
+            groups.append({
+                "rule_id": rule.rule_id,
+                "conclusion": rule.conclusion,
+                "operator": rule.operator,
+                "uncertain_conditions": uncertain_conditions
+            })
+            processed_rules.add(rule.rule_id)
 
-        return False
+        return {"groups": groups}
 
     def get_rule_visualization(self) -> Dict:
         """
         推論過程の可視化用データを生成
         """
         rules = self._get_applicable_rules()
-        visualization_rules = []
+        return {
+            "rules": [self._visualize_rule(rule) for rule in rules],
+            "fired_rules": self.fired_rules,
+        }
 
-        for rule in rules:
-            conditions_viz = []
-            has_not_satisfied = False
-            has_satisfied = False
-            all_known = True
+    def get_rule_visualization_delta(self, rule_mask: int) -> List[Dict]:
+        """指定したルール（ルールindexのビットセット）のみの可視化用データ（index付き）"""
+        rules = self._get_applicable_rules()
+        return [{"index": index, **self._visualize_rule(rules[index])} for index in iter_bits(rule_mask)]
 
-            for condition in rule.conditions:
-                # Determine condition status
-                if condition.fact_name in self.facts:
-                    expected = condition.expected_value
-                    actual = self.facts[condition.fact_name]
-                    status = "satisfied" if actual == expected else "not_satisfied"
-
-                    if status == "satisfied":
-                        has_satisfied = True
-                    else:
-                        has_not_satisfied = True
-                elif condition.fact_name in self.unknown_facts:
-                    # 「わからない」と回答された条件
-                    status = "uncertain"
-                    all_known = False
-                else:
-                    status = "unknown"
-                    all_known = False
+    def get_changed_rules(self) -> int:
+        """
+        前回の呼び出し以降に可視化の表示が変わりうるルールのビットセットを返し、変更の記録をリセット
 
-                # Check if this condition is derivable
-                is_derivable = any(
-                    r.conclusion == condition.fact_name for r in rules
-                )
+        状態が変化した事実を条件または結論に持つルールと、発火状態が変化したルール
+        """
+        self._get_applicable_rules()
+        rule_masks_by_fact = self.knowledge_base.rule_masks_by_fact
+        changed = self._changed_rules
+        for fact_id in iter_bits(self._changed_facts):
+            if fact_id < len(rule_masks_by_fact):
+                changed |= rule_masks_by_fact[fact_id]
+        self._changed_facts = 0
+        self._changed_rules = 0
+        return changed
+
+    def get_rule_status_delta(self, rule_mask: int) -> List[list]:
+        """
+        指定したルールのコンパクトな状態（静的なルールグラフの index に対応）
 
-                conditions_viz.append({
+        Returns:
+            [index, フラグ（RULE_*）, 条件の状態のコードの文字列] のリスト
+        """
+        rules = self._get_applicable_rules()
+        result = []
+        for index in iter_bits(rule_mask):
+            statuses, flags = self._rule_status(rules[index])
+            result.append([index, flags, "".join(CONDITION_STATUS_CODES[status] for status in statuses)])
+        return result
+
+    def _visualize_rule(self, rule: CompiledRule) -> Dict:
+        """1つのルールの可視化用データ（条件の状態・発火状態）"""
+        statuses, flags = self._rule_status(rule)
+        derivable_mask = self.knowledge_base.derivable_mask
+        return {
+            "rule_id": rule.rule_id,
+            "conditions": [
+                {
                     "fact_name": condition.fact_name,
                     "status": status,
-                    "is_derivable": is_derivable,
-                })
-
-            # Check if conclusion is derived
-            conclusion_derived = rule.conclusion in self.facts and self.facts[rule.conclusion] == rule.conclusion_value
-
-            # Determine if rule is still fireable
-            is_fireable = True
-            if rule.operator == "AND":
-                # AND: 1つでもnot_satisfiedがあれば発火不可能
-                if has_not_satisfied:
-                    is_fireable = False
-            else:  # OR
-                # OR: 全ての既知の条件がnot_satisfiedで、かつ1つも満たされていない場合は発火不可能
-                if all_known and not has_satisfied:
-                    is_fireable = False
-
-            visualization_rules.append({
-                "rule_id": rule.rule_id,
-                "conditions": conditions_viz,
-                "operator": rule.operator,
-                "conclusion": rule.conclusion,
-                "conclusion_derived": conclusion_derived,
-                "is_fired": rule.rule_id in self.fired_rules,
-                "is_fireable": is_fireable,
-            })
-
-        return {
-            "rules": visualization_rules,
-            "fired_rules": self.fired_rules,
+                    # Check if this condition is derivable (precomputed in the knowledge base)
+                    "is_derivable": bool(derivable_mask >> condition.fact_id & 1),
+                }
+                for condition, status in zip(rule.conditions, statuses)
+            ],
+            "operator": rule.operator,
+            "conclusion": rule.conclusion,
+            "conclusion_derived": bool(flags & RULE_CONCLUSION_DERIVED),
+            "is_fired": bool(flags & RULE_FIRED),
+            "is_fireable": bool(flags & RULE_FIREABLE),
         }
 
+    def _rule_status(self, rule: CompiledRule) -> Tuple[List[str], int]:
+        """ルールの条件の状態と、ルールの状態のフラグ（結論の導出・発火済み・発火可能）"""
+        statuses = []
+        has_not_satisfied = False
+        has_satisfied = False
+        all_known = True
+
+        for condition in rule.conditions:
+            fact_id = condition.fact_id
+            # Determine condition status
+            if self._known >> fact_id & 1:
+                expected = condition.expected_value
+                actual = bool(self._values >> fact_id & 1)
+                status = "satisfied" if actual == expected else "not_satisfied"
+
+                if status == "satisfied":
+                    has_satisfied = True
+                else:
+                    has_not_satisfied = True
+            elif self._unknown >> fact_id & 1:
+                # 「わからない」と回答された条件
+                status = "uncertain"
+                all_known = False
+            else:
+                status = "unknown"
+                all_known = False
+            statuses.append(status)
+
+        # Determine if rule is still fireable
+        is_fireable = True
+        if rule.operator == "AND":
+            # AND: 1つでもnot_satisfiedがあれば発火不可能
+            if has_not_satisfied:
+                is_fireable = False
+        else:  # OR
+            # OR: 全ての既知の条件がnot_satisfiedで、かつ1つも満たされていない場合は発火不可能
+            if all_known and not has_satisfied:
+                is_fireable = False
+
+        flags = 0
+        # Check if conclusion is derived
+        if self._fact_value(rule.conclusion_id) == rule.conclusion_value:
+            flags |= RULE_CONCLUSION_DERIVED
+        if self._fired >> rule.index & 1:
+            flags |= RULE_FIRED
+        if is_fireable:
+            flags |= RULE_FIREABLE
+        return statuses, flags
+
     def save_snapshot(self) -> dict:
         """
         現在のエンジンの状態のスナップショットを保存
@@ -552,12 +1229,13 @@ class InferenceEngine:
             状態のスナップショット (dict)
         """
         return {
-            "facts": copy.deepcopy(self.facts),
-            "uncertain_facts": copy.deepcopy(self.uncertain_facts),
-            "derived_facts": copy.deepcopy(self.derived_facts),
-            "asked_questions": copy.deepcopy(self.asked_questions),
-            "fired_rules": copy.deepcopy(self.fired_rules),
-            "unknown_facts": copy.deepcopy(self.unknown_facts),
+            "facts": dict(self.facts),
+            "uncertain_facts": dict(self.uncertain_facts),
+            "derived_facts": set(self.derived_facts),
+            "asked_questions": set(self.asked_questions),
+            "fired_rules": list(self.fired_rules),
+            "unknown_facts": set(self.unknown_facts),
+            "overridden_facts": {self._fact_name(k): v for k, v in self._overridden.items()},
         }
 
     def restore_snapshot(self, snapshot: dict):
@@ -567,9 +1245,36 @@ class InferenceEngine:
         Args:
             snapshot: save_snapshot()で保存したスナップショット
         """
-        self.facts = copy.deepcopy(snapshot.get("facts", {}))
-        self.uncertain_facts = copy.deepcopy(snapshot.get("uncertain_facts", {}))
-        self.derived_facts = copy.deepcopy(snapshot.get("derived_facts", set()))
-        self.asked_questions = copy.deepcopy(snapshot.get("asked_questions", set()))
-        self.fired_rules = copy.deepcopy(snapshot.get("fired_rules", []))
-        self.unknown_facts = copy.deepcopy(snapshot.get("unknown_facts", set()))
+        self._get_applicable_rules()
+        self._known = self._values = 0
+        self._uncertain_known = self._uncertain_values = 0
+        for fact_name, value in snapshot.get("facts", {}).items():
+            fact_id = self._fact_id(fact_name)
+            self._known |= 1 << fact_id
+            if value:
+                self._values |= 1 << fact_id
+        for fact_name, value in snapshot.get("uncertain_facts", {}).items():
+            fact_id = self._fact_id(fact_name)
+            self._uncertain_known |= 1 << fact_id
+            if value:
+                self._uncertain_values |= 1 << fact_id
+        self._derived = self._mask_of(snapshot.get("derived_facts", ()))
+        self._asked = self._mask_of(snapshot.get("asked_questions", ()))
+        self._unknown = self._mask_of(snapshot.get("unknown_facts", ()))
+        self.fired_rules = list(snapshot.get("fired_rules", []))
+        self._overridden = {
+            self._fact_id(fact_name): value
+            for fact_name, value in snapshot.get("overridden_facts", {}).items()
+        }
+
+        self._trail = []  # スナップショット以前のステップには戻れない
+
+        # 復元した事実に合わせて発火済みルールとアジェンダを再構築
+        self._rebuild_rule_index()
+
+    def _mask_of(self, fact_names) -> int:
+        """fact_nameの集合をビットセットに変換"""
+        mask = 0
+        for fact_name in fact_names:
+            mask |= 1 << self._fact_id(fact_name)
+        return mask
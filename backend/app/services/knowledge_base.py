@@ -0,0 +1,377 @@
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+from sqlalchemy.orm import Session, joinedload
+from app.models.models import Rule
+from app.services.fact_state import iter_bits
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import weakref
+
+
+# 全ビザモードで診断するビザタイプ（質問が登録されているもののみ）
+ALL_VISA_TYPES = ["E", "L", "B"]
+# 診断できるビザタイプ（API で受け付ける値。知識ベース・テンプレートのレジストリのキーになる）
+VISA_TYPES = ALL_VISA_TYPES + ["ALL"]
+
+# 知識ベースの再検証間隔（秒）。他のワーカーでの管理画面の編集を取り込むため
+KNOWLEDGE_BASE_TTL_SECONDS = float(os.getenv("KNOWLEDGE_BASE_TTL_SECONDS", "300"))
+
+# 状態のフィンガープリント（Zobristハッシュ）の事実の状態の種類
+ZOBRIST_TRUE = 0
+ZOBRIST_FALSE = 1
+ZOBRIST_UNCERTAIN = 2
+ZOBRIST_UNKNOWN = 3
+ZOBRIST_ASKED = 4
+_ZOBRIST_FACT_STATES = 5
+_ZOBRIST_BITS = 128
+
+
+class CompiledCondition:
+    """コンパイル済みの条件（ORMから切り離した読み取り専用の構造）"""
+
+    __slots__ = ("fact_name", "expected_value", "fact_id")
+
+    def __init__(self, fact_name: str, expected_value: bool):
+        self.fact_name = fact_name
+        self.expected_value = expected_value
+        self.fact_id = -1  # Assigned by KnowledgeBase
+
+
+class CompiledRule:
+    """コンパイル済みのルール（ORMから切り離した読み取り専用の構造）"""
+
+    __slots__ = (
+        "id",
+        "rule_id",
+        "visa_type",
+        "conclusion",
+        "conclusion_value",
+        "operator",
+        "priority",
+        "conditions",
+        "index",
+        "conclusion_id",
+        "condition_mask",
+        "expected_mask",
+        "depth",
+        "position",
+    )
+
+    def __init__(self, rule: Rule):
+        self.id = rule.id
+        self.rule_id = rule.rule_id
+        self.visa_type = rule.visa_type
+        self.conclusion = rule.conclusion
+        self.conclusion_value = rule.conclusion_value
+        self.operator = rule.operator
+        self.priority = rule.priority
+        self.conditions: Tuple[CompiledCondition, ...] = tuple(
+            CompiledCondition(c.fact_name, c.expected_value)
+            for c in sorted(rule.conditions, key=lambda c: c.id)
+        )
+        # 以下は KnowledgeBase が設定する（知識ベース内の位置と事実IDのビットマスク）
+        self.index = -1
+        self.conclusion_id = -1
+        self.condition_mask = 0  # 条件の事実のビット
+        self.expected_mask = 0  # 期待値が True の条件の事実のビット
+        self.depth = -1  # 依存の深さ（条件を導出するルールの最大の深さ+1、循環がある場合は-1）
+        self.position = -1  # 前向き推論での評価順序
+
+
+class KnowledgeBase:
+    """
+    ビザタイプごとのコンパイル済み知識ベース（"ALL" は全ビザタイプのルールの和集合）
+
+    プロセス全体で共有され、全ての InferenceEngine から読み取り専用で参照される。
+    全ての fact_name は出現順に連番の整数ID（事実ID）に変換され、
+    エンジンの状態は事実IDのビットセットとして保持される。
+    """
+
+    __slots__ = (
+        "visa_type",
+        "version",
+        "rules",
+        "rule_indices",
+        "fact_names",
+        "fact_ids",
+        "rules_by_conclusion",
+        "rules_by_conclusion_id",
+        "rules_by_fact",
+        "rule_masks_by_fact",
+        "derivable_mask",
+        "is_acyclic",
+        "evaluation_order",
+        "zobrist_fact_keys",
+        "zobrist_rule_keys",
+        "_cones",
+        "_cone_rules",
+        "_graph_json",
+        "__weakref__",
+    )
+
+    def __init__(self, visa_type: str, rules: List[CompiledRule]):
+        self.visa_type = visa_type
+        self.rules: Tuple[CompiledRule, ...] = tuple(rules)
+        self.rule_indices: Mapping[str, int] = MappingProxyType(
+            {rule.rule_id: index for index, rule in reversed(list(enumerate(self.rules)))}
+        )
+
+        # fact_name -> 事実ID（ルールの順序で結論・条件の出現順に採番するので決定的）
+        fact_ids: Dict[str, int] = {}
+        for index, rule in enumerate(self.rules):
+            rule.index = index
+            rule.conclusion_id = fact_ids.setdefault(rule.conclusion, len(fact_ids))
+            for condition in rule.conditions:
+                condition.fact_id = fact_ids.setdefault(condition.fact_name, len(fact_ids))
+                rule.condition_mask |= 1 << condition.fact_id
+                if condition.expected_value:
+                    rule.expected_mask |= 1 << condition.fact_id
+        self.fact_ids: Mapping[str, int] = MappingProxyType(fact_ids)
+        self.fact_names: Tuple[str, ...] = tuple(fact_ids)
+
+        # conclusion -> rules（優先度順）
+        rules_by_conclusion: Dict[str, List[CompiledRule]] = {}
+        for rule in self.rules:
+            rules_by_conclusion.setdefault(rule.conclusion, []).append(rule)
+        self.rules_by_conclusion: Mapping[str, Tuple[CompiledRule, ...]] = MappingProxyType(
+            {conclusion: tuple(rs) for conclusion, rs in rules_by_conclusion.items()}
+        )
+        # 事実ID -> その事実を結論とするルール（優先度順）
+        self.rules_by_conclusion_id: Tuple[Tuple[CompiledRule, ...], ...] = tuple(
+            self.rules_by_conclusion.get(fact_name, ()) for fact_name in self.fact_names
+        )
+
+        # 事実ID -> その事実を条件に持つルールのindex（前向き推論用の転置インデックス）
+        rules_by_fact: List[List[int]] = [[] for _ in self.fact_names]
+        for index, rule in enumerate(self.rules):
+            for condition in rule.conditions:
+                if not rules_by_fact[condition.fact_id] or rules_by_fact[condition.fact_id][-1] != index:
+                    rules_by_fact[condition.fact_id].append(index)
+        self.rules_by_fact: Tuple[Tuple[int, ...], ...] = tuple(tuple(indices) for indices in rules_by_fact)
+
+        # 事実ID -> その事実を条件または結論に持つルールのビットセット（可視化の差分用）
+        self.rule_masks_by_fact: Tuple[int, ...] = tuple(
+            sum(1 << index for index in set(rules_by_fact[fact_id]) | {r.index for r in self.rules_by_conclusion_id[fact_id]})
+            for fact_id in range(len(self.fact_names))
+        )
+        # ルールで導出可能な事実（いずれかのルールの結論）のビットセット
+        self.derivable_mask = sum(1 << fact_id for fact_id, rs in enumerate(self.rules_by_conclusion_id) if rs)
+
+        # 前向き推論の評価順序：依存の深さ順（同じ深さなら優先度順）に並べると、
+        # 条件を導出するルールが必ず先に評価されるので1パスで済む。
+        # 循環がある場合は優先度順のまま（固定点まで繰り返し評価する）
+        depths = self._compute_rule_depths()
+        self.is_acyclic = depths is not None
+        if depths is not None:
+            order = sorted(range(len(self.rules)), key=lambda index: (depths[index], index))
+        else:
+            order = list(range(len(self.rules)))
+        for position, index in enumerate(order):
+            rule = self.rules[index]
+            rule.position = position
+            rule.depth = depths[index] if depths is not None else -1
+        self.evaluation_order: Tuple[CompiledRule, ...] = tuple(self.rules[index] for index in order)
+
+        self.version = self._compute_version()
+
+        # Zobristハッシュのキー：状態の種類 -> 事実ID -> 乱数、ルールindex -> 乱数（発火済み）
+        # バージョンから決定的に生成するので、同じ知識ベースならプロセスをまたいで同じ値になる
+        rng = random.Random(self.version)
+        self.zobrist_fact_keys: Tuple[Tuple[int, ...], ...] = tuple(
+            tuple(rng.getrandbits(_ZOBRIST_BITS) for _ in self.fact_names)
+            for _ in range(_ZOBRIST_FACT_STATES)
+        )
+        self.zobrist_rule_keys: Tuple[int, ...] = tuple(rng.getrandbits(_ZOBRIST_BITS) for _ in self.rules)
+
+        self._cones: Dict[int, int] = {}  # 事実ID -> 後向きの到達範囲（初回の参照時に計算）
+        self._cone_rules: Dict[int, int] = {}  # 事実ID -> 到達範囲の事実を結論とするルール（初回の参照時に計算）
+        self._graph_json: Optional[bytes] = None
+
+    def cone_mask(self, fact_id: int) -> int:
+        """
+        事実の導出に関わりうる全ての事実（その事実自身と、その事実を結論とするルールの条件を
+        再帰的にたどったもの）のビットセット
+
+        ゴールの事実IDを渡すと、そのゴールの診断で質問される可能性のある事実の範囲になる。
+        """
+        cone = self._cones.get(fact_id)
+        if cone is None:
+            cone = 1 << fact_id
+            stack = [fact_id]
+            while stack:
+                current = stack.pop()
+                for rule in self.rules_by_conclusion_id[current] if current < len(self.fact_names) else ():
+                    new = rule.condition_mask & ~cone
+                    cone |= new
+                    stack.extend(iter_bits(new))
+            self._cones[fact_id] = cone
+        return cone
+
+    def cone_rule_mask(self, fact_id: int) -> int:
+        """
+        事実の導出に関わりうる全てのルール（cone_mask の事実を結論とするルール）のビットセット
+
+        ゴールの事実IDを渡すと、そのゴールの判定に影響しうるルールだけに絞ったルールグラフのスライスになる。
+        """
+        rule_mask = self._cone_rules.get(fact_id)
+        if rule_mask is None:
+            rule_mask = 0
+            for conclusion_id in iter_bits(self.cone_mask(fact_id)):
+                if conclusion_id < len(self.fact_names):
+                    for rule in self.rules_by_conclusion_id[conclusion_id]:
+                        rule_mask |= 1 << rule.index
+            self._cone_rules[fact_id] = rule_mask
+        return rule_mask
+
+    def graph_json(self) -> bytes:
+        """
+        ルールグラフ（ルールの構造のみで、診断の状態を含まない）のJSON
+
+        可視化のコンパクトな状態配列は、このルールの順序（index）と条件の順序に対応する。
+        内容はバージョンごとに不変なので、初回に1度だけ生成する。
+        """
+        if self._graph_json is None:
+            graph = {
+                "visa_type": self.visa_type,
+                "version": self.version,
+                "rules": [
+                    {
+                        "rule_id": rule.rule_id,
+                        "operator": rule.operator,
+                        "conclusion": rule.conclusion,
+                        "conditions": [
+                            {
+                                "fact_name": condition.fact_name,
+                                "is_derivable": bool(self.derivable_mask >> condition.fact_id & 1),
+                            }
+                            for condition in rule.conditions
+                        ],
+                    }
+                    for rule in self.rules
+                ],
+            }
+            self._graph_json = json.dumps(graph, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return self._graph_json
+
+    def _dependencies(self, index: int) -> List[int]:
+        """ルールの条件の事実を結論とするルールのindex"""
+        return [
+            dependency.index
+            for condition in self.rules[index].conditions
+            for dependency in self.rules_by_conclusion_id[condition.fact_id]
+        ]
+
+    def _compute_rule_depths(self) -> Optional[List[int]]:
+        """
+        各ルールの依存の深さを計算（条件がどのルールからも導出されなければ0）
+
+        Returns:
+            ルールindex -> 深さ。ルールの依存関係に循環がある場合はNone
+        """
+        depths: List[Optional[int]] = [None] * len(self.rules)
+        in_progress = [False] * len(self.rules)
+
+        for root in range(len(self.rules)):
+            if depths[root] is not None:
+                continue
+            in_progress[root] = True
+            stack = [(root, iter(self._dependencies(root)))]
+            while stack:
+                index, dependencies = stack[-1]
+                for dependency in dependencies:
+                    if depths[dependency] is None:
+                        if in_progress[dependency]:
+                            return None  # 循環参照
+                        in_progress[dependency] = True
+                        stack.append((dependency, iter(self._dependencies(dependency))))
+                        break
+                else:
+                    stack.pop()
+                    in_progress[index] = False
+                    depths[index] = 1 + max((depths[d] for d in self._dependencies(index)), default=-1)
+        return depths
+
+    def _compute_version(self) -> str:
+        """ルールの内容から知識ベースのバージョン（ハッシュ）を計算"""
+        content = [
+            [
+                rule.rule_id,
+                rule.conclusion,
+                rule.conclusion_value,
+                rule.operator,
+                rule.priority,
+                [[c.fact_name, c.expected_value] for c in rule.conditions],
+            ]
+            for rule in self.rules
+        ]
+        payload = json.dumps([self.visa_type, content], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def compile_knowledge_base(db: Session, visa_type: str) -> KnowledgeBase:
+    """DBからルールを読み込み、知識ベースをコンパイル（"ALL" は全ビザタイプのルールをまとめる）"""
+    visa_filter = Rule.visa_type.in_(ALL_VISA_TYPES) if visa_type == "ALL" else Rule.visa_type == visa_type
+    rules = (
+        db.query(Rule)
+        .options(joinedload(Rule.conditions))  # Eager load conditions
+        .filter(visa_filter)
+        .order_by(Rule.priority.desc(), Rule.id)
+        .all()
+    )
+    return KnowledgeBase(visa_type, [CompiledRule(rule) for rule in rules])
+
+
+class KnowledgeBaseRegistry:
+    """コンパイル済み知識ベースのプロセス全体のレジストリ（visa_type, version で管理）"""
+
+    def __init__(self, ttl_seconds: float = KNOWLEDGE_BASE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._current: Dict[str, Tuple[KnowledgeBase, float]] = {}  # visa_type -> (KB, loaded_at)
+        self._by_version: "weakref.WeakValueDictionary[Tuple[str, str], KnowledgeBase]" = (
+            weakref.WeakValueDictionary()
+        )
+
+    def get(self, db: Session, visa_type: str) -> KnowledgeBase:
+        """現在の知識ベースを取得（未コンパイルまたは期限切れの場合のみDBから読み込む）"""
+        entry = self._current.get(visa_type)
+        if entry is not None and not self._is_expired(entry[1]):
+            return entry[0]
+
+        with self._lock:
+            entry = self._current.get(visa_type)
+            if entry is not None and not self._is_expired(entry[1]):
+                return entry[0]
+
+            kb = compile_knowledge_base(db, visa_type)
+            # 内容が変わっていなければ既存のインスタンスを再利用
+            existing = self._by_version.get((visa_type, kb.version))
+            if existing is not None:
+                kb = existing
+            else:
+                self._by_version[(visa_type, kb.version)] = kb
+            self._current[visa_type] = (kb, time.monotonic())
+            return kb
+
+    def get_version(self, visa_type: str, version: str) -> Optional[KnowledgeBase]:
+        """指定バージョンの知識ベースを取得（使用中のセッションがあるもののみ保持）"""
+        return self._by_version.get((visa_type, version))
+
+    def invalidate(self, visa_type: Optional[str] = None):
+        """知識ベースを無効化（ルール編集時に呼び出す）"""
+        with self._lock:
+            if visa_type is None:
+                self._current.clear()
+            else:
+                self._current.pop(visa_type, None)
+
+    def _is_expired(self, loaded_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.monotonic() - loaded_at > self.ttl_seconds
+
+
+# Global registry (shared by all engines in this process)
+knowledge_base_registry = KnowledgeBaseRegistry()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+import os
+import threading
+
+
+# 次の質問のキャッシュの最大件数（0で無効）
+NEXT_QUESTION_CACHE_SIZE = int(os.getenv("NEXT_QUESTION_CACHE_SIZE", "10000"))
+
+_MISSING = object()
+
+
+class NextQuestionCache:
+    """
+    次の質問のプロセス全体のキャッシュ（LRU）
+
+    キーは (visa_type, 知識ベースのバージョン, 質問カタログのバージョン, 状態のフィンガープリント)、
+    値は次に質問すべきfact_name（診断終了ならNone）。
+    同じ回答をたどったセッションは、後向き推論の探索をせずに辞書の参照で次の質問が得られる。
+    """
+
+    def __init__(self, max_size: int = NEXT_QUESTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Optional[str]]" = OrderedDict()
+
+    def get(self, key: Hashable, default=_MISSING):
+        """キャッシュされた次の質問を取得（なければ default）"""
+        if self.max_size <= 0:
+            return default
+        with self._lock:
+            question = self._entries.get(key, _MISSING)
+            if question is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return question
+
+    def put(self, key: Hashable, question: Optional[str]):
+        """次の質問をキャッシュ（上限を超えたら最も古いものから追い出す）"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = question
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Global cache (shared by all sessions in this process)
+next_question_cache = NextQuestionCache()
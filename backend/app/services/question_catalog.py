@@ -0,0 +1,115 @@
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+from sqlalchemy.orm import Session
+from app.models.models import Question
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+# 質問カタログの再検証間隔（秒）。他のワーカーでの管理画面の編集を取り込むため
+QUESTION_CATALOG_TTL_SECONDS = float(os.getenv("QUESTION_CATALOG_TTL_SECONDS", "300"))
+
+
+class QuestionEntry:
+    """質問マスタの1件（ORMから切り離した読み取り専用の構造）"""
+
+    __slots__ = ("fact_name", "question_text", "visa_type", "priority")
+
+    def __init__(self, fact_name: str, question_text: str, visa_type: Optional[str], priority: int):
+        self.fact_name = fact_name
+        self.question_text = question_text
+        self.visa_type = visa_type
+        self.priority = priority
+
+
+class QuestionCatalog:
+    """
+    質問マスタのインメモリカタログ
+
+    fact_name -> (question_text, priority, visa_type) と question_text -> fact_name を保持する。
+    """
+
+    __slots__ = ("version", "by_fact_name", "fact_name_by_text")
+
+    def __init__(self, entries: List[QuestionEntry]):
+        by_fact_name: Dict[str, QuestionEntry] = {}
+        fact_name_by_text: Dict[str, str] = {}
+        for entry in entries:
+            by_fact_name.setdefault(entry.fact_name, entry)
+            # 同じ質問文が複数ある場合は最初のもの（id順）を使う
+            fact_name_by_text.setdefault(entry.question_text, entry.fact_name)
+
+        self.by_fact_name: Mapping[str, QuestionEntry] = MappingProxyType(by_fact_name)
+        self.fact_name_by_text: Mapping[str, str] = MappingProxyType(fact_name_by_text)
+        self.version = self._compute_version(entries)
+
+    def get_question_text(self, fact_name: str) -> str:
+        """fact_nameから質問文を取得（質問が未定義ならfact_nameをそのまま返す）"""
+        entry = self.by_fact_name.get(fact_name)
+        return entry.question_text if entry else fact_name
+
+    def get_fact_name(self, question_text: str) -> str:
+        """質問文からfact_nameを取得（質問が未定義なら質問文をそのまま返す）"""
+        return self.fact_name_by_text.get(question_text, question_text)
+
+    def get_priority(self, fact_name: str) -> int:
+        """質問の優先度を取得（質問が未定義なら0）"""
+        entry = self.by_fact_name.get(fact_name)
+        return entry.priority if entry else 0
+
+    @staticmethod
+    def _compute_version(entries: List[QuestionEntry]) -> str:
+        """質問マスタの内容からカタログのバージョン（ハッシュ）を計算"""
+        content = [[e.fact_name, e.question_text, e.visa_type, e.priority] for e in entries]
+        payload = json.dumps(content, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_question_catalog(db: Session) -> QuestionCatalog:
+    """DBから質問マスタを読み込み、カタログを作成"""
+    questions = db.query(Question).order_by(Question.id).all()
+    return QuestionCatalog(
+        [
+            QuestionEntry(q.fact_name, q.question_text, q.visa_type, q.priority or 0)
+            for q in questions
+        ]
+    )
+
+
+class QuestionCatalogRegistry:
+    """質問カタログのプロセス全体のレジストリ"""
+
+    def __init__(self, ttl_seconds: float = QUESTION_CATALOG_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._current: Optional[Tuple[QuestionCatalog, float]] = None  # (catalog, loaded_at)
+
+    def get(self, db: Session) -> QuestionCatalog:
+        """現在のカタログを取得（未読み込みまたは期限切れの場合のみDBから読み込む）"""
+        entry = self._current
+        if entry is not None and not self._is_expired(entry[1]):
+            return entry[0]
+
+        with self._lock:
+            entry = self._current
+            if entry is not None and not self._is_expired(entry[1]):
+                return entry[0]
+
+            catalog = load_question_catalog(db)
+            self._current = (catalog, time.monotonic())
+            return catalog
+
+    def invalidate(self):
+        """カタログを無効化（質問編集時に呼び出す）"""
+        with self._lock:
+            self._current = None
+
+    def _is_expired(self, loaded_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.monotonic() - loaded_at > self.ttl_seconds
+
+
+# Global registry (shared by all engines in this process)
+question_catalog_registry = QuestionCatalogRegistry()
@@ -0,0 +1,237 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+from app.services.fact_state import iter_bits
+from app.services.knowledge_base import KnowledgeBase
+import sys
+import threading
+import weakref
+
+
+# 事実・条件・ノードの状態（事実: 未確定/True/False、条件とノード: 未確定/満たされた/不一致）
+OPEN = 0
+SATISFIED = 1
+MISMATCHED = 2
+FACT_TRUE = 1
+FACT_FALSE = 2
+
+# (変化前, 変化後) の状態 -> 入力先のノードの (満たされた入力数, 不一致の入力数) の増分
+_DELTAS = {
+    (old, new): ((new == SATISFIED) - (old == SATISFIED), (new == MISMATCHED) - (old == MISMATCHED))
+    for old in (OPEN, SATISFIED, MISMATCHED)
+    for new in (OPEN, SATISFIED, MISMATCHED)
+}
+
+
+class ReteNetwork:
+    """
+    知識ベースから作る条件の共有ネットワーク（Rete/TREAT方式、知識ベースごとに1つ、不変）
+
+    事実は真偽値だけなので、ネットワークは変数の結合を持たない:
+    - アルファノード: 事実ごとの (条件のノード, 期待値) のリスト
+    - ノード: 同じ演算子（AND/OR）のルールが共有する条件の集合。入力（条件と親のノード）のうち
+      満たされた数・不一致の数を数え、AND/OR の3値（満たされた/不一致/未確定）の状態を持つ
+
+    ルールの条件を全体で多く使われる順に並べたトライを作り、分岐しない区間を1つのノードにまとめる。
+    共通の条件を持つルールはトライの接頭辞のノードを共有し、その条件の変化はノードの状態が変わったときだけ子に伝わる。
+    AND/OR は結合的なので、ノードの状態（満たされた・不一致）はルールの条件の評価（_conditions_hold・_is_rule_impossible）と一致する。
+    """
+
+    __slots__ = (
+        "fact_count",
+        "node_is_and",
+        "node_inputs",
+        "node_children",
+        "node_rules",
+        "node_rule_masks",
+        "alpha",
+        "always_holds",
+        "__weakref__",
+    )
+
+    def __init__(self, knowledge_base: KnowledgeBase):
+        self.fact_count = len(knowledge_base.fact_names)
+        self.node_is_and: List[bool] = []
+        self.node_inputs: List[int] = []
+        node_children: List[List[int]] = []
+        node_rules: List[List[int]] = []
+        alpha: List[List[Tuple[int, bool]]] = [[] for _ in range(self.fact_count)]
+
+        # 条件（事実ID, 期待値）の出現回数。多く使われる条件をトライの根に近くする
+        literals_by_rule = []
+        frequency: Counter = Counter()
+        for rule in knowledge_base.rules:
+            literals = [(fact_id, bool(rule.expected_mask >> fact_id & 1)) for fact_id in iter_bits(rule.condition_mask)]
+            literals_by_rule.append(literals)
+            frequency.update(literals)
+
+        # 演算子ごとのトライ（ノード: [子の辞書, 終端のルール]）
+        roots: Dict[bool, list] = {True: [{}, []], False: [{}, []]}
+        for rule, literals in zip(knowledge_base.rules, literals_by_rule):
+            literals.sort(key=lambda literal: (-frequency[literal], literal))
+            trie = roots[rule.operator != "OR"]
+            for literal in literals:
+                trie = trie[0].setdefault(literal, [{}, []])
+            trie[1].append(rule.index)
+
+        for is_and, root in roots.items():
+            if root[1]:
+                # 条件のないルール（AND は常に満たされ、OR は満たされない）
+                self._add_node(is_and, [], None, root[1], alpha, node_children, node_rules)
+            # 分岐する・ルールが終端するトライのノードだけをネットワークのノードにする
+            stack = [(root, None, [])]
+            while stack:
+                trie, parent, pending = stack.pop()
+                for literal, child in trie[0].items():
+                    literals = pending + [literal]
+                    if child[1] or len(child[0]) != 1:
+                        node = self._add_node(is_and, literals, parent, child[1], alpha, node_children, node_rules)
+                        stack.append((child, node, []))
+                    else:
+                        stack.append((child, parent, literals))
+
+        self.node_children = tuple(tuple(children) for children in node_children)
+        self.node_rules = tuple(tuple(rules) for rules in node_rules)
+        self.node_rule_masks = tuple(sum(1 << index for index in rules) for rules in node_rules)
+        self.alpha = tuple(tuple(entries) for entries in alpha)
+        self.always_holds = sum(
+            mask for is_and, inputs, mask in zip(self.node_is_and, self.node_inputs, self.node_rule_masks) if is_and and not inputs
+        )
+
+    def _add_node(self, is_and, literals, parent, rules, alpha, node_children, node_rules) -> int:
+        node = len(self.node_is_and)
+        self.node_is_and.append(is_and)
+        self.node_inputs.append(len(literals) + (parent is not None))
+        node_children.append([])
+        node_rules.append(list(rules))
+        if parent is not None:
+            node_children[parent].append(node)
+        for fact_id, expected in literals:
+            alpha[fact_id].append((node, expected))
+        return node
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_is_and)
+
+    def condition_evaluations(self) -> int:
+        """ネットワーク全体の条件の入力数（共有しない場合はルールの条件の総数）"""
+        return sum(self.node_inputs)
+
+
+class ReteMatcher:
+    """
+    エンジンごとのネットワークの状態（ノードごとの入力の数え上げと、ルールの満たされた・発火不可能のビット）
+
+    事実の変化ごとに update() で差分を伝える。状態は事実だけから決まるので、アンドゥは事実の変更を戻す
+    _set_fact/_unset_fact を通じて同じ差分で戻り、トレイルには記録しない。
+    """
+
+    __slots__ = ("network", "satisfied", "mismatched", "holds", "dead")
+
+    def __init__(self, network: ReteNetwork):
+        self.network = network
+        self.reset(0, 0)
+
+    def reset(self, known: int, values: int):
+        """事実のビットセットから状態を作り直す"""
+        count = self.network.node_count
+        self.satisfied = [0] * count
+        self.mismatched = [0] * count
+        self.holds = self.network.always_holds  # 条件が満たされているルール
+        self.dead = 0  # 発火不可能なルール
+        for fact_id in iter_bits(known):
+            self.update(fact_id, OPEN, FACT_TRUE if values >> fact_id & 1 else FACT_FALSE)
+
+    def copy(self) -> "ReteMatcher":
+        matcher = object.__new__(ReteMatcher)
+        matcher.network = self.network
+        matcher.satisfied = list(self.satisfied)
+        matcher.mismatched = list(self.mismatched)
+        matcher.holds = self.holds
+        matcher.dead = self.dead
+        return matcher
+
+    def update(self, fact_id: int, old: int, new: int) -> List[int]:
+        """
+        事実の状態の変化（OPEN/FACT_TRUE/FACT_FALSE）をネットワークに伝える
+
+        Returns:
+            新たに条件が満たされたルールのindex
+        """
+        network = self.network
+        newly: List[int] = []
+        if fact_id >= network.fact_count or old == new:
+            return newly
+
+        # 期待値 True の条件は事実の状態がそのまま条件の状態、False の条件は満たされた・不一致が逆になる
+        when_true = _DELTAS[old, new]
+        when_false = _DELTAS[_swap(old), _swap(new)]
+        stack = [(node, when_true if expected else when_false) for node, expected in network.alpha[fact_id]]
+
+        satisfied, mismatched = self.satisfied, self.mismatched
+        is_and, inputs, children = network.node_is_and, network.node_inputs, network.node_children
+        while stack:
+            node, (satisfied_delta, mismatched_delta) = stack.pop()
+            count = inputs[node]
+            before_satisfied, before_mismatched = satisfied[node], mismatched[node]
+            after_satisfied = satisfied[node] = before_satisfied + satisfied_delta
+            after_mismatched = mismatched[node] = before_mismatched + mismatched_delta
+            if is_and[node]:
+                before = SATISFIED if before_satisfied == count else MISMATCHED if before_mismatched else OPEN
+                after = SATISFIED if after_satisfied == count else MISMATCHED if after_mismatched else OPEN
+            else:
+                before = SATISFIED if before_satisfied else MISMATCHED if before_mismatched == count else OPEN
+                after = SATISFIED if after_satisfied else MISMATCHED if after_mismatched == count else OPEN
+            if before == after:
+                continue
+
+            rule_mask = network.node_rule_masks[node]
+            if rule_mask:
+                if after == SATISFIED:
+                    self.holds |= rule_mask
+                    newly.extend(network.node_rules[node])
+                elif before == SATISFIED:
+                    self.holds &= ~rule_mask
+                if after == MISMATCHED:
+                    self.dead |= rule_mask
+                elif before == MISMATCHED:
+                    self.dead &= ~rule_mask
+            delta = _DELTAS[before, after]
+            for child in children[node]:
+                stack.append((child, delta))
+        return newly
+
+    def estimate_memory(self) -> int:
+        return sys.getsizeof(self.satisfied) + sys.getsizeof(self.mismatched) + sys.getsizeof(self.holds) + sys.getsizeof(self.dead)
+
+
+def _swap(state: int) -> int:
+    """期待値 False の条件の状態（事実が True なら不一致、False なら満たされた）"""
+    return MISMATCHED if state == FACT_TRUE else SATISFIED if state == FACT_FALSE else OPEN
+
+
+class ReteNetworkRegistry:
+    """知識ベースごとのネットワークのプロセス全体のレジストリ（知識ベースが使われなくなれば破棄される）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._networks: "weakref.WeakKeyDictionary[KnowledgeBase, ReteNetwork]" = weakref.WeakKeyDictionary()
+
+    def get(self, knowledge_base: KnowledgeBase) -> ReteNetwork:
+        network = self._networks.get(knowledge_base)
+        if network is not None:
+            return network
+        with self._lock:
+            network = self._networks.get(knowledge_base)
+            if network is None:
+                network = ReteNetwork(knowledge_base)
+                self._networks[knowledge_base] = network
+            return network
+
+    def clear(self):
+        with self._lock:
+            self._networks = weakref.WeakKeyDictionary()
+
+
+# Global registry (shared by all engines in this process)
+rete_network_registry = ReteNetworkRegistry()
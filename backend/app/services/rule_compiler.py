@@ -0,0 +1,233 @@
+from typing import Callable, Optional, Tuple
+from app.services.knowledge_base import CompiledRule, KnowledgeBase
+import hashlib
+import importlib.util
+import logging
+import marshal
+import os
+import stat
+import tempfile
+import threading
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+# ルールの評価関数の方式（"interpreted": 汎用の評価、"compiled": 知識ベースごとに生成したコード。生成は明示的に有効にする）
+RULE_EVALUATORS = os.getenv("RULE_EVALUATORS", "interpreted")
+# 生成したコードのコンパイル結果を保存するディレクトリ（未設定・空ならディスクに保存しない）。
+# 読み込んだコードは実行されるので、このプロセスのユーザーだけが書き込める専用のディレクトリを指定する
+RULE_EVALUATOR_CACHE_DIR = os.getenv("RULE_EVALUATOR_CACHE_DIR") or None
+
+# ルールの評価関数: (確定した事実のビットセット, 値のビットセット) -> bool
+RuleCheck = Callable[[int, int], bool]
+
+
+def interpret_conditions_hold(rule: CompiledRule, known: int, values: int) -> bool:
+    """ルールの条件が満たされているか（OR: 1つ以上、AND: 全て）。生成したコードの基準となる汎用の評価"""
+    satisfied = known & rule.condition_mask & ~(values ^ rule.expected_mask)
+    if rule.operator == "OR":
+        return satisfied != 0
+    return satisfied == rule.condition_mask
+
+
+def interpret_is_impossible(rule: CompiledRule, known: int, values: int) -> bool:
+    """ルールが発火不可能か（ANDで1つでも不一致、ORで全て既知かつ全て不一致）。生成したコードの基準となる汎用の評価"""
+    known = known & rule.condition_mask
+    mismatched = known & (values ^ rule.expected_mask)
+    if rule.operator == "AND":
+        return mismatched != 0
+    return known != 0 and known == rule.condition_mask and mismatched == known
+
+
+class RuleEvaluators:
+    """知識ベースの全ルールの評価関数（ルールindex順）"""
+
+    __slots__ = ("holds", "impossible", "compiled", "digest")
+
+    def __init__(self, holds: Tuple[RuleCheck, ...], impossible: Tuple[RuleCheck, ...], compiled: bool, digest: str = ""):
+        self.holds = holds  # 条件が満たされているか（前向き推論で発火する）
+        self.impossible = impossible  # 発火不可能か
+        self.compiled = compiled  # 生成したコードか（False なら汎用の評価）
+        self.digest = digest  # 生成したコードの内容のハッシュ
+
+
+def interpreted_evaluators(knowledge_base: KnowledgeBase) -> RuleEvaluators:
+    """汎用の評価による評価関数（コード生成が無効・失敗した場合のフォールバック）"""
+    return RuleEvaluators(
+        tuple(_bind(interpret_conditions_hold, rule) for rule in knowledge_base.rules),
+        tuple(_bind(interpret_is_impossible, rule) for rule in knowledge_base.rules),
+        compiled=False,
+    )
+
+
+def _bind(check: Callable[[CompiledRule, int, int], bool], rule: CompiledRule) -> RuleCheck:
+    return lambda known, values: check(rule, known, values)
+
+
+def generate_rule_source(knowledge_base: KnowledgeBase) -> str:
+    """
+    知識ベースのルールごとの評価関数のPythonソースを生成
+
+    各ルールの条件の事実ID（ビット位置）と期待値をマスクの定数に畳み込み、
+    AND/OR の分岐のない1行の式にする。内容はルールの構造だけで決まる（同じ知識ベースなら同じソース）。
+    ソースに入るのはルールindexと整数の定数だけで、ルールID・事実名など知識ベースの文字列は含めない
+    （管理画面から編集できる文字列をコードとして実行しないため）。
+    """
+    lines = [
+        "# Generated by app.services.rule_compiler; k = known facts bitset, v = fact values bitset",
+        "",
+    ]
+    for rule in knowledge_base.rules:
+        mask, expected = hex(rule.condition_mask), hex(rule.expected_mask)
+        if rule.operator == "OR":
+            holds = f"k & ~(v ^ {expected}) & {mask} != 0" if rule.condition_mask else "False"
+            impossible = f"k & {mask} == {mask} and (v ^ {expected}) & {mask} == {mask}" if rule.condition_mask else "False"
+        else:
+            holds = f"k & {mask} == {mask} and v & {mask} == {expected}" if rule.condition_mask else "True"
+            impossible = f"k & (v ^ {expected}) & {mask} != 0" if rule.condition_mask else "False"
+        lines += [
+            f"def holds_{int(rule.index)}(k, v):",
+            f"    return {holds}",
+            "",
+            f"def impossible_{int(rule.index)}(k, v):",
+            f"    return {impossible}",
+            "",
+        ]
+    indices = range(len(knowledge_base.rules))
+    lines += [
+        "HOLDS = (" + "".join(f"holds_{index}, " for index in indices) + ")",
+        "IMPOSSIBLE = (" + "".join(f"impossible_{index}, " for index in indices) + ")",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def compile_rule_evaluators(knowledge_base: KnowledgeBase, cache_dir: Optional[str] = RULE_EVALUATOR_CACHE_DIR) -> RuleEvaluators:
+    """
+    知識ベースの評価関数のコードを生成してコンパイル
+
+    コンパイル結果（コードオブジェクト）は、ソースの内容のハッシュをファイル名にして cache_dir に保存し、
+    次回（再起動後・他のワーカー）はそれを読み込む。cache_dir はモード0700で作成し、このプロセスのユーザーが
+    所有して他のユーザーが書き込めないディレクトリ・ファイルだけを使う（そうでなければディスクを使わない）。
+    保存・読み込みに失敗してもメモリ上でコンパイルして続ける。
+    """
+    source = generate_rule_source(knowledge_base)
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    if cache_dir and not _prepare_private_dir(cache_dir):
+        cache_dir = None
+    code = _load_cached_code(cache_dir, digest) if cache_dir else None
+    if code is None:
+        code = compile(source, "<rule evaluators>", "exec")
+        if cache_dir:
+            _store_cached_code(cache_dir, digest, code)
+
+    namespace: dict = {"__builtins__": {}}
+    exec(code, namespace)
+    holds, impossible = namespace["HOLDS"], namespace["IMPOSSIBLE"]
+    # 生成したソースは、ルールごとに2つの関数とそのタプルだけを定義する
+    functions = [name for name, value in namespace.items() if callable(value)]
+    if len(functions) != 2 * len(knowledge_base.rules) or len(holds) != len(knowledge_base.rules) or len(impossible) != len(knowledge_base.rules):
+        raise ValueError("Generated rule evaluators do not match the knowledge base")
+    return RuleEvaluators(holds, impossible, compiled=True, digest=digest)
+
+
+def _cache_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, f"{digest[:32]}.bin")
+
+
+def _is_private(st: os.stat_result) -> bool:
+    """このプロセスのユーザーが所有し、グループ・他のユーザーが書き込めない"""
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _prepare_private_dir(cache_dir: str) -> bool:
+    """キャッシュのディレクトリを作成し（モード0700）、専用のディレクトリか確認する"""
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.lstat(cache_dir)
+    except OSError as e:
+        logger.warning("Rule evaluator cache directory %s is not usable: %s", cache_dir, e)
+        return False
+    if not stat.S_ISDIR(st.st_mode) or not _is_private(st):
+        logger.warning("Rule evaluator cache directory %s is not private to this user; not using it", cache_dir)
+        return False
+    return True
+
+
+def _load_cached_code(cache_dir: str, digest: str):
+    """保存したコードオブジェクトを読み込む（なければ・他のユーザーが書き込める・Pythonのバージョンが異なる・壊れていればNone）"""
+    header = importlib.util.MAGIC_NUMBER + bytes.fromhex(digest)
+    try:
+        with open(_cache_path(cache_dir, digest), "rb") as f:
+            if not _is_private(os.fstat(f.fileno())):
+                return None
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _store_cached_code(cache_dir: str, digest: str, code):
+    """コードオブジェクトを保存（一時ファイルに書いてから置き換えるので、読み込み中のワーカーは壊れたファイルを見ない）"""
+    header = importlib.util.MAGIC_NUMBER + bytes.fromhex(digest)
+    path = _cache_path(cache_dir, digest)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header + marshal.dumps(code))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        pass
+
+
+class RuleEvaluatorRegistry:
+    """知識ベースごとの評価関数のプロセス全体のレジストリ（知識ベースが使われなくなれば破棄される）"""
+
+    def __init__(self, mode: str = RULE_EVALUATORS, cache_dir: Optional[str] = RULE_EVALUATOR_CACHE_DIR):
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.failures = 0  # コード生成に失敗した回数（汎用の評価にフォールバック）
+        self._lock = threading.Lock()
+        self._evaluators: "weakref.WeakKeyDictionary[KnowledgeBase, RuleEvaluators]" = weakref.WeakKeyDictionary()
+
+    def get(self, knowledge_base: KnowledgeBase) -> RuleEvaluators:
+        """知識ベースの評価関数を取得（初回のみ生成・コンパイルする）"""
+        evaluators = self._evaluators.get(knowledge_base)
+        if evaluators is not None:
+            return evaluators
+
+        with self._lock:
+            evaluators = self._evaluators.get(knowledge_base)
+            if evaluators is None:
+                evaluators = self._build(knowledge_base)
+                self._evaluators[knowledge_base] = evaluators
+            return evaluators
+
+    def _build(self, knowledge_base: KnowledgeBase) -> RuleEvaluators:
+        if self.mode != "compiled":
+            return interpreted_evaluators(knowledge_base)
+        try:
+            return compile_rule_evaluators(knowledge_base, self.cache_dir)
+        except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+            # 生成したコードが使えない場合も診断は止めない
+            logger.warning("Rule evaluator generation failed for %s %s: %s", knowledge_base.visa_type, knowledge_base.version, e)
+            self.failures += 1
+            return interpreted_evaluators(knowledge_base)
+
+    def clear(self):
+        with self._lock:
+            self._evaluators = weakref.WeakKeyDictionary()
+
+
+# Global registry (shared by all engines in this process)
+rule_evaluator_registry = RuleEvaluatorRegistry()
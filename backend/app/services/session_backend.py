@@ -0,0 +1,268 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+import os
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+
+
+# 診断セッションの保存先（未設定ならプロセス内のみ）。"memory://"、"redis://[:password@]host[:port][/db]"、
+# または "sqlite:///path"（同じインスタンスのワーカー間で共有）
+CONSULTATION_SESSION_BACKEND_URL = os.getenv("CONSULTATION_SESSION_BACKEND_URL", "")
+# アイドルセッションの退避先のSQLiteファイル（未設定なら退避せず、追い出したセッションは破棄する）
+CONSULTATION_SESSION_SPILL_PATH = os.getenv("CONSULTATION_SESSION_SPILL_PATH", "")
+
+
+class SessionBackend(ABC):
+    """
+    診断セッションの保存先のインターフェース
+
+    値は session_codec.pack_state() のバイナリ。診断の1ステップで get と set を1回ずつ呼び出す。
+    """
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[bytes]:
+        """保存された状態を取得（なければ、または期限切れならNone）"""
+
+    @abstractmethod
+    def set(self, session_id: str, data: bytes, ttl_seconds: float):
+        """状態を保存（ttl_seconds <= 0 なら期限なし）"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """状態を削除"""
+
+
+class InMemorySessionBackend(SessionBackend):
+    """プロセス内の辞書に保存するバックエンド（単一プロセス・テスト用）"""
+
+    _SWEEP_INTERVAL = 256  # この回数の set ごとに期限切れのエントリを削除する
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[bytes, float]] = {}  # session_id -> (data, expires_at)
+        self._sets = 0
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] and time.monotonic() > entry[1]:
+                del self._entries[session_id]
+                return None
+            return entry[0]
+
+    def set(self, session_id: str, data: bytes, ttl_seconds: float):
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds > 0 else 0.0
+        with self._lock:
+            self._entries[session_id] = (data, expires_at)
+            self._sets += 1
+            if self._sets % self._SWEEP_INTERVAL == 0:
+                now = time.monotonic()
+                for key in [k for k, (_, expires) in self._entries.items() if expires and now > expires]:
+                    del self._entries[key]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteSessionBackend(SessionBackend):
+    """
+    ローカルのSQLiteファイルに保存するバックエンド（アイドルセッションの退避先）
+
+    同じインスタンスのワーカー間で共有できる（WALモード）。接続はスレッドごとに1つで、
+    読み取りはメモリマップを使う。期限は他のプロセスと共有するため壁時計の時刻で保持する。
+    書き込みは1回ずつトランザクション（BEGIN IMMEDIATE）で行い、失敗したらロールバックする。
+    """
+
+    _SWEEP_INTERVAL = 256  # この回数の set ごとに期限切れの行を削除する
+    _MMAP_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(session_id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT data, expires_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] and time.time() > row[1]:
+            self.delete(session_id)
+            return None
+        return row[0]
+
+    def set(self, session_id: str, data: bytes, ttl_seconds: float):
+        expires_at = time.time() + ttl_seconds if ttl_seconds > 0 else 0.0
+        self._sets += 1
+        with self._connection() as connection:
+            if self._sets % self._SWEEP_INTERVAL == 0:
+                connection.execute("DELETE FROM sessions WHERE expires_at > 0 AND expires_at < ?", (time.time(),))
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, data, expires_at),
+            )
+
+    def delete(self, session_id: str):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # 書き込み（DML）の前に BEGIN IMMEDIATE を発行する。with connection: でコミット・ロールバックする
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level="IMMEDIATE")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={self._MMAP_SIZE}")
+            self._local.connection = connection
+        return connection
+
+
+class RedisError(Exception):
+    """Redisがエラーを返した"""
+
+
+class _RedisConnection:
+    """RESP（Redisのプロトコル）の1接続"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def command(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts += [b"$%d\r\n" % len(arg), arg, b"\r\n"]
+        self.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise RedisError(payload.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError("Redis connection closed")
+            return data[:-2]
+        if kind == b"*":
+            size = int(payload)
+            return None if size < 0 else [self._read_reply() for _ in range(size)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisSessionBackend(SessionBackend):
+    """
+    Redis（RESPプロトコル）に保存するバックエンド（複数ワーカー・インスタンス・再起動をまたいで共有）
+
+    追加の依存パッケージなしで GET / SET PX / DEL のみを使う。接続はスレッドごとに1つで、
+    切断されていたら1度だけ再接続して再送する。
+    """
+
+    def __init__(self, url: str, prefix: str = "consultation:session:", timeout: float = 5.0):
+        parts = urlsplit(url)
+        if parts.scheme not in ("redis", "rediss"):
+            raise ValueError(f"Unsupported Redis URL: {url}")
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.use_tls = parts.scheme == "rediss"
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        return self._command("GET", self.prefix + session_id)
+
+    def set(self, session_id: str, data: bytes, ttl_seconds: float):
+        if ttl_seconds > 0:
+            self._command("SET", self.prefix + session_id, data, "PX", max(1, int(ttl_seconds * 1000)))
+        else:
+            self._command("SET", self.prefix + session_id, data)
+
+    def delete(self, session_id: str):
+        self._command("DEL", self.prefix + session_id)
+
+    def _command(self, *args):
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            try:
+                return connection.command(*args)
+            except (OSError, ConnectionError):
+                # 切断された接続（サーバーの再起動・アイドルタイムアウト）は作り直す
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def _connect(self) -> _RedisConnection:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.use_tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        connection = _RedisConnection(sock)
+        try:
+            if self.password is not None:
+                if self.username:
+                    connection.command("AUTH", self.username, self.password)
+                else:
+                    connection.command("AUTH", self.password)
+            if self.db:
+                connection.command("SELECT", self.db)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+
+def create_session_backend(url: str) -> Optional[SessionBackend]:
+    """URLからバックエンドを作成（空ならNone：プロセス内のセッションストアのみを使う）"""
+    if not url:
+        return None
+    if url == "memory://":
+        return InMemorySessionBackend()
+    if url.startswith(("redis://", "rediss://")):
+        return RedisSessionBackend(url)
+    if url.startswith("sqlite:///"):
+        return SqliteSessionBackend(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported session backend: {url}")
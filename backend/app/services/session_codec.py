@@ -0,0 +1,287 @@
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from app.services.knowledge_base import ALL_VISA_TYPES, KnowledgeBase
+import base64
+import hashlib
+import hmac
+import os
+import time
+import zlib
+
+
+# 診断の状態トークンの署名鍵（未設定ならステートレスモードは無効）。全てのワーカーで同じ値を設定する
+CONSULTATION_STATE_SECRET = os.getenv("CONSULTATION_STATE_SECRET", "")
+# 状態トークンの有効期限（秒、0で無期限）。セッションストアのTTLと同じ
+CONSULTATION_STATE_MAX_AGE_SECONDS = float(
+    os.getenv("CONSULTATION_STATE_MAX_AGE_SECONDS", os.getenv("CONSULTATION_SESSION_TTL_SECONDS", "3600"))
+)
+# この長さ（バイト）以上の状態は zlib で圧縮する（圧縮して短くなる場合のみ）
+CONSULTATION_STATE_COMPRESS_MIN_BYTES = int(os.getenv("CONSULTATION_STATE_COMPRESS_MIN_BYTES", "96"))
+# 状態に含める回答の件数の上限。状態の復元では回答を全て前向き推論で再生するため、
+# 長い回答の列を持つトークンで処理時間が増えないように、これを超える状態は不正として扱う
+CONSULTATION_STATE_MAX_ANSWERS = int(os.getenv("CONSULTATION_STATE_MAX_ANSWERS", "500"))
+
+_FORMAT_VERSION = 2
+_FLAG_COMPRESSED = 1
+_MAC_BYTES = 16
+_FINGERPRINT_MASK = (1 << 64) - 1
+_MAX_STATE_BYTES = 1 << 20  # 展開後のサイズの上限
+
+# 回答のコード（2ビット）
+_ANSWER_CODES = {False: 0, True: 1, None: 2}
+_ANSWERS = {code: answer for answer, code in _ANSWER_CODES.items()}
+
+
+class StateTokenError(ValueError):
+    """状態トークン（または保存された状態）が不正（改ざん・破損・期限切れ）"""
+
+
+class StaleStateError(StateTokenError):
+    """状態トークンの知識ベースのバージョンが現在のものと異なる（診断をやり直す必要がある）"""
+
+
+class SessionState(NamedTuple):
+    """状態トークン・セッションバックエンドに保存する診断の状態（これと知識ベースからセッションを再構築できる）"""
+
+    session_id: str
+    visa_type: str
+    answers: List[Tuple[str, Optional[bool]]]  # 回答の履歴（fact_name, 回答）。事実の状態は再生して求める
+    question_history: List[str]  # 表示した質問の fact_name
+    current_question_fact: Optional[str]
+    current_visa_type: Optional[str]
+    visualization_version: int
+    visualization_changes: int  # 最新の可視化のバージョンで表示が変わったルールのビットセット（直前のバージョンからの差分用）
+    fingerprint: int  # 再生後のエンジンのフィンガープリント（下位64ビット、再生結果の検証用）
+    saved_at: int = 0  # 保存した時刻（UNIX時間、unpack_state で設定される）
+
+
+def pack_state(
+    state: SessionState,
+    knowledge_base: KnowledgeBase,
+    compress_min_bytes: int = CONSULTATION_STATE_COMPRESS_MIN_BYTES,
+) -> bytes:
+    """
+    状態をコンパクトなバイナリに変換（署名なし。サーバー側のセッションバックエンドに保存する形式）
+
+    事実は知識ベースの事実IDで表し（知識ベースにない事実のみ名前を含める）、
+    回答は事実IDと2ビットの回答コードを1つの可変長整数にまとめる。
+    先頭の1バイトは形式のバージョンとフラグで、本体は短くなる場合のみ zlib で圧縮する。
+    """
+    fact_ids = knowledge_base.fact_ids
+    extra_names: List[str] = []
+    extra_refs = {}
+
+    def ref(fact_name: str) -> int:
+        fact_id = fact_ids.get(fact_name)
+        if fact_id is None:
+            fact_id = extra_refs.get(fact_name)
+            if fact_id is None:
+                fact_id = extra_refs[fact_name] = len(knowledge_base.fact_names) + len(extra_names)
+                extra_names.append(fact_name)
+        return fact_id
+
+    answers = [ref(fact_name) << 2 | _ANSWER_CODES[answer] for fact_name, answer in state.answers]
+    history = [ref(fact_name) for fact_name in state.question_history]
+    current_question = ref(state.current_question_fact) + 1 if state.current_question_fact is not None else 0
+
+    body = bytearray()
+    _write_varint(body, int(time.time()))
+    _write_text(body, state.session_id)
+    _write_text(body, state.visa_type)
+    body += bytes.fromhex(knowledge_base.version)
+    _write_varint(body, len(extra_names))
+    for fact_name in extra_names:
+        _write_text(body, fact_name)
+    for values in (answers, history):
+        _write_varint(body, len(values))
+        for value in values:
+            _write_varint(body, value)
+    _write_varint(body, current_question)
+    _write_varint(body, ALL_VISA_TYPES.index(state.current_visa_type) + 1 if state.current_visa_type else 0)
+    _write_varint(body, state.visualization_version)
+    _write_varint(body, state.visualization_changes)
+    body += (state.fingerprint & _FINGERPRINT_MASK).to_bytes(8, "big")
+
+    flags = 0
+    if len(body) >= compress_min_bytes:
+        compressed = zlib.compress(bytes(body), 9)
+        if len(compressed) < len(body):
+            body, flags = compressed, _FLAG_COMPRESSED
+    return bytes([_FORMAT_VERSION << 1 | flags]) + bytes(body)
+
+
+def unpack_state(
+    data: bytes,
+    get_knowledge_base: Callable[[str, str], KnowledgeBase],
+) -> Tuple[KnowledgeBase, SessionState]:
+    """
+    pack_state() のバイナリを状態に戻す
+
+    Args:
+        get_knowledge_base: (visa_type, 知識ベースのバージョン) -> 知識ベース（なければ StaleStateError）
+
+    Raises:
+        StateTokenError: 形式が不正、または回答・質問履歴の件数が CONSULTATION_STATE_MAX_ANSWERS を超える
+    """
+    if len(data) < 1 or data[0] >> 1 != _FORMAT_VERSION:
+        raise StateTokenError("Unsupported consultation state format")
+
+    body = data[1:]
+    if data[0] & _FLAG_COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, _MAX_STATE_BYTES)
+        except zlib.error:
+            raise StateTokenError("Invalid consultation state")
+        if decompressor.unconsumed_tail:
+            raise StateTokenError("Invalid consultation state")
+
+    try:
+        reader = _Reader(body)
+        saved_at = reader.varint()
+        session_id = reader.text()
+        visa_type = reader.text()
+        kb_version = reader.read(8).hex()
+        extra_names = [reader.text() for _ in range(reader.varint())]
+        answers = [reader.varint() for _ in range(_checked_count(reader.varint()))]
+        history = [reader.varint() for _ in range(_checked_count(reader.varint()))]
+        current_question = reader.varint()
+        current_visa_type = reader.varint()
+        visualization_version = reader.varint()
+        visualization_changes = reader.varint()
+        fingerprint = int.from_bytes(reader.read(8), "big")
+        reader.end()
+
+        knowledge_base = get_knowledge_base(visa_type, kb_version)
+        fact_names = knowledge_base.fact_names + tuple(extra_names)
+        state = SessionState(
+            session_id=session_id,
+            visa_type=visa_type,
+            answers=[(fact_names[value >> 2], _ANSWERS[value & 3]) for value in answers],
+            question_history=[fact_names[value] for value in history],
+            current_question_fact=fact_names[current_question - 1] if current_question else None,
+            current_visa_type=ALL_VISA_TYPES[current_visa_type - 1] if current_visa_type else None,
+            visualization_version=visualization_version,
+            visualization_changes=visualization_changes,
+            fingerprint=fingerprint,
+            saved_at=saved_at,
+        )
+    except (IndexError, KeyError, UnicodeDecodeError):
+        raise StateTokenError("Invalid consultation state")
+    return knowledge_base, state
+
+
+def _checked_count(count: int) -> int:
+    """回答・質問履歴の件数（上限を超えたら StateTokenError。読み込む前に確認する）"""
+    if count > CONSULTATION_STATE_MAX_ANSWERS:
+        raise StateTokenError("Too many answers in consultation state")
+    return count
+
+
+class StateCodec:
+    """
+    診断の状態を、署名付きのトークンに変換する（ステートレスモード）
+
+    トークンは pack_state() のバイナリに HMAC-SHA256（16バイト）を付けて
+    base64url（パディングなし）にしたもので、知識ベースのバージョンを含む。
+    """
+
+    def __init__(
+        self,
+        secret: bytes,
+        max_age_seconds: float = CONSULTATION_STATE_MAX_AGE_SECONDS,
+        compress_min_bytes: int = CONSULTATION_STATE_COMPRESS_MIN_BYTES,
+    ):
+        self.secret = secret
+        self.max_age_seconds = max_age_seconds
+        self.compress_min_bytes = compress_min_bytes
+
+    def encode(self, state: SessionState, knowledge_base: KnowledgeBase) -> str:
+        """状態をトークンに変換"""
+        payload = pack_state(state, knowledge_base, self.compress_min_bytes)
+        token = payload + self._sign(payload)
+        return base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii")
+
+    def decode(
+        self,
+        token: str,
+        get_knowledge_base: Callable[[str, str], KnowledgeBase],
+    ) -> Tuple[KnowledgeBase, SessionState]:
+        """
+        トークンを検証して状態に戻す
+
+        Raises:
+            StateTokenError: 署名が一致しない・形式が不正・期限切れ
+        """
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except (ValueError, TypeError):
+            raise StateTokenError("Invalid consultation state")
+        payload, mac = raw[:-_MAC_BYTES], raw[-_MAC_BYTES:]
+        if len(payload) < 1 or not hmac.compare_digest(mac, self._sign(payload)):
+            raise StateTokenError("Invalid consultation state")
+
+        knowledge_base, state = unpack_state(payload, get_knowledge_base)
+        if self.max_age_seconds > 0 and time.time() - state.saved_at > self.max_age_seconds:
+            raise StateTokenError("Consultation state has expired")
+        return knowledge_base, state
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:_MAC_BYTES]
+
+
+def _write_varint(buffer: bytearray, value: int):
+    """符号なし整数を LEB128 の可変長整数で書き込む"""
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            buffer.append(byte | 0x80)
+        else:
+            buffer.append(byte)
+            return
+
+
+def _write_text(buffer: bytearray, text: str):
+    data = text.encode("utf-8")
+    _write_varint(buffer, len(data))
+    buffer += data
+
+
+class _Reader:
+    """トークン本体の読み取り（範囲外の読み取りは IndexError）"""
+
+    __slots__ = ("data", "offset")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size: int) -> bytes:
+        if self.offset + size > len(self.data):
+            raise IndexError("truncated")
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value
+
+    def varint(self) -> int:
+        value = shift = 0
+        while True:
+            byte = self.data[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def text(self) -> str:
+        return self.read(self.varint()).decode("utf-8")
+
+    def end(self):
+        if self.offset != len(self.data):
+            raise IndexError("trailing data")
+
+
+# Global codec (None when CONSULTATION_STATE_SECRET is not set: stateless mode disabled)
+state_codec: Optional[StateCodec] = (
+    StateCodec(CONSULTATION_STATE_SECRET.encode("utf-8")) if CONSULTATION_STATE_SECRET else None
+)
@@ -0,0 +1,122 @@
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import KnowledgeBase, knowledge_base_registry
+from app.services.question_catalog import QuestionCatalog, question_catalog_registry
+import threading
+
+
+class SessionTemplate:
+    """
+    診断開始時の状態のテンプレート（visa_type, 知識ベースのバージョン, 質問カタログのバージョン ごとに1つ）
+
+    回答前のエンジン・最初の質問・導出可能かどうか・初期状態の可視化は全ての利用者で同じなので、
+    1度だけ計算し、新しいセッションはエンジンを複製（clone）して使う。
+    テンプレートのエンジンは読み取り専用で、状態を変更してはいけない。
+    """
+
+    __slots__ = (
+        "visa_type",
+        "knowledge_base",
+        "catalog_version",
+        "engine",
+        "question_fact",
+        "question_text",
+        "is_derivable",
+        "current_visa_type",
+        "visualization",
+        "rule_statuses",
+    )
+
+    def __init__(self, visa_type: str, knowledge_base: KnowledgeBase, question_catalog: QuestionCatalog):
+        self.visa_type = visa_type
+        self.knowledge_base = knowledge_base
+        self.catalog_version = question_catalog.version
+
+        engine = InferenceEngine(None, visa_type, knowledge_base=knowledge_base, question_catalog=question_catalog)
+        self.question_fact = engine.get_next_question()
+        self.question_text = question_catalog.get_question_text(self.question_fact) if self.question_fact else None
+        self.is_derivable = engine._is_derivable(self.question_fact) if self.question_fact else True
+        self.current_visa_type = (
+            engine.get_question_visa_type(self.question_fact) if visa_type == "ALL" and self.question_fact else None
+        )
+        # 初期状態の可視化（ルールindex順）。回答のないセッションは全てこれと同じ表示になる
+        self.visualization: Dict = engine.get_rule_visualization()
+        self.rule_statuses: List[list] = engine.get_rule_status_delta((1 << len(knowledge_base.rules)) - 1)
+
+        # セッションのエンジンは現在の質問カタログを使うので、複製元には固定しない
+        engine.question_catalog = None
+        self.engine = engine
+
+    def create_engine(self, db: Session) -> InferenceEngine:
+        """回答前の状態のエンジンを作成（テンプレートのエンジンの複製）"""
+        engine = self.engine.clone()
+        engine.db = db
+        return engine
+
+    def get_rule_visualization_delta(self, rule_mask: int) -> List[Dict]:
+        """初期状態の、指定したルールのみの可視化用データ（InferenceEngine.get_rule_visualization_delta と同じ形式）"""
+        rules = self.visualization["rules"]
+        return [{"index": index, **rules[index]} for index in range(len(rules)) if rule_mask >> index & 1]
+
+    def get_rule_status_delta(self, rule_mask: int) -> List[list]:
+        """初期状態の、指定したルールのみのコンパクトな状態（InferenceEngine.get_rule_status_delta と同じ形式）"""
+        return [status for status in self.rule_statuses if rule_mask >> status[0] & 1]
+
+
+class SessionTemplateRegistry:
+    """セッションのテンプレートのプロセス全体のレジストリ（ビザタイプごとに現在のバージョンのもののみ保持）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates: Dict[str, SessionTemplate] = {}  # visa_type -> template
+
+    def get(self, db: Session, visa_type: str) -> SessionTemplate:
+        """
+        現在の知識ベースと質問カタログのテンプレートを取得
+
+        どちらかのバージョンが変わっていれば（ルール・質問の編集後）作り直す
+        """
+        knowledge_base = knowledge_base_registry.get(db, visa_type)
+        question_catalog = question_catalog_registry.get(db)
+        template = self._templates.get(visa_type)
+        if self._matches(template, knowledge_base, question_catalog):
+            return template
+
+        with self._lock:
+            template = self._templates.get(visa_type)
+            if not self._matches(template, knowledge_base, question_catalog):
+                template = SessionTemplate(visa_type, knowledge_base, question_catalog)
+                self._templates[visa_type] = template
+            return template
+
+    def find(self, db: Optional[Session], knowledge_base: KnowledgeBase) -> Optional[SessionTemplate]:
+        """
+        指定した知識ベースの作成済みのテンプレートを取得（なければNone）
+
+        保存された状態からの再構築用。古いバージョンの知識ベースのテンプレートは作らない
+        """
+        template = self._templates.get(knowledge_base.visa_type)
+        if self._matches(template, knowledge_base, question_catalog_registry.get(db)):
+            return template
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    @staticmethod
+    def _matches(
+        template: Optional[SessionTemplate],
+        knowledge_base: KnowledgeBase,
+        question_catalog: QuestionCatalog,
+    ) -> bool:
+        return (
+            template is not None
+            and template.knowledge_base is knowledge_base
+            and template.catalog_version == question_catalog.version
+        )
+
+
+# Global registry (shared by all sessions in this process)
+session_template_registry = SessionTemplateRegistry()
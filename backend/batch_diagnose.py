@@ -0,0 +1,210 @@
+"""
+一括診断のコマンドラインツール（夜間の再診断など、大量の件数をオフラインで処理する）
+
+入力（JSONL）: 1行1件
+    {"case_id": "001", "visa_type": "E", "answers": {"<fact_name または質問文>": true, ...}}
+
+入力（CSV）: 1行1件。case_id, visa_type 以外の列は fact_name（または質問文）で、
+    値は はい/いいえ/分からない（true/false/unknown, yes/no, 1/0 も可）。空欄は未回答。
+
+出力: 1行1件のJSONL（/api/consultation/batch と同じ形式）を入力と同じ順序で逐次書き出す。
+
+Usage:
+    python batch_diagnose.py cases.jsonl -o results.jsonl --workers 8 --chunk-size 500
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# Add app to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal, engine
+from app.services.consultation_service import diagnose_case
+from app.services.knowledge_base import ALL_VISA_TYPES, KnowledgeBase, compile_knowledge_base
+from app.services.question_catalog import QuestionCatalog, load_question_catalog
+
+
+ANSWER_VALUES = {
+    "はい": True,
+    "true": True,
+    "yes": True,
+    "y": True,
+    "1": True,
+    "いいえ": False,
+    "false": False,
+    "no": False,
+    "n": False,
+    "0": False,
+    "分からない": None,
+    "わからない": None,
+    "unknown": None,
+    "null": None,
+    "none": None,
+}
+
+# ワーカープロセスごとに1度だけ読み込む知識ベースと質問カタログ
+_knowledge_bases: Dict[str, KnowledgeBase] = {}
+_question_catalog: Optional[QuestionCatalog] = None
+
+
+def parse_answer(value: str) -> Optional[bool]:
+    """CSVの回答の値を変換"""
+    key = value.strip().lower()
+    if key not in ANSWER_VALUES:
+        raise ValueError(f"Invalid answer value: {value!r}")
+    return ANSWER_VALUES[key]
+
+
+def read_cases(path: str, input_format: str, default_visa_type: str) -> Iterator[dict]:
+    """入力ファイルから1件ずつ読み込む（ファイル全体をメモリに載せない）"""
+    stream = sys.stdin if path == "-" else open(path, "r", encoding="utf-8-sig", newline="")
+    try:
+        if input_format == "csv":
+            for index, row in enumerate(csv.DictReader(stream)):
+                case_id = row.pop("case_id", None) or str(index)
+                visa_type = row.pop("visa_type", None) or default_visa_type
+                try:
+                    answers = {
+                        fact_name: parse_answer(value)
+                        for fact_name, value in row.items()
+                        if fact_name and value and value.strip()
+                    }
+                except ValueError as e:
+                    yield {"case_id": case_id, "visa_type": visa_type, "error": str(e)}
+                    continue
+                yield {"case_id": case_id, "visa_type": visa_type, "answers": answers}
+        else:
+            for index, line in enumerate(stream):
+                if not line.strip():
+                    continue
+                case = json.loads(line)
+                case.setdefault("case_id", str(index))
+                case.setdefault("visa_type", default_visa_type)
+                yield case
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def init_worker():
+    """ワーカーの初期化：知識ベースと質問カタログを1度だけ読み込む"""
+    global _question_catalog
+    engine.dispose()  # 親プロセスから引き継いだコネクションは使わない
+    db = SessionLocal()
+    try:
+        _question_catalog = load_question_catalog(db)
+        for visa_type in ALL_VISA_TYPES + ["ALL"]:
+            _knowledge_bases[visa_type] = compile_knowledge_base(db, visa_type)
+    finally:
+        db.close()
+
+
+def _get_knowledge_base(visa_type: str) -> KnowledgeBase:
+    """ワーカーの知識ベースを取得（初期化時に読み込んでいないものは初回のみDBから読み込む）"""
+    if visa_type not in _knowledge_bases:
+        db = SessionLocal()
+        try:
+            _knowledge_bases[visa_type] = compile_knowledge_base(db, visa_type)
+        finally:
+            db.close()
+    return _knowledge_bases[visa_type]
+
+
+def diagnose_chunk(cases: List[dict]) -> List[str]:
+    """1チャンク分を診断し、出力行（JSON）のリストを返す"""
+    lines = []
+    for case in cases:
+        result = {"case_id": case["case_id"], "visa_type": case["visa_type"]}
+        if "error" in case:
+            result["error"] = case["error"]
+        else:
+            try:
+                knowledge_base = _get_knowledge_base(case["visa_type"])
+                result.update(
+                    diagnose_case(case["visa_type"], case.get("answers") or {}, knowledge_base, _question_catalog)
+                )
+            except Exception as e:
+                result["error"] = str(e)
+        lines.append(json.dumps(result, ensure_ascii=False))
+    return lines
+
+
+def chunked(cases: Iterable[dict], chunk_size: int) -> Iterator[List[dict]]:
+    iterator = iter(cases)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(cases: Iterable[dict], output, workers: int, chunk_size: int) -> int:
+    """
+    全件を診断して書き出す
+
+    実行中のチャンク数を workers の2倍までに抑えるので、件数によらずメモリ使用量は一定。
+    結果は入力と同じ順序で、チャンクが終わるたびに書き出す。
+    """
+    count = 0
+    chunks = chunked(cases, chunk_size)
+
+    def write(lines: List[str]):
+        nonlocal count
+        for line in lines:
+            output.write(line + "\n")
+        output.flush()
+        count += len(lines)
+
+    if workers <= 1:
+        init_worker()
+        for chunk in chunks:
+            write(diagnose_chunk(chunk))
+        return count
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(diagnose_chunk, chunk))
+            if len(pending) >= workers * 2:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回答済みの案件を一括診断し、結果をJSONLで書き出す")
+    parser.add_argument("input", help="入力ファイル（.jsonl または .csv、- で標準入力）")
+    parser.add_argument("-o", "--output", default="-", help="出力ファイル（JSONL、デフォルトは標準出力）")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="入力形式（省略時は拡張子から判定）")
+    parser.add_argument("--visa-type", default="ALL", help="visa_type のない行のビザタイプ（デフォルト: ALL）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数（1でプロセスを分けない）")
+    parser.add_argument("--chunk-size", type=int, default=500, help="1回にワーカーへ渡す件数")
+    args = parser.parse_args()
+
+    input_format = args.format or ("csv" if args.input.lower().endswith(".csv") else "jsonl")
+    cases = read_cases(args.input, input_format, args.visa_type)
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    started = time.perf_counter()
+    try:
+        count = run(cases, output, args.workers, max(1, args.chunk_size))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Diagnosed {count} cases in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} cases/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
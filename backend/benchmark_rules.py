@@ -0,0 +1,138 @@
+"""
+ルールの照合のベンチマーク（前向き推論で回答を適用する時間、回答1つあたりの最小値）
+
+- evaluators: ルールの評価関数（汎用の評価 / 知識ベースごとに生成したコード、RULE_EVALUATORS）
+- matcher: 条件の照合方式（ルールごとの評価 naive / 条件を共有するネットワーク rete、RULE_MATCHER）
+
+知識ベースは出荷している E・ALL と、合成した知識ベース（条件の集合を共有するルールの多い shared、
+1つの事実を多くのルールが条件に持つ wide）。状態の復元と質問の探索の時間は含まない。
+
+Usage:
+    python benchmark_rules.py [evaluators|matcher ...] --repeat 5
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+# Add app to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import compile_knowledge_base
+from app.services.question_cache import NextQuestionCache
+from app.services.rule_compiler import compile_rule_evaluators, interpreted_evaluators
+from rule_factories import shared_knowledge_base, wide_knowledge_base
+
+
+def consultation_sequences(db, knowledge_base, rng, count=50, length=40):
+    """診断で実際に聞かれる質問の列（回答はランダム）"""
+    engine = InferenceEngine(
+        db, knowledge_base.visa_type, knowledge_base=knowledge_base, question_cache=NextQuestionCache(0)
+    )
+    sequences = []
+    for _ in range(count):
+        engine.restore_snapshot({})
+        answers = []
+        while len(answers) < length:
+            question = engine.get_next_question()
+            if question is None:
+                break
+            answers.append((question, rng.random() < 0.5))
+            engine.add_fact(*answers[-1])
+            engine.forward_chain()
+        sequences.append(answers)
+    return sequences
+
+
+def random_sequences(rng, facts, count=30, length=40):
+    return [[(fact_name, rng.random() < 0.5) for fact_name in rng.sample(facts, length)] for _ in range(count)]
+
+
+def load_cases(rng):
+    """(名前, 知識ベース, 回答の列) のリスト"""
+    db = SessionLocal()
+    cases = []
+    for visa_type in ["E", "ALL"]:
+        knowledge_base = compile_knowledge_base(db, visa_type)
+        cases.append((visa_type, knowledge_base, consultation_sequences(db, knowledge_base, rng)))
+    db.close()
+
+    knowledge_base, facts = shared_knowledge_base(rng)
+    cases.append(("shared", knowledge_base, random_sequences(rng, facts, length=60)))
+    knowledge_base, facts = wide_knowledge_base(rng)
+    cases.append(("wide", knowledge_base, random_sequences(rng, facts)))
+    return cases
+
+
+def make_engine(knowledge_base, matcher="naive", evaluators=None):
+    engine = InferenceEngine(
+        None, knowledge_base.visa_type, knowledge_base=knowledge_base, question_cache=NextQuestionCache(0), matcher=matcher
+    )
+    engine._get_applicable_rules()
+    if evaluators is not None:
+        engine._holds, engine._impossible = evaluators.holds, evaluators.impossible
+    return engine
+
+
+def bench_forward_chain(engine, sequences, repeat):
+    """記録した回答の列を前向き推論で適用する時間（マイクロ秒/回答）"""
+    initial = engine.save_snapshot()
+    best = None
+    for _ in range(repeat):
+        elapsed = 0.0
+        for answers in sequences:
+            engine.restore_snapshot(initial)
+            start = time.perf_counter()
+            for fact_name, value in answers:
+                engine.add_fact(fact_name, value)
+                engine.forward_chain()
+            elapsed += time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / sum(len(answers) for answers in sequences) * 1e6
+
+
+def bench_evaluators(cases, repeat):
+    for name, knowledge_base, sequences in cases:
+        engine = make_engine(knowledge_base, evaluators=interpreted_evaluators(knowledge_base))
+        interpreted = bench_forward_chain(engine, sequences, repeat)
+        engine = make_engine(knowledge_base, evaluators=compile_rule_evaluators(knowledge_base, None))
+        compiled = bench_forward_chain(engine, sequences, repeat)
+        print(
+            f"Evaluators {name} ({len(knowledge_base.rules)} rules): interpreted {interpreted:.2f} us/answer, "
+            f"compiled {compiled:.2f} us/answer ({interpreted / compiled:.2f}x)"
+        )
+
+
+def bench_matcher(cases, repeat):
+    for name, knowledge_base, sequences in cases:
+        naive = bench_forward_chain(make_engine(knowledge_base, "naive"), sequences, repeat)
+        rete = bench_forward_chain(make_engine(knowledge_base, "rete"), sequences, repeat)
+        print(
+            f"Matcher {name} ({len(knowledge_base.rules)} rules): naive {naive:.2f} us/answer, "
+            f"rete {rete:.2f} us/answer ({naive / rete:.2f}x)"
+        )
+
+
+BENCHMARKS = {"evaluators": bench_evaluators, "matcher": bench_matcher}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ルールの評価関数・照合方式の前向き推論の時間を比較する")
+    parser.add_argument("benchmarks", nargs="*", help=f"実行するベンチマーク（{', '.join(sorted(BENCHMARKS))}。省略時は全て）")
+    parser.add_argument("--repeat", type=int, default=5, help="繰り返し回数（最小値を報告する）")
+    parser.add_argument("--seed", type=int, default=0, help="合成する知識ベース・回答の乱数のシード")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    cases = load_cases(random.Random(args.seed))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](cases, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""テスト用のルール・エンジン・知識ベースの作成（DBには保存しない。test_*.py から共通で使う）"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.models import Condition, Rule
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import CompiledRule, KnowledgeBase
+from app.services.question_cache import NextQuestionCache
+from app.services.question_catalog import QuestionCatalog, QuestionEntry
+
+
+def make_rule(rule_id, conditions, conclusion, operator="AND", priority=0, visa_type="T"):
+    """
+    テスト用のルールを作成
+
+    conditions は (fact_name, 期待値) のタプル、または fact_name（期待値 True）のリスト
+    """
+    rule = Rule(
+        rule_id=rule_id,
+        visa_type=visa_type,
+        conclusion=conclusion,
+        conclusion_value=True,
+        operator=operator,
+        priority=priority,
+    )
+    conditions = [(condition, True) if isinstance(condition, str) else condition for condition in conditions]
+    rule.conditions = [
+        Condition(id=i, fact_name=fact_name, expected_value=expected)
+        for i, (fact_name, expected) in enumerate(conditions)
+    ]
+    return CompiledRule(rule)
+
+
+def make_engine(rules, catalog=None, visa_type="T", question_cache=None, matcher=None):
+    """
+    ルールのリスト（または知識ベース）からエンジンを作成
+
+    Returns:
+        (知識ベース, エンジン)
+    """
+    kb = rules if isinstance(rules, KnowledgeBase) else KnowledgeBase(visa_type, rules)
+    engine = InferenceEngine(
+        None,
+        kb.visa_type,
+        knowledge_base=kb,
+        question_catalog=catalog or QuestionCatalog([]),
+        question_cache=question_cache if question_cache is not None else NextQuestionCache(),
+        matcher=matcher,
+    )
+    return kb, engine
+
+
+def random_knowledge_base(rng, fact_count=40, rule_count=60):
+    """ランダムな知識ベース（循環・広いORルール・高優先度の中間質問を含む）"""
+    facts = [f"f{i}" for i in range(fact_count)]
+    rules = []
+    for i in range(rule_count):
+        conclusion = rng.choice(facts[: fact_count // 2])
+        width = rng.choice([1, 2, 3, 6]) if rng.random() < 0.8 else 12
+        conditions = [(rng.choice(facts), rng.random() < 0.8) for _ in range(width)]
+        conditions = list({fact_name: expected for fact_name, expected in conditions if fact_name != conclusion}.items())
+        if conditions:
+            rules.append(make_rule(f"r{i}", conditions, conclusion, rng.choice(["AND", "OR"]), rng.randint(0, 5)))
+    catalog = QuestionCatalog(
+        [QuestionEntry(fact_name, fact_name, "T", 90 if rng.random() < 0.05 else 0) for fact_name in facts]
+    )
+    return rules, catalog
+
+
+def shared_knowledge_base(rng, groups=40, group_size=5, rules_per_group=40, fact_count=200):
+    """
+    条件の集合を共有するルールの多い知識ベース（rules.json の投資・経営者/従業員の分岐のような構造を大きくしたもの）
+
+    ルール = グループの共通の条件（group_size 個）+ ルール固有の条件（1〜3個）
+    """
+    facts = [f"f{i}" for i in range(fact_count)]
+    rules = []
+    for group in range(groups):
+        shared = [(fact_name, rng.random() < 0.7) for fact_name in rng.sample(facts[20:], group_size)]
+        shared_names = {fact_name for fact_name, _ in shared}
+        for i in range(rules_per_group):
+            extra = [(fact_name, rng.random() < 0.7) for fact_name in rng.sample(facts[20:], 3) if fact_name not in shared_names]
+            conditions = shared + extra[: rng.randint(1, 3)]
+            operator = "AND" if rng.random() < 0.8 else "OR"
+            rules.append(make_rule(f"g{group}_{i}", conditions, rng.choice(facts[:20]), operator))
+    return KnowledgeBase("T", rules), facts[20:]
+
+
+def wide_knowledge_base(rng, rule_count=1500, fact_count=120, conclusion_count=40):
+    """
+    条件の事実が少なく、1つの事実を多くのルールが条件に持つランダムな知識ベース（デフォルトで1事実あたり平均約75ルール）
+
+    Returns:
+        (知識ベース, 条件に使われる事実名のリスト)
+    """
+    facts = [f"f{i}" for i in range(fact_count)]
+    rules = []
+    for i in range(rule_count):
+        conditions = [(fact_name, rng.random() < 0.7) for fact_name in rng.sample(facts[conclusion_count:], rng.choice([2, 3, 4, 6]))]
+        rules.append(make_rule(f"r{i}", conditions, rng.choice(facts[:conclusion_count]), rng.choice(["AND", "OR"])))
+    return KnowledgeBase("T", rules), facts[conclusion_count:]
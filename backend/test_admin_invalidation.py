@@ -0,0 +1,73 @@
+"""管理画面のルールの編集（AdminService）で、知識ベース・セッションのテンプレートのキャッシュが更新されるかのテスト（質問の編集は test_question_catalog.py）"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import schemas
+from app.models.database import Base
+from app.services.admin_service import AdminService
+from app.services.knowledge_base import knowledge_base_registry
+from app.services.question_catalog import question_catalog_registry
+from app.services.session_template import session_template_registry
+
+
+def make_database(path):
+    """ルール1つ・質問2つの一時DB（開発用のDBは変更しない。キャッシュは各テストの最後に無効化する）"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    service = AdminService(db)
+    service.create_question(schemas.QuestionCreate(fact_name="a", question_text="Aですか", visa_type="E"))
+    service.create_question(schemas.QuestionCreate(fact_name="b", question_text="Bですか", visa_type="E"))
+    rule = service.create_rule(schemas.RuleCreate(
+        rule_id="r1",
+        visa_type="E",
+        conclusion="Eビザでの申請ができます",
+        conditions=[schemas.ConditionCreate(fact_name="a")],
+    ))
+    return engine, db, rule
+
+
+def test_rule_edit_invalidates_knowledge_base():
+    """ルールの編集後の get() は新しいバージョンの知識ベース（とテンプレート）を返す"""
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, db, rule = make_database(os.path.join(tmp, "admin.db"))
+        try:
+            before = knowledge_base_registry.get(db, "E")
+            assert knowledge_base_registry.get(db, "E") is before  # 編集がなければキャッシュを使う
+            template = session_template_registry.get(db, "E")
+            assert template.question_fact == "a"
+
+            AdminService(db).update_rule(rule.id, schemas.RuleUpdate(
+                conditions=[schemas.ConditionCreate(fact_name="b"), schemas.ConditionCreate(fact_name="a")],
+            ))
+            after = knowledge_base_registry.get(db, "E")
+            assert after is not before and after.version != before.version
+            assert [condition.fact_name for condition in after.rules[0].conditions] == ["b", "a"]
+            assert session_template_registry.get(db, "E") is not template
+
+            AdminService(db).delete_rule(rule.id)
+            assert not knowledge_base_registry.get(db, "E").rules
+        finally:
+            knowledge_base_registry.invalidate()
+            question_catalog_registry.invalidate()
+            session_template_registry.clear()
+            db.close()
+            engine.dispose()
+    print("Rule edit: knowledge base reloaded")
+
+
+if __name__ == "__main__":
+    try:
+        test_rule_edit_invalidates_knowledge_base()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
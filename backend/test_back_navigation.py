@@ -0,0 +1,76 @@
+"""「戻る」操作（トレイルによるアンドゥ）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import answer_question
+from app.services.inference_engine import InferenceEngine
+
+
+def test_undo_matches_snapshots():
+    """undo() で戻した状態が、回答前に保存したスナップショットと一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+
+    for visa_type in ["E", "L", "B"]:
+        for _ in range(50):
+            engine = InferenceEngine(db, visa_type)
+            snapshots = [engine.save_snapshot()]
+
+            for step in range(30):
+                fact_name = engine.get_next_question()
+                if fact_name is None:
+                    break
+                answer_question(engine, fact_name, rng.choice([True, False, None]))
+                snapshots.append(engine.save_snapshot())
+
+                if rng.random() < 0.3:
+                    steps = rng.randint(1, len(snapshots) - 1)
+                    assert engine.undo(steps) == steps
+                    del snapshots[-steps:]
+                    restored = engine.save_snapshot()
+                    expected = snapshots[-1]
+                    for key in ["facts", "uncertain_facts", "derived_facts", "asked_questions", "unknown_facts"]:
+                        assert restored[key] == expected[key], key
+                    assert restored["fired_rules"] == expected["fired_rules"]
+
+            assert engine.trail_depth == len(snapshots) - 1
+
+    print("Undo: OK")
+    db.close()
+
+
+def test_undo_then_continue():
+    """戻った後に別の回答をすると、最初からその回答をした場合と同じ質問になる"""
+    db = SessionLocal()
+
+    engine = InferenceEngine(db, "E")
+    first = engine.get_next_question()
+    answer_question(engine, first, True)
+    second = engine.get_next_question()
+    answer_question(engine, second, True)
+    engine.undo(2)
+    answer_question(engine, first, False)
+
+    fresh = InferenceEngine(db, "E")
+    answer_question(fresh, first, False)
+
+    assert engine.get_next_question() == fresh.get_next_question()
+    assert engine.facts == fresh.facts
+    assert engine.fired_rules == fresh.fired_rules
+    print("Undo then continue: OK")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_undo_matches_snapshots()
+        test_undo_then_continue()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
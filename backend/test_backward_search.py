@@ -0,0 +1,182 @@
+"""後向き推論の探索（明示的なスタック・共有の訪問済みの印・探索の上限）のテスト"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import compile_knowledge_base
+from app.services.question_cache import NextQuestionCache
+from rule_factories import make_engine, make_rule, random_knowledge_base
+
+
+def reference_question_for_goal(engine, goal, visited=None):
+    """以前の再帰版の探索（代替のルールごとに訪問済みの集合をコピーする）"""
+    if visited is None:
+        visited = set()
+    if goal in visited:
+        return None
+    visited.add(goal)
+    if engine._known >> goal & 1:
+        return None
+    rules = engine._get_rules_with_conclusion_id(goal)
+    if not rules:
+        return None
+    if not engine._asked >> goal & 1 and engine._get_question_priority(engine._fact_name(goal)) >= 80:
+        return goal
+
+    available_rules, uncertain_rules = [], []
+    for rule in rules:
+        if engine._fired >> rule.index & 1 or engine._is_rule_impossible(rule):
+            continue
+        (uncertain_rules if engine._has_unknown_conditions(rule) else available_rules).append(rule)
+    for rule in available_rules + uncertain_rules:
+        question = reference_question_for_rule(engine, rule, visited.copy())
+        if question is not None:
+            return question
+    return None
+
+
+def reference_question_for_rule(engine, rule, visited):
+    for condition in rule.conditions:
+        fact_id = condition.fact_id
+        if engine._known >> fact_id & 1 or engine._uncertain_known >> fact_id & 1:
+            continue
+        if engine._unknown >> fact_id & 1:
+            if engine._get_rules_with_conclusion_id(fact_id):
+                question = reference_question_for_goal(engine, fact_id, visited)
+                if question is not None:
+                    return question
+            continue
+        if engine._get_rules_with_conclusion_id(fact_id):
+            if not engine._asked >> fact_id & 1:
+                return fact_id
+            continue
+        return fact_id
+    return None
+
+
+def test_same_questions_as_recursive_search():
+    """ランダムな知識ベースとランダムな回答で、以前の再帰版と同じ質問を返す"""
+    rng = random.Random(0)
+    compared = 0
+    for _ in range(150):
+        rules, catalog = random_knowledge_base(rng)
+        kb, engine = make_engine(rules, catalog)
+        engine._get_applicable_rules()
+        for _ in range(12):
+            for goal in range(len(kb.fact_names)):
+                assert engine._find_question_for_goal(goal) == reference_question_for_goal(engine, goal)
+                compared += 1
+            fact_name = rng.choice(kb.fact_names)
+            if fact_name in engine.asked_questions:
+                continue
+            value = rng.choice([True, False, None])
+            if value is None:
+                engine.add_unknown_fact(fact_name)
+            else:
+                engine.add_fact(fact_name, value)
+                engine.forward_chain()
+        assert not engine._search_truncated
+
+    # 出荷している知識ベースでも、診断の各状態で同じ質問になる
+    db = SessionLocal()
+    for visa_type in ["E", "L", "B"]:
+        kb = compile_knowledge_base(db, visa_type)
+        engine = InferenceEngine(db, visa_type, knowledge_base=kb, question_cache=NextQuestionCache())
+        goal = engine._fact_id(engine.goal)
+        for step in range(40):
+            question = engine._find_question_for_goal(goal)
+            assert question == reference_question_for_goal(engine, goal)
+            compared += 1
+            if question is None:
+                break
+            value = rng.choice([True, False, None])
+            if value is None:
+                engine.add_unknown_fact(engine._fact_name(question))
+            else:
+                engine.add_fact(engine._fact_name(question), value)
+                engine.forward_chain()
+    db.close()
+    print(f"Same questions as the recursive search: {compared} searches")
+
+
+def deep_chain(depth):
+    """goal <- c1 <- c2 <- ... <- c{depth} <- 質問（全ての中間事実を「わからない」と回答済み）"""
+    rules = [make_rule("r0", [("c1", True)], "goal")]
+    for level in range(1, depth):
+        rules.append(make_rule(f"r{level}", [(f"c{level + 1}", True)], f"c{level}"))
+    rules.append(make_rule(f"r{depth}", [("question", True)], f"c{depth}"))
+    kb, engine = make_engine(rules)
+    for level in range(1, depth + 1):
+        engine.add_unknown_fact(f"c{level}")
+    return kb, engine
+
+
+def test_deep_and_wide_knowledge_bases():
+    """再帰の上限を超える深さのルールの連鎖と、広いORルールでも探索できる"""
+    depth = sys.getrecursionlimit() * 2
+    kb, engine = deep_chain(depth)
+    start = time.perf_counter()
+    assert engine._find_question_for_goal(kb.fact_ids["goal"]) == kb.fact_ids["question"]
+    print(f"Depth {depth}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # 広いORルール：多数の「わからない」と回答された導出可能な条件が、それぞれ多数の代替ルールを持ち、
+    # どれも質問に到達しない（以前の再帰版は代替のルールごとに訪問済みの集合をコピーしていた）
+    width, alternatives = 1500, 8
+    rules = [make_rule("wide", [(f"w{i}", True) for i in range(width)], "goal", "OR")]
+    for i in range(width):
+        for j in range(alternatives):
+            rules.append(make_rule(f"w{i}_{j}", [(f"x{i}_{j}", True)], f"w{i}"))
+    rules.append(make_rule("last", [("w0", True), ("question", True)], "goal"))  # 広いORルールの後に試される
+    kb, engine = make_engine(rules)
+    for i in range(width):
+        engine.add_unknown_fact(f"w{i}")
+        for j in range(alternatives):
+            engine.add_unknown_fact(f"x{i}_{j}")
+    goal = kb.fact_ids["goal"]
+    start = time.perf_counter()
+    assert engine._find_question_for_goal(goal) == kb.fact_ids["question"]
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    assert reference_question_for_goal(engine, goal) == kb.fact_ids["question"]
+    print(f"Width {width}x{alternatives}: {elapsed * 1000:.1f} ms (recursive: {(time.perf_counter() - start) * 1000:.1f} ms)")
+
+
+def test_search_budget_falls_back():
+    """探索の上限を超えたら線形走査の近似の質問を返し、その結果はキャッシュしない"""
+    kb, engine = deep_chain(500)
+    engine.goals = ["goal"]
+    engine.max_search_nodes = 100
+    assert engine.get_next_question() == "question"
+    assert engine._search_truncated and len(engine.question_cache) == 0
+
+    engine.max_search_nodes = 0
+    engine.max_search_seconds = 1e-9
+    assert engine.get_next_question() == "question"
+    assert engine._search_truncated and len(engine.question_cache) == 0
+
+    engine.max_search_seconds = 0
+    assert engine.get_next_question() == "question"
+    assert not engine._search_truncated and len(engine.question_cache) == 1
+
+    # 全ての条件が確定・回答済みなら、近似も質問なし
+    engine.add_fact("question", False)
+    engine.forward_chain()
+    assert engine._scan_question_for_goal(kb.fact_ids["goal"]) is None
+    print("Search budget: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_same_questions_as_recursive_search()
+        test_deep_and_wide_knowledge_bases()
+        test_search_budget_falls_back()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
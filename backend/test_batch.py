@@ -0,0 +1,160 @@
+"""一括診断（/api/consultation/batch）のテスト"""
+import csv
+import io
+import json
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+import batch_diagnose
+from app.main import app
+from app.models.database import SessionLocal
+from app.services.consultation_service import BATCH_MAX_CASES, SessionStore, diagnose_case
+from app.services.knowledge_base import knowledge_base_registry
+from app.services.question_catalog import question_catalog_registry
+
+
+def random_answers(db, visa_type, rng):
+    """対話で診断しながら回答を集める（一部の質問は未回答のまま残す）"""
+    session = SessionStore().create(db, visa_type)
+    result = session.start()
+    answers = {}
+    for step in range(30):
+        if not result["next_question"] or result["is_finished"]:
+            break
+        if rng.random() < 0.1:
+            break
+        value = rng.choice([True, False, None])
+        answers[session.current_question_fact] = value
+        result = session.answer(db, result["next_question"], value)
+    return answers, result
+
+
+def test_batch_matches_interactive():
+    """同じ回答で対話した結果と一括診断の結果が一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    catalog = question_catalog_registry.get(db)
+    knowledge_bases = {v: knowledge_base_registry.get(db, v) for v in ["E", "L", "B", "ALL"]}
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(50):
+            answers, interactive = random_answers(db, visa_type, rng)
+            batch = diagnose_case(visa_type, answers, knowledge_bases[visa_type], catalog)
+
+            assert batch["is_finished"] == interactive["is_finished"]
+            assert batch["next_question"] == (None if interactive["is_finished"] else interactive["next_question"])
+            if batch["is_finished"]:
+                assert batch["conclusions"] == interactive["conclusions"]
+                assert batch["all_conclusions"] == interactive.get("all_conclusions", {})
+                assert batch["insufficient_info"] == interactive["insufficient_info"]
+                if visa_type != "ALL":  # 対話の全ビザモードは不足している重要情報を返さない
+                    assert batch["missing_critical_info"] == interactive["missing_critical_info"]
+
+    print("Batch vs interactive: OK")
+    db.close()
+
+
+def test_batch_endpoint_streams_ndjson():
+    """1件ごとに1行のNDJSONが返る（全ビザモードを含む）"""
+    client = TestClient(app)
+    cases = [
+        {"case_id": "yes", "visa_type": "E", "answers": {}},
+        {"visa_type": "ALL", "answers": {}},
+        {"visa_type": "B", "answers": {}},
+    ]
+    first = client.post("/api/consultation/start", json={"visa_type": "E"}).json()["next_question"]
+    cases[0]["answers"] = {first: True}
+
+    response = client.post("/api/consultation/batch", json={"cases": cases})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["case_id"] for line in lines] == ["yes", "1", "2"]
+    assert lines[0]["next_question"] != first
+    assert lines[1]["current_visa_type"] == "E"
+    for line in lines:
+        assert line["is_finished"] or line["next_question"]
+    print(f"Batch endpoint: {len(lines)} results")
+
+
+def test_batch_endpoint_rejects_bad_cases():
+    """不明なビザタイプの件はその行のエラーになり（知識ベースを作らない）、件数の上限を超えると422"""
+    client = TestClient(app)
+    cases = [{"visa_type": "X", "answers": {}}, {"visa_type": "E", "answers": {}}]
+    response = client.post("/api/consultation/batch", json={"cases": cases})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0]["error"] == "Unknown visa_type: X" and "conclusions" not in lines[0]
+    assert "error" not in lines[1] and lines[1]["next_question"]
+    assert "X" not in knowledge_base_registry._current
+
+    cases = [{"visa_type": "E", "answers": {}}] * (BATCH_MAX_CASES + 1)
+    assert client.post("/api/consultation/batch", json={"cases": cases}).status_code == 422
+    print("Batch endpoint: unknown visa_type and size limit rejected")
+
+
+def test_cli_jsonl_and_csv():
+    """CLI（JSONL/CSV入力、複数プロセス）の結果が diagnose_case と一致し、入力順に並ぶ"""
+    db = SessionLocal()
+    rng = random.Random(1)
+    catalog = question_catalog_registry.get(db)
+    knowledge_bases = {v: knowledge_base_registry.get(db, v) for v in ["E", "L", "B", "ALL"]}
+
+    cases = []
+    for index in range(40):
+        visa_type = ["E", "B", "ALL"][index % 3]
+        answers, _ = random_answers(db, visa_type, rng)
+        cases.append({"case_id": f"case-{index}", "visa_type": visa_type, "answers": answers})
+    expected = [
+        {"case_id": case["case_id"], **diagnose_case(case["visa_type"], case["answers"], knowledge_bases[case["visa_type"]], catalog)}
+        for case in cases
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jsonl_path = Path(tmp) / "cases.jsonl"
+        jsonl_path.write_text("".join(json.dumps(c, ensure_ascii=False) + "\n" for c in cases), encoding="utf-8")
+
+        for workers in [1, 2]:
+            output = io.StringIO()
+            count = batch_diagnose.run(
+                batch_diagnose.read_cases(str(jsonl_path), "jsonl", "ALL"), output, workers, chunk_size=7
+            )
+            assert count == len(cases)
+            assert [json.loads(line) for line in output.getvalue().splitlines()] == expected
+
+        # CSV：回答の列は fact_name、空欄は未回答
+        fact_names = sorted({f for c in cases for f in c["answers"]})
+        csv_path = Path(tmp) / "cases.csv"
+        labels = {True: "はい", False: "いいえ", None: "分からない"}
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["case_id", "visa_type"] + fact_names)
+            for case in cases:
+                values = [labels[case["answers"][f]] if f in case["answers"] else "" for f in fact_names]
+                writer.writerow([case["case_id"], case["visa_type"]] + values)
+
+        output = io.StringIO()
+        batch_diagnose.run(batch_diagnose.read_cases(str(csv_path), "csv", "ALL"), output, 1, chunk_size=7)
+        assert [json.loads(line) for line in output.getvalue().splitlines()] == expected
+
+    print(f"CLI: {len(cases)} cases OK")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_batch_matches_interactive()
+        test_batch_endpoint_streams_ndjson()
+        test_batch_endpoint_rejects_bad_cases()
+        test_cli_jsonl_and_csv()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
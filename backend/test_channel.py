@@ -0,0 +1,175 @@
+"""診断のWebSocketチャネル（/api/consultation/ws）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.api import consultation as consultation_api
+from app.main import app
+from app.services.knowledge_base import knowledge_base_registry
+from app.services.session_template import session_template_registry
+
+
+def test_channel_matches_http():
+    """チャネルの応答（診断結果と可視化の差分）が、HTTPの /answer と /visualization/status と一致する"""
+    client = TestClient(app)
+    rng = random.Random(0)
+
+    for visa_type in ["E", "B", "ALL"]:
+        with client.websocket_connect("/api/consultation/ws") as ws:
+            ws.send_json({"type": "start", "visa_type": visa_type, "id": 1})
+            reply = ws.receive_json()
+            assert reply["type"] == "start" and reply["id"] == 1
+            assert reply["visualization"]["full"]
+
+            # 同じ回答をHTTPで送るセッション
+            http = client.post("/api/consultation/start", json={"visa_type": visa_type}).json()
+            http_session = http["session_id"]
+            http_version = client.get(
+                "/api/consultation/visualization/status", params={"session_id": http_session}
+            ).json()["version"]
+            assert reply["consultation"]["next_question"] == http["next_question"]
+
+            result = reply["consultation"]
+            for step in range(20):
+                if result["is_finished"] or not result["next_question"]:
+                    break
+                if step > 2 and rng.random() < 0.2:
+                    ws.send_json({"type": "back", "id": step})
+                    reply = ws.receive_json()
+                    back = client.post("/api/consultation/back", json={"session_id": http_session}).json()
+                    assert reply["current_question"] == back["current_question"]
+                    question = back["current_question"]
+                else:
+                    question = result["next_question"]
+
+                value = rng.choice([True, False, None])
+                ws.send_json({"type": "answer", "question": question, "answer": value, "id": step})
+                reply = ws.receive_json()
+                assert reply["id"] == step
+                http = client.post(
+                    "/api/consultation/answer",
+                    json={"session_id": http_session, "question": question, "answer": value},
+                ).json()
+                result = reply["consultation"]
+                assert {k: v for k, v in result.items() if k != "session_id"} == {
+                    k: v for k, v in http.items() if k != "session_id"
+                }
+
+                status = client.get(
+                    "/api/consultation/visualization/status",
+                    params={"session_id": http_session, "since": http_version},
+                )
+                if status.status_code == 304:
+                    assert reply["visualization"] is None
+                    continue
+                status = status.json()
+                http_version = status["version"]
+                assert reply["visualization"]["rules"] == status["rules"]
+                assert reply["visualization"]["fired_rules"] == status["fired_rules"]
+    print("Channel vs HTTP: OK")
+
+
+def test_channel_errors():
+    """不正なメッセージにはエラーを返し、接続は維持する"""
+    client = TestClient(app)
+    with client.websocket_connect("/api/consultation/ws") as ws:
+        ws.send_json({"type": "answer", "question": "x", "answer": True, "id": "a"})
+        reply = ws.receive_json()
+        assert reply["type"] == "error" and reply["id"] == "a"
+
+        ws.send_text("not json")
+        assert ws.receive_json()["type"] == "error"
+
+        ws.send_json({"type": "unknown"})
+        assert ws.receive_json()["type"] == "error"
+
+        ws.send_json({"type": "start", "visa_type": "E"})
+        start = ws.receive_json()
+        assert start["type"] == "start" and start["consultation"]["next_question"]
+
+        # 別の接続からセッションを再開できる
+        with client.websocket_connect("/api/consultation/ws") as other:
+            other.send_json({"type": "resume", "session_id": start["session_id"]})
+            resumed = other.receive_json()
+            assert resumed["type"] == "resume" and resumed["visualization"]["full"]
+    print("Channel errors: OK")
+
+
+def test_resent_answer_is_not_applied_twice():
+    """チャネルで反映済みの回答・戻る操作をHTTPで再送しても（応答が届かなかった場合）、同じ step なら繰り返さない"""
+    client = TestClient(app)
+    with client.websocket_connect("/api/consultation/ws") as ws:
+        ws.send_json({"type": "start", "visa_type": "E"})
+        start = ws.receive_json()
+        session_id, result = start["session_id"], start["consultation"]
+        for _ in range(3):
+            message = {"question": result["next_question"], "answer": True, "step": result["step"]}
+            ws.send_json({"type": "answer", **message})
+            result = ws.receive_json()["consultation"]
+            resent = client.post("/api/consultation/answer", json={"session_id": session_id, **message}).json()
+            assert resent == {**result, "session_id": session_id}
+        assert result["step"] == 3
+
+        ws.send_json({"type": "back", "step": result["step"]})
+        back = ws.receive_json()
+        assert back["step"] == 2
+        resent = client.post("/api/consultation/back", json={"session_id": session_id, "step": result["step"]}).json()
+        assert resent == {"current_question": back["current_question"], "step": 2}
+        ws.send_json({"type": "answer", "question": back["current_question"], "answer": False, "step": back["step"]})
+        assert ws.receive_json()["consultation"]["step"] == 3
+    print("Resent answer: applied once")
+
+
+def test_channel_survives_unexpected_errors():
+    """メッセージの処理中の予期しないエラーはエラーの応答になり、接続は維持する"""
+    client = TestClient(app)
+    handle = consultation_api._handle_channel_message
+
+    def fail(db, channel, message):
+        raise RuntimeError("boom")
+
+    with client.websocket_connect("/api/consultation/ws") as ws:
+        consultation_api._handle_channel_message = fail
+        try:
+            ws.send_json({"type": "start", "visa_type": "E", "id": 1})
+            reply = ws.receive_json()
+        finally:
+            consultation_api._handle_channel_message = handle
+        assert reply == {"type": "error", "detail": "Internal server error", "id": 1}
+
+        ws.send_json({"type": "start", "visa_type": "E", "id": 2})
+        assert ws.receive_json()["type"] == "start"
+    print("Channel unexpected error: connection kept")
+
+
+def test_unknown_visa_type_rejected():
+    """不明なビザタイプは422（チャネルではエラー）で拒否し、知識ベース・テンプレートのレジストリに入れない"""
+    client = TestClient(app)
+    for visa_type in ["X", "e", "ALLX"]:
+        assert client.post("/api/consultation/start", json={"visa_type": visa_type}).status_code == 422
+        assert client.get(f"/api/consultation/graph/{visa_type}/v1").status_code == 422
+        with client.websocket_connect("/api/consultation/ws") as ws:
+            ws.send_json({"type": "start", "visa_type": visa_type})
+            assert ws.receive_json()["type"] == "error"
+        assert visa_type not in knowledge_base_registry._current
+        assert visa_type not in session_template_registry._templates
+    assert client.post("/api/consultation/start", json={"visa_type": "ALL"}).status_code == 200
+    print("Unknown visa_type: rejected")
+
+
+if __name__ == "__main__":
+    try:
+        test_channel_matches_http()
+        test_channel_errors()
+        test_resent_answer_is_not_applied_twice()
+        test_channel_survives_unexpected_errors()
+        test_unknown_visa_type_rejected()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,71 @@
+"""事実ID（整数化）とビットセットによる事実の状態のテスト"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import compile_knowledge_base
+
+
+def test_fact_ids_are_deterministic():
+    """同じルールからは同じ事実IDが割り当てられ、条件のビットマスクと一致する"""
+    db = SessionLocal()
+
+    for visa_type in ["E", "B"]:
+        first = compile_knowledge_base(db, visa_type)
+        second = compile_knowledge_base(db, visa_type)
+        assert first.fact_names == second.fact_names
+        assert len(set(first.fact_names)) == len(first.fact_names)
+
+        for rule in first.rules:
+            assert first.fact_names[rule.conclusion_id] == rule.conclusion
+            mask = 0
+            for condition in rule.conditions:
+                assert first.fact_names[condition.fact_id] == condition.fact_name
+                mask |= 1 << condition.fact_id
+                assert rule.index in first.rules_by_fact[condition.fact_id]
+            assert mask == rule.condition_mask
+        print(f"{visa_type}: {len(first.fact_names)} facts, {len(first.rules)} rules")
+
+    db.close()
+
+
+def test_fact_views():
+    """facts などは fact_name で参照できる読み取り専用ビューとして振る舞う"""
+    db = SessionLocal()
+
+    engine = InferenceEngine(db, "E")
+    first = engine.get_next_question()
+    engine.add_fact(first, True)
+    engine.add_fact("ルールに出てこない事実", False)  # 知識ベース外の事実
+    engine.add_uncertain_fact("ルールに出てこない別の事実", True)
+    engine.forward_chain()
+
+    assert engine.facts == {first: True, "ルールに出てこない事実": False}
+    assert engine.facts["ルールに出てこない事実"] is False
+    assert "存在しない事実" not in engine.facts
+    assert engine.facts.get("存在しない事実") is None
+    assert engine.uncertain_facts == {"ルールに出てこない別の事実": True}
+    assert engine.unknown_facts == {"ルールに出てこない別の事実"}
+    assert engine.asked_questions == {first, "ルールに出てこない事実", "ルールに出てこない別の事実"}
+    assert len(engine.derived_facts) == 0
+
+    # 別のエンジンの知識ベース外の事実IDは共有されない
+    other = InferenceEngine(db, "E")
+    assert "ルールに出てこない事実" not in other.facts
+    assert other.get_next_question() == first
+    print("Fact views: OK")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_fact_ids_are_deterministic()
+        test_fact_views()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,82 @@
+"""次の質問の先読み（lookahead）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models.database import SessionLocal
+from app.services.consultation_service import LOOKAHEAD_ANSWERS, SessionStore
+
+
+def engine_state(engine):
+    return (
+        engine.save_snapshot(),
+        engine._fingerprint,
+        set(engine._agenda),
+        engine.trail_depth,
+        engine._changed_facts,
+        engine._changed_rules,
+    )
+
+
+def test_lookahead_predicts_next_question():
+    """先読みした次の質問が実際に回答した後の次の質問と一致し、先読みで状態が変わらない"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    checked = 0
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(20):
+            session = SessionStore().create(db, visa_type)
+            result = session.start(lookahead=True)
+            for step in range(25):
+                if result["is_finished"] or not result["next_question"]:
+                    break
+                before = engine_state(session.engine)
+                lookahead = session.get_lookahead(session.current_question_fact)
+                assert engine_state(session.engine) == before
+                assert lookahead == result["lookahead"]
+
+                key, value = rng.choice(LOOKAHEAD_ANSWERS)
+                result = session.answer(db, result["next_question"], value, lookahead=True)
+                predicted = lookahead[key]
+                assert predicted["is_finished"] == (result["next_question"] is None)
+                assert predicted["next_question"] == result["next_question"]
+                if not predicted["is_finished"]:
+                    assert predicted["is_derivable"] == result["is_derivable"]
+                checked += 1
+
+    print(f"Lookahead: {checked} answers predicted")
+    db.close()
+
+
+def test_lookahead_endpoint():
+    """lookahead を指定した場合のみ先読みを返す"""
+    client = TestClient(app)
+    start = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+    assert start["lookahead"] is None
+
+    start = client.post("/api/consultation/start", json={"visa_type": "E", "lookahead": True}).json()
+    assert set(start["lookahead"]) == {"yes", "no", "unknown"}
+
+    result = client.post(
+        "/api/consultation/answer",
+        json={"session_id": start["session_id"], "question": start["next_question"], "answer": True, "lookahead": True},
+    ).json()
+    assert result["next_question"] == start["lookahead"]["yes"]["next_question"]
+    print("Lookahead endpoint: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_lookahead_predicts_next_question()
+        test_lookahead_endpoint()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,105 @@
+"""全ビザモード（1つのエンジンで全ビザタイプのゴールを同時に追う）のテスト"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import SessionStore
+from app.services.knowledge_base import compile_knowledge_base
+from rule_factories import make_engine, make_rule
+
+
+def shared_condition_engine():
+    # E と B のゴールが「共通」を条件に持つ
+    rules = [
+        make_rule("e1", ["E固有", "共通"], "Eビザでの申請ができます", visa_type="E"),
+        make_rule("b1", ["共通", "B固有"], "Bビザでの申請ができます", visa_type="B"),
+    ]
+    return make_engine(rules, visa_type="ALL")[1]
+
+
+def answer_all(engine, answers):
+    asked = []
+    question = engine.get_next_question()
+    while question is not None:
+        asked.append(question)
+        engine.add_fact(question, answers[question])
+        engine.forward_chain()
+        question = engine.get_next_question()
+    engine.finalize_diagnosis()
+    return asked
+
+
+def test_shared_question_first():
+    """より多くのゴールを前進させる質問から聞く"""
+    engine = shared_condition_engine()
+    assert engine.get_next_question() == "共通"
+    assert engine.get_question_visa_type("共通") == "E"
+    assert engine.get_question_visa_type("B固有") == "B"
+
+    asked = answer_all(engine, {"共通": True, "E固有": True, "B固有": True})
+    assert asked == ["共通", "E固有", "B固有"]
+    assert engine.get_conclusions_by_visa_type() == {
+        "E": ["Eビザでの申請ができます"],
+        "L": [],
+        "B": ["Bビザでの申請ができます"],
+    }
+
+    # 共通の条件が満たされなければ、1問で全てのゴールの判定が終わる
+    engine = shared_condition_engine()
+    assert answer_all(engine, {"共通": False}) == ["共通"]
+    assert engine.get_conclusions() == []
+    print("Shared question first: OK")
+
+
+def test_union_knowledge_base():
+    """ALLの知識ベースは全ビザタイプのルールの和集合で、ゴールの到達範囲は各ビザタイプのルールに対応する"""
+    db = SessionLocal()
+    union = compile_knowledge_base(db, "ALL")
+    per_visa = {v: compile_knowledge_base(db, v) for v in ["E", "L", "B"]}
+    assert sorted(r.rule_id for r in union.rules) == sorted(r.rule_id for kb in per_visa.values() for r in kb.rules)
+
+    def cone_names(kb):
+        cone = kb.cone_mask(kb.fact_ids["Eビザでの申請ができます"])
+        return {fact_name for fact_id, fact_name in enumerate(kb.fact_names) if cone >> fact_id & 1}
+
+    cone = cone_names(union)
+    assert cone == cone_names(per_visa["E"])
+    assert "Eビザでの申請ができます" in cone
+    print(f"Union knowledge base: {len(union.rules)} rules, E cone {len(cone)} facts")
+    db.close()
+
+
+def test_all_mode_session():
+    """全ビザモードのセッションは1つのエンジンで診断し、終了時にビザタイプごとの結論を返す"""
+    db = SessionLocal()
+    session = SessionStore().create(db, "ALL")
+    result = session.start()
+    assert result["all_visa_mode"] and result["current_visa_type"] == "E"
+
+    history = []
+    while not result["is_finished"]:
+        history.append(result["next_question"])
+        result = session.answer(db, result["next_question"], True)
+    assert set(result["all_conclusions"]) == {"E", "L", "B"}
+    assert "Eビザでの申請ができます" in result["all_conclusions"]["E"]
+
+    # 戻ると1つのエンジンのトレイルが戻り、最初の質問から診断し直せる
+    session.back(db, steps=len(history))
+    assert session.current_question_fact == session.engine.get_next_question()
+    assert not session.engine.asked_questions
+    print(f"ALL mode session: {len(history)} questions")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_shared_question_first()
+        test_union_knowledge_base()
+        test_all_mode_session()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,75 @@
+"""次の質問のキャッシュ（状態のフィンガープリント）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import answer_question
+from app.services.inference_engine import InferenceEngine
+from app.services.question_cache import NextQuestionCache
+
+
+def test_fingerprint_is_maintained_incrementally():
+    """回答・取り消し・アンドゥの後も、差分で更新したフィンガープリントが再計算と一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+
+    for visa_type in ["E", "B"]:
+        for _ in range(30):
+            engine = InferenceEngine(db, visa_type, question_cache=NextQuestionCache(0))
+            engine._get_applicable_rules()
+            start = engine._compute_fingerprint()
+            answers = []
+            for step in range(20):
+                fact_name = engine.get_next_question()
+                if fact_name is None:
+                    break
+                answer_question(engine, fact_name, rng.choice([True, False, None]))
+                answers.append(fact_name)
+                assert engine._fingerprint == engine._compute_fingerprint()
+
+            if answers and rng.random() < 0.5:
+                engine.push_frame()
+                engine.remove_fact(rng.choice(answers))
+                assert engine._fingerprint == engine._compute_fingerprint()
+            engine.undo(engine.trail_depth)
+            assert engine._fingerprint == start
+
+    print("Fingerprint: OK")
+    db.close()
+
+
+def test_cached_questions_match_search():
+    """キャッシュを共有した複数セッションの質問が、キャッシュなしの探索結果と一致する"""
+    db = SessionLocal()
+    cache = NextQuestionCache()
+
+    for seed in range(60):
+        rng = random.Random(seed % 20)  # 同じ回答パターンを繰り返してキャッシュに当てる
+        cached = InferenceEngine(db, "E", question_cache=cache)
+        uncached = InferenceEngine(db, "E", question_cache=NextQuestionCache(0))
+        for step in range(20):
+            fact_name = cached.get_next_question()
+            assert fact_name == uncached.get_next_question()
+            if fact_name is None:
+                break
+            value = rng.choice([True, False, None])
+            answer_question(cached, fact_name, value)
+            answer_question(uncached, fact_name, value)
+
+    assert cache.hits > 0
+    print(f"Cache: {len(cache)} entries, {cache.hits} hits, {cache.misses} misses")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_fingerprint_is_maintained_incrementally()
+        test_cached_questions_match_search()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,105 @@
+"""質問カタログ（fact_name・質問文・優先度の検索、バージョン、レジストリのキャッシュと無効化）のテスト"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models import schemas
+from app.services.admin_service import AdminService
+from app.services.knowledge_base import knowledge_base_registry
+from app.services.question_catalog import QuestionCatalog, QuestionCatalogRegistry, QuestionEntry, question_catalog_registry
+from app.services.session_template import session_template_registry
+from test_admin_invalidation import make_database
+
+
+def test_catalog_lookup():
+    """fact_name と質問文の双方向の検索・優先度（未定義の質問はそのまま・優先度0）"""
+    catalog = QuestionCatalog([
+        QuestionEntry("a", "Aですか", "E", 10),
+        QuestionEntry("b", "Bですか", "E", 0),
+        QuestionEntry("c", "Aですか", "L", 5),  # 同じ質問文は最初のものを使う
+        QuestionEntry("a", "Aの別の質問", "L", 99),  # 同じ fact_name も最初のものを使う
+    ])
+    assert catalog.get_question_text("a") == "Aですか"
+    assert catalog.get_question_text("c") == "Aですか"
+    assert catalog.get_question_text("missing") == "missing"
+    assert catalog.get_fact_name("Aですか") == "a"
+    assert catalog.get_fact_name("Bですか") == "b"
+    assert catalog.get_fact_name("未定義の質問") == "未定義の質問"
+    assert catalog.get_priority("a") == 10 and catalog.get_priority("missing") == 0
+
+    # バージョンは内容から決まる
+    same = QuestionCatalog([QuestionEntry("a", "Aですか", "E", 10), QuestionEntry("b", "Bですか", "E", 0)])
+    assert same.version == QuestionCatalog([QuestionEntry("a", "Aですか", "E", 10), QuestionEntry("b", "Bですか", "E", 0)]).version
+    assert same.version != QuestionCatalog([QuestionEntry("a", "Aですか", "E", 11), QuestionEntry("b", "Bですか", "E", 0)]).version
+    assert same.version != catalog.version
+
+    # 読み取り専用
+    try:
+        catalog.by_fact_name["x"] = None
+        assert False, "catalog should be read-only"
+    except TypeError:
+        pass
+    print("Catalog lookup: OK")
+
+
+def test_registry_caches_until_ttl():
+    """レジストリは TTL の間は同じカタログを返し、期限切れ・無効化の後は読み込み直す"""
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, db, _ = make_database(os.path.join(tmp, "catalog.db"))
+        try:
+            registry = QuestionCatalogRegistry(ttl_seconds=0.05)
+            first = registry.get(db)
+            assert registry.get(db) is first
+            assert first.get_fact_name("Aですか") == "a" and first.get_question_text("b") == "Bですか"
+
+            time.sleep(0.06)
+            second = registry.get(db)
+            assert second is not first and second.version == first.version
+
+            registry.invalidate()
+            assert registry.get(db) is not second
+        finally:
+            db.close()
+            engine.dispose()
+    print("Registry cache: OK")
+
+
+def test_question_edit_invalidates_catalog():
+    """質問の編集後の get() は新しいバージョンの質問カタログを返す"""
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, db, _ = make_database(os.path.join(tmp, "admin.db"))
+        try:
+            before = question_catalog_registry.get(db)
+            assert question_catalog_registry.get(db) is before
+            question = next(q for q in AdminService(db).get_questions("E") if q.fact_name == "a")
+
+            AdminService(db).update_question(question.id, schemas.QuestionUpdate(question_text="Aでしょうか"))
+            after = question_catalog_registry.get(db)
+            assert after is not before and after.version != before.version
+            assert after.get_question_text("a") == "Aでしょうか"
+
+            AdminService(db).delete_question(question.id)
+            assert question_catalog_registry.get(db).version not in (before.version, after.version)
+        finally:
+            knowledge_base_registry.invalidate()
+            question_catalog_registry.invalidate()
+            session_template_registry.clear()
+            db.close()
+            engine.dispose()
+    print("Question edit: catalog reloaded")
+
+
+if __name__ == "__main__":
+    try:
+        test_catalog_lookup()
+        test_registry_caches_until_ttl()
+        test_question_edit_invalidates_catalog()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,151 @@
+"""条件を共有するネットワーク（Rete/TREAT方式の照合）のテスト: ルールごとの評価との一致（ベンチマークは benchmark_rules.py）"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import KnowledgeBase, compile_knowledge_base
+from app.services.question_cache import NextQuestionCache
+from app.services.rete_matcher import ReteNetwork
+from app.services.rule_compiler import interpret_conditions_hold, interpret_is_impossible
+from rule_factories import make_engine, make_rule, random_knowledge_base, shared_knowledge_base
+
+
+def matcher_engine(kb, matcher, catalog=None):
+    engine = make_engine(kb, catalog, question_cache=NextQuestionCache(0), matcher=matcher)[1]
+    engine._get_applicable_rules()
+    return engine
+
+
+def assert_matches_rules(engine):
+    """ネットワークの満たされた・発火不可能なルールが、ルールごとの評価と一致する"""
+    known, values = engine._known, engine._values
+    holds = sum(1 << rule.index for rule in engine.all_rules if interpret_conditions_hold(rule, known, values))
+    dead = sum(1 << rule.index for rule in engine.all_rules if interpret_is_impossible(rule, known, values))
+    assert engine._rete.holds == holds and engine._rete.dead == engine._dead == dead
+
+
+def test_network_follows_state():
+    """回答・取り消し・アンドゥ・復元・複製・先読みの後も、ネットワークの状態がルールごとの評価と一致する"""
+    rng = random.Random(0)
+    checked = 0
+    for trial in range(80):
+        if trial % 4 == 0:
+            kb, _ = shared_knowledge_base(rng, groups=4, rules_per_group=6, fact_count=40)
+            catalog = None
+        else:
+            rules, catalog = random_knowledge_base(rng)
+            kb = KnowledgeBase("T", rules)
+        engine = matcher_engine(kb, "rete", catalog)
+        assert_matches_rules(engine)
+        snapshots = []
+        for step in range(30):
+            operation = rng.random()
+            fact_name = rng.choice(kb.fact_names)
+            if operation < 0.5:
+                engine.push_frame()
+                engine.add_fact(fact_name, rng.random() < 0.5)
+                engine.forward_chain()
+            elif operation < 0.65 and fact_name in engine.asked_questions:
+                engine.push_frame()
+                engine.remove_fact(fact_name)
+            elif operation < 0.8:
+                engine.undo(rng.randint(1, 3))
+            elif operation < 0.9:
+                with engine.speculate():
+                    engine.add_fact(fact_name, True)
+                    engine.forward_chain()
+                    assert_matches_rules(engine)
+            elif snapshots and operation < 0.95:
+                engine.restore_snapshot(rng.choice(snapshots))
+            else:
+                clone = engine.clone()
+                assert clone._rete is not engine._rete and clone._rete.satisfied is not engine._rete.satisfied
+                engine = clone
+            snapshots.append(engine.save_snapshot())
+            assert_matches_rules(engine)
+            checked += 1
+    print(f"Network state: {checked} states")
+
+
+def test_same_results_as_naive_matcher():
+    """同じ回答の列に、ルールごとの評価（naive）と同じ発火・質問・結論になる"""
+    rng = random.Random(1)
+    compared = 0
+    knowledge_bases = []
+    for _ in range(40):
+        rules, catalog = random_knowledge_base(rng)
+        knowledge_bases.append((KnowledgeBase("T", rules), catalog))
+    for _ in range(5):
+        knowledge_bases.append((shared_knowledge_base(rng, groups=6, rules_per_group=8, fact_count=60)[0], None))
+    db = SessionLocal()
+    for visa_type in ["E", "L", "B", "ALL"]:
+        knowledge_bases.append((compile_knowledge_base(db, visa_type), None))
+
+    for kb, catalog in knowledge_bases:
+        for _ in range(5):
+            seed = rng.random()
+            results = []
+            for matcher in ("naive", "rete"):
+                if kb.visa_type == "T":
+                    engine = matcher_engine(kb, matcher, catalog)
+                    engine.goals = [kb.fact_names[0]]
+                else:
+                    engine = InferenceEngine(
+                        db, kb.visa_type, knowledge_base=kb, question_cache=NextQuestionCache(0), matcher=matcher
+                    )
+                answers = random.Random(seed)
+                questions = []
+                for _ in range(30):
+                    question = engine.get_next_question()
+                    if question is None:
+                        question = answers.choice(kb.fact_names)
+                    questions.append(question)
+                    value = answers.choice([True, False, None])
+                    if value is None:
+                        engine.add_unknown_fact(question)
+                    else:
+                        engine.add_fact(question, value)
+                    engine.forward_chain()
+                results.append((questions, engine.fired_rules, engine.save_snapshot(), engine._dead, engine.get_conclusions()))
+            assert results[0] == results[1]
+            compared += 1
+    db.close()
+    print(f"Same results as the naive matcher: {compared} consultations")
+
+
+def test_network_shares_conditions():
+    """共通の条件の集合はノードを共有し、ネットワークの入力数はルールの条件の総数より少ない"""
+    rules = [
+        make_rule("a", [("x", True), ("y", True), ("z", True)], "c1"),
+        make_rule("b", [("x", True), ("y", True), ("w", False)], "c2"),
+        make_rule("c", [("x", True), ("y", True)], "c3"),
+        make_rule("d", [("x", True), ("y", True)], "c4", "OR"),  # 演算子が違うルールとは共有しない
+    ]
+    network = ReteNetwork(KnowledgeBase("T", rules))
+    # AND: {x,y}（c の終端）-> {z}（a）, {w}（b）、OR: {x,y}（d）
+    assert network.node_count == 4 and network.condition_evaluations() == 2 + 2 + 2 + 2
+    shared = next(node for node, rules in enumerate(network.node_rules) if rules == (2,))
+    assert len(network.node_children[shared]) == 2
+
+    rng = random.Random(2)
+    kb, _ = shared_knowledge_base(rng)
+    network = ReteNetwork(kb)
+    conditions = sum(bin(rule.condition_mask).count("1") for rule in kb.rules)
+    print(f"Shared network: {len(kb.rules)} rules, {conditions} conditions -> {network.node_count} nodes, {network.condition_evaluations()} inputs")
+    assert network.condition_evaluations() < conditions * 0.8
+
+
+if __name__ == "__main__":
+    try:
+        test_network_follows_state()
+        test_same_results_as_naive_matcher()
+        test_network_shares_conditions()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,121 @@
+"""事実の取り消し（remove_fact）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import answer_question
+from app.services.inference_engine import InferenceEngine
+
+
+def random_consultation(db, visa_type, rng):
+    """
+    ランダムに回答して診断を進める
+
+    導出可能な質問には「分からない」と答え、個別の条件まで掘り下げる
+    """
+    engine = InferenceEngine(db, visa_type)
+    answers = []
+    for step in range(30):
+        fact_name = engine.get_next_question()
+        if fact_name is None:
+            break
+        value = None if engine._is_derivable(fact_name) else rng.choice([True, False])
+        answer_question(engine, fact_name, value)
+        answers.append((fact_name, value))
+    return engine, answers
+
+
+def run_answers(db, visa_type, answers):
+    """回答を順に反映したエンジンを返す"""
+    engine = InferenceEngine(db, visa_type)
+    for fact_name, value in answers:
+        answer_question(engine, fact_name, value)
+    return engine
+
+
+def test_remove_matches_recomputation():
+    """回答を1つ取り消した結果が、その回答をしなかった場合と一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    checked = 0
+
+    for visa_type in ["E", "B"]:
+        for _ in range(50):
+            engine, answers = random_consultation(db, visa_type, rng)
+            if not engine.fired_rules:
+                continue
+
+            removed = rng.choice([a for a in answers if a[1] is not None])
+            engine.remove_fact(removed[0])
+            expected = run_answers(db, visa_type, [a for a in answers if a != removed])
+
+            assert engine.facts == expected.facts, removed
+            assert engine.derived_facts == expected.derived_facts, removed
+            assert set(engine.fired_rules) == set(expected.fired_rules), removed
+            assert engine.get_next_question() == expected.get_next_question(), removed
+            checked += 1
+
+    print(f"Remove: OK ({checked} cases)")
+    db.close()
+
+
+def test_remove_keeps_independent_conclusions():
+    """取り消した事実に依存しない結論と発火ルールは残る"""
+    db = SessionLocal()
+    rng = random.Random(1)
+    kept_cases = 0
+
+    for _ in range(50):
+        engine, answers = random_consultation(db, "E", rng)
+        if len(engine.fired_rules) < 2:
+            continue
+
+        removed = [fact_name for fact_name, value in answers if value is not None][-1]
+        fired_before = list(engine.fired_rules)
+        engine.remove_fact(removed)
+        # 最後の回答に依存しないルールは発火済みのまま（順序も保たれる）
+        kept = [r for r in fired_before if r in engine.fired_rules]
+        assert engine.fired_rules[:len(kept)] == kept
+        assert removed not in engine.facts
+        if kept:
+            kept_cases += 1
+
+    assert kept_cases > 0
+    print(f"Kept independent rules in {kept_cases} cases")
+    db.close()
+
+
+def test_remove_can_be_undone():
+    """remove_fact の変更もトレイルから取り消せる"""
+    db = SessionLocal()
+
+    rng = random.Random(2)
+
+    for _ in range(20):
+        engine, answers = random_consultation(db, "E", rng)
+        before = engine.save_snapshot()
+        engine.push_frame()
+        for fact_name, value in answers[:3]:
+            engine.remove_fact(fact_name)
+        engine.undo()
+        after = engine.save_snapshot()
+        for key in before:
+            assert after[key] == before[key], key
+        assert engine.get_next_question() == run_answers(db, "E", answers).get_next_question()
+    print("Remove undo: OK")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_remove_matches_recomputation()
+        test_remove_keeps_independent_conclusions()
+        test_remove_can_be_undone()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,206 @@
+"""知識ベースのバージョンごとに生成するルールの評価関数（生成したコードと汎用の評価の一致・ディスクキャッシュ）のテスト"""
+import importlib.util
+import marshal
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import KnowledgeBase, compile_knowledge_base
+from app.services.question_cache import NextQuestionCache
+from app.services.rule_compiler import (
+    RULE_EVALUATOR_CACHE_DIR,
+    RuleEvaluatorRegistry,
+    compile_rule_evaluators,
+    generate_rule_source,
+    interpret_conditions_hold,
+    interpret_is_impossible,
+    interpreted_evaluators,
+    RULE_EVALUATORS,
+    rule_evaluator_registry,
+)
+from rule_factories import make_rule, random_knowledge_base
+
+
+def random_states(rng, fact_count, count):
+    """ランダムな (known, values)。既知でない事実の値のビットは0（エンジンと同じ）"""
+    for _ in range(count):
+        known = rng.getrandbits(fact_count) & rng.getrandbits(fact_count)
+        yield known, rng.getrandbits(fact_count) & known
+
+
+def assert_same_as_interpreted(kb, evaluators, rng, count):
+    fact_count = len(kb.fact_names)
+    states = [(0, 0), ((1 << fact_count) - 1, 0), ((1 << fact_count) - 1, (1 << fact_count) - 1)]
+    states += random_states(rng, fact_count, count)
+    for known, values in states:
+        for rule in kb.rules:
+            assert evaluators.holds[rule.index](known, values) == interpret_conditions_hold(rule, known, values), rule.rule_id
+            assert evaluators.impossible[rule.index](known, values) == interpret_is_impossible(rule, known, values), rule.rule_id
+    return len(states) * len(kb.rules)
+
+
+def test_generated_matches_interpreted():
+    """生成したコードが、ランダムな知識ベースと出荷している知識ベースの全ての状態で汎用の評価と一致する"""
+    rng = random.Random(0)
+    checked = 0
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(100):
+            rules, _ = random_knowledge_base(rng)
+            kb = KnowledgeBase("T", rules)
+            evaluators = compile_rule_evaluators(kb, cache_dir)
+            assert evaluators.compiled
+            checked += assert_same_as_interpreted(kb, evaluators, rng, 50)
+
+        # 条件のないルール・1つの条件の両方の値
+        rules = [
+            make_rule("empty_and", [], "a"),
+            make_rule("empty_or", [], "b", "OR"),
+            make_rule("single_true", [("x", True)], "c", "OR"),
+            make_rule("single_false", [("x", False)], "d"),
+        ]
+        kb = KnowledgeBase("T", rules)
+        checked += assert_same_as_interpreted(kb, compile_rule_evaluators(kb, cache_dir), rng, 20)
+
+        db = SessionLocal()
+        for visa_type in ["E", "L", "B", "ALL"]:
+            kb = compile_knowledge_base(db, visa_type)
+            checked += assert_same_as_interpreted(kb, compile_rule_evaluators(kb, cache_dir), rng, 300)
+        db.close()
+    print(f"Generated evaluators: {checked} checks")
+
+
+def test_engine_results_unchanged():
+    """生成したコードと汎用の評価のエンジンで、同じ回答の列に同じ発火・質問・結論になる"""
+    db = SessionLocal()
+    rng = random.Random(1)
+    registry = RuleEvaluatorRegistry("compiled", None)
+    for visa_type in ["E", "B", "ALL"]:
+        kb = compile_knowledge_base(db, visa_type)
+        assert registry.get(kb).compiled
+        for _ in range(20):
+            engines = []
+            for evaluators in (registry.get(kb), interpreted_evaluators(kb)):
+                engine = InferenceEngine(db, visa_type, knowledge_base=kb, question_cache=NextQuestionCache(0))
+                engine._get_applicable_rules()
+                engine._holds, engine._impossible = evaluators.holds, evaluators.impossible
+                engines.append(engine)
+            seed = rng.random()
+            answers = random.Random(seed)
+            for engine in engines:
+                answers.seed(seed)
+                for _ in range(40):
+                    question = engine.get_next_question()
+                    if question is None:
+                        break
+                    engine.add_fact(question, answers.random() < 0.5)
+                    engine.forward_chain()
+            compiled, interpreted = engines
+            assert compiled.fired_rules == interpreted.fired_rules
+            assert compiled.save_snapshot() == interpreted.save_snapshot()
+            assert compiled._dead == interpreted._dead
+            assert compiled.get_conclusions() == interpreted.get_conclusions()
+    db.close()
+    print("Engine results: OK")
+
+
+def test_disk_cache():
+    """コンパイル結果はソースの内容のハッシュで保存し、次回はそれを読み込む（壊れたファイルは無視してコンパイルし直す）"""
+    rules = [make_rule("r0", [("a", True), ("b", False)], "c"), make_rule("r1", [("c", True), ("d", True)], "e", "OR")]
+    kb = KnowledgeBase("T", rules)
+    a, b = 1 << kb.fact_ids["a"], 1 << kb.fact_ids["b"]
+    source = generate_rule_source(kb)
+    assert source == generate_rule_source(KnowledgeBase("T", list(rules)))  # 同じ内容なら同じソース
+    with tempfile.TemporaryDirectory() as cache_dir:
+        first = compile_rule_evaluators(kb, cache_dir)
+        files = os.listdir(cache_dir)
+        assert files == [f"{first.digest[:32]}.bin"]
+        mtime = os.path.getmtime(os.path.join(cache_dir, files[0]))
+
+        second = compile_rule_evaluators(KnowledgeBase("T", list(rules)), cache_dir)
+        assert second.digest == first.digest and os.listdir(cache_dir) == files
+        assert os.path.getmtime(os.path.join(cache_dir, files[0])) == mtime  # 書き直さずに読み込んだ
+        assert second.holds[0](a | b, a) and not second.holds[0](a | b, a | b)
+
+        # 壊れたファイル
+        with open(os.path.join(cache_dir, files[0]), "wb") as f:
+            f.write(b"broken")
+        third = compile_rule_evaluators(kb, cache_dir)
+        assert third.holds[0](a | b, a) and third.impossible[0](a | b, a | b)
+
+        # 別の知識ベースは別のファイル
+        compile_rule_evaluators(KnowledgeBase("T", rules[:1]), cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+
+        # 他のユーザーが書き込めるファイルは読み込まない（コンパイルし直して自分のファイルに置き換える）
+        path = os.path.join(cache_dir, files[0])
+        planted = compile(generate_rule_source(kb).replace("return k", "return True or k"), "<planted>", "exec")
+        with open(path, "wb") as f:
+            f.write(importlib.util.MAGIC_NUMBER + bytes.fromhex(first.digest) + marshal.dumps(planted))
+        os.chmod(path, 0o666)
+        assert not compile_rule_evaluators(kb, cache_dir).holds[0](a | b, a | b)
+        assert not os.stat(path).st_mode & 0o022
+
+        # 他のユーザーが書き込めるディレクトリは使わない
+        os.chmod(cache_dir, 0o777)
+        compile_rule_evaluators(KnowledgeBase("T", [make_rule("r2", [("f", True)], "g")]), cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+
+    # 作成するディレクトリは専用（モード0700）
+    with tempfile.TemporaryDirectory() as parent:
+        cache_dir = os.path.join(parent, "evaluators")
+        compile_rule_evaluators(kb, cache_dir)
+        assert os.stat(cache_dir).st_mode & 0o777 == 0o700 and len(os.listdir(cache_dir)) == 1
+
+    # デフォルトではディスクに保存しない
+    assert RULE_EVALUATOR_CACHE_DIR is None or "RULE_EVALUATOR_CACHE_DIR" in os.environ
+
+    # 保存できないディレクトリでもメモリ上でコンパイルする
+    assert compile_rule_evaluators(kb, "/proc/visa-expert-rule-evaluators").compiled
+
+    # デフォルトは汎用の評価（生成したコードは RULE_EVALUATORS=compiled で有効にする）
+    assert RULE_EVALUATORS == "interpreted" or "RULE_EVALUATORS" in os.environ
+    assert not RuleEvaluatorRegistry("interpreted", None).get(kb).compiled
+    if "RULE_EVALUATORS" not in os.environ:
+        assert not rule_evaluator_registry.get(kb).compiled
+    registry = RuleEvaluatorRegistry("compiled", None)
+    assert registry.get(kb) is registry.get(kb) and registry.get(kb).compiled
+    print("Disk cache: OK")
+
+
+def test_source_has_no_knowledge_base_text():
+    """ルールID・事実名・結論はソースに入らない（改行やコードを含む文字列でも、生成したコードは同じ）"""
+    payload = "r0\nimport os; os.system('echo injected')\n#"
+    rules = [
+        make_rule(payload, [(payload + "fact", True), ("b", False)], payload + "conclusion"),
+        make_rule("r1'\"\n)(", [("b", True)], "c", "OR"),
+    ]
+    kb = KnowledgeBase("T", rules)
+    source = generate_rule_source(kb)
+    assert "import" not in source and "injected" not in source and "r1" not in source and "conclusion" not in source
+    plain = KnowledgeBase("T", [make_rule("x", [("y", True), ("b", False)], "z"), make_rule("w", [("b", True)], "c", "OR")])
+    assert source == generate_rule_source(plain)
+
+    evaluators = RuleEvaluatorRegistry("compiled", None).get(kb)
+    assert evaluators.compiled
+    fact, b = 1 << kb.fact_ids[payload + "fact"], 1 << kb.fact_ids["b"]
+    assert evaluators.holds[0](fact | b, fact) and not evaluators.holds[0](fact | b, fact | b)
+    print("Source without knowledge base text: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_generated_matches_interpreted()
+        test_engine_results_unchanged()
+        test_disk_cache()
+        test_source_has_no_knowledge_base_text()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,106 @@
+"""ルールグラフ（/api/consultation/graph）とコンパクトな可視化の状態のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+CONDITION_STATUSES = {"0": "unknown", "1": "satisfied", "2": "not_satisfied", "3": "uncertain"}
+
+
+def expand(graph, status):
+    """グラフとコンパクトな状態から可視化のルールを組み立てる（frontend の expandRuleStatus と同じ）"""
+    index, flags, codes = status
+    rule = graph["rules"][index]
+    return {
+        "rule_id": rule["rule_id"],
+        "conditions": [
+            {"fact_name": c["fact_name"], "status": CONDITION_STATUSES[code], "is_derivable": c["is_derivable"]}
+            for c, code in zip(rule["conditions"], codes)
+        ],
+        "operator": rule["operator"],
+        "conclusion": rule["conclusion"],
+        "conclusion_derived": bool(flags & 1),
+        "is_fired": bool(flags & 2),
+        "is_fireable": bool(flags & 4),
+    }
+
+
+def test_graph_is_cacheable():
+    """ルールグラフは強いETagと immutable で返り、If-None-Match には 304 を返す"""
+    client = TestClient(app)
+    start = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+    status = client.get("/api/consultation/visualization/status", params={"session_id": start["session_id"]}).json()
+    url = f"/api/consultation/graph/{status['graph_visa_type']}/{status['graph_version']}"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag == f'"{status["graph_version"]}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert len(response.json()["rules"]) == len(status["rules"])
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    assert client.get("/api/consultation/graph/E/0000000000000000").status_code == 404
+    print("Rule graph caching: OK")
+
+
+def test_status_matches_visualization():
+    """グラフと状態の差分から組み立てた可視化が全件の可視化と一致し、1ステップの転送量が小さい"""
+    client = TestClient(app)
+    rng = random.Random(0)
+    full_bytes = status_bytes = 0
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(5):
+            result = client.post("/api/consultation/start", json={"visa_type": visa_type}).json()
+            session_id = result["session_id"]
+            status = client.get("/api/consultation/visualization/status", params={"session_id": session_id}).json()
+            assert status["full"]
+            graph = client.get(f"/api/consultation/graph/{status['graph_visa_type']}/{status['graph_version']}").json()
+            rules = [expand(graph, s) for s in status["rules"]]
+            version = status["version"]
+
+            for step in range(20):
+                if result["is_finished"] or not result["next_question"]:
+                    break
+                result = client.post(
+                    "/api/consultation/answer",
+                    json={"session_id": session_id, "question": result["next_question"], "answer": rng.choice([True, False, None])},
+                ).json()
+
+                response = client.get("/api/consultation/visualization/status", params={"session_id": session_id, "since": version})
+                full = client.get("/api/consultation/visualization", params={"session_id": session_id})
+                full_bytes += len(full.content)
+                if response.status_code == 304:
+                    continue
+                status_bytes += len(response.content)
+                status = response.json()
+                for s in status["rules"]:
+                    rules[s[0]] = expand(graph, s)
+                version = status["version"]
+
+                full = full.json()
+                assert rules == full["rules"]
+                assert [graph["rules"][i]["rule_id"] for i in status["fired_rules"]] == full["fired_rules"]
+
+    assert status_bytes * 5 < full_bytes
+    print(f"Visualization bytes per consultation: {status_bytes} (status) vs {full_bytes} (full)")
+
+
+if __name__ == "__main__":
+    try:
+        test_graph_is_cacheable()
+        test_status_matches_visualization()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
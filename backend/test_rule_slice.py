@@ -0,0 +1,156 @@
+"""ゴールのスライス（到達範囲のルール）と発火不可能なルールの印のテスト"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import compile_knowledge_base
+from app.services.question_cache import NextQuestionCache
+from rule_factories import make_engine, make_rule, random_knowledge_base
+
+
+def expected_dead(engine):
+    return sum(1 << rule.index for rule in engine.all_rules if engine._is_rule_impossible(rule))
+
+
+def test_cone_rule_mask():
+    """スライスは、ゴールの到達範囲の事実を結論とするルールちょうど"""
+    db = SessionLocal()
+    for visa_type in ["E", "L", "B", "ALL"]:
+        kb = compile_knowledge_base(db, visa_type)
+        for fact_id in range(len(kb.fact_names)):
+            cone = kb.cone_mask(fact_id)
+            expected = sum(1 << rule.index for rule in kb.rules if cone >> rule.conclusion_id & 1)
+            assert kb.cone_rule_mask(fact_id) == expected
+    db.close()
+    print("Cone rule mask: OK")
+
+
+def test_dead_rules_follow_state():
+    """発火不可能なルールの印は、回答・取り消し・アンドゥ・復元・複製の後も状態から求めたものと一致する"""
+    rng = random.Random(0)
+    checked = 0
+    for _ in range(60):
+        rules, catalog = random_knowledge_base(rng)
+        kb, engine = make_engine(rules, catalog)
+        engine._get_applicable_rules()
+        snapshots = []
+        for step in range(30):
+            operation = rng.random()
+            fact_name = rng.choice(kb.fact_names)
+            if operation < 0.5:
+                engine.push_frame()
+                engine.add_fact(fact_name, rng.random() < 0.5)
+                engine.forward_chain()
+            elif operation < 0.65 and fact_name in engine.asked_questions:
+                engine.push_frame()
+                engine.remove_fact(fact_name)
+            elif operation < 0.8:
+                engine.undo(rng.randint(1, 3))
+            elif operation < 0.9:
+                with engine.speculate():
+                    engine.add_fact(fact_name, True)
+                    engine.forward_chain()
+                    assert engine._dead == expected_dead(engine)
+            elif snapshots and operation < 0.95:
+                engine.restore_snapshot(rng.choice(snapshots))
+            else:
+                engine = engine.clone()
+            snapshots.append(engine.save_snapshot())
+            assert engine._dead == expected_dead(engine)
+            checked += 1
+    print(f"Dead rules: {checked} states")
+
+
+def branching_engine(branches=200, width=4, alternatives=3):
+    """
+    goal <- OR(b0..bN)、bi <- AND(ki, di_0..di_w)、di_j <- AND(xi_j_l, yi_j_l)（代替ルール alternatives 個）
+
+    最後以外の分岐は ki=いいえ で発火不可能にする
+    """
+    rules = [make_rule("goal", [(f"b{i}", True) for i in range(branches)], "goal", "OR")]
+    for i in range(branches):
+        rules.append(make_rule(f"b{i}", [(f"k{i}", True)] + [(f"d{i}_{j}", True) for j in range(width)], f"b{i}"))
+        for j in range(width):
+            for alternative in range(alternatives):
+                conditions = [(f"x{i}_{j}_{alternative}", True), (f"y{i}_{j}_{alternative}", True)]
+                rules.append(make_rule(f"d{i}_{j}_{alternative}", conditions, f"d{i}_{j}"))
+    kb, engine = make_engine(rules)
+    engine.goals = ["goal"]
+    for i in range(branches):
+        engine.add_unknown_fact(f"b{i}")
+        if i < branches - 1:
+            engine.add_fact(f"k{i}", False)
+    engine.forward_chain()
+    return kb, engine
+
+
+def test_live_rules_drop_dead_branches():
+    """発火不可能になった分岐の先のルールは生きているスライスから外れ、近似の走査でも質問しない"""
+    branches = 200
+    kb, engine = branching_engine(branches)
+    goal = kb.fact_ids["goal"]
+    live = engine._live_rules(goal)
+    live_ids = {engine.all_rules[index].rule_id for index in range(len(engine.all_rules)) if live >> index & 1}
+    assert "goal" in live_ids and f"b{branches - 1}" in live_ids and "b0" not in live_ids
+    assert not any(rule_id.startswith("d0_") for rule_id in live_ids)
+    assert len(live_ids) == 2 + 4 * 3
+    assert engine._live_rules(goal) & engine._dead == 0
+    print(f"Live rules: {len(live_ids)} of {bin(kb.cone_rule_mask(goal)).count('1')}")
+
+    # 探索を打ち切った近似の走査も、生きている分岐の質問を返す
+    expected = engine.get_next_question()
+    engine.max_search_nodes = 1
+    engine.question_cache = NextQuestionCache(0)
+    assert engine.get_next_question() == expected == f"k{branches - 1}"
+
+    # 最後の分岐も発火不可能になると、ゴールのスライスにはゴールのルールだけが残り、質問はなくなる
+    engine.add_fact(f"k{branches - 1}", False)
+    assert engine._live_rules(goal) == 1 << kb.rule_indices["goal"]
+    assert engine._scan_question_for_goal(goal) is None and engine._find_question_for_goal(goal) is None
+
+    kb, engine = branching_engine(branches)
+    engine.question_cache = NextQuestionCache(0)
+    start = time.perf_counter()
+    for _ in range(20):
+        engine.get_next_question()
+    print(f"Search with {branches - 1} dead branches: {(time.perf_counter() - start) / 20 * 1e6:.0f} us")
+
+
+def test_shipped_knowledge_base_questions():
+    """出荷している知識ベースでは、スライスの近似の走査がまだ聞いていない事実だけを質問する"""
+    db = SessionLocal()
+    rng = random.Random(1)
+    for visa_type in ["E", "ALL"]:
+        kb = compile_knowledge_base(db, visa_type)
+        engine = InferenceEngine(db, visa_type, knowledge_base=kb, question_cache=NextQuestionCache(0))
+        goal = engine._fact_id(engine.goal)
+        while True:
+            question = engine.get_next_question()
+            if question is None:
+                break
+            scanned = engine._scan_question_for_goal(goal)
+            assert scanned is None or not engine._asked >> scanned & 1
+            assert engine._live_rules(goal) & ~kb.cone_rule_mask(goal) == 0
+            engine.add_fact(question, rng.random() < 0.5)
+            engine.forward_chain()
+            assert engine._dead == expected_dead(engine)
+    db.close()
+    print("Shipped knowledge base: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_cone_rule_mask()
+        test_dead_rules_follow_state()
+        test_live_rules_drop_dead_branches()
+        test_shipped_knowledge_base_questions()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
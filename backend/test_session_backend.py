@@ -0,0 +1,296 @@
+"""セッションバックエンド（プロセス内・Redisプロトコル）のテスト"""
+import os
+import random
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models.database import SessionLocal
+from app.services.consultation_service import SessionStore, session_store
+from app.services.session_backend import (
+    InMemorySessionBackend,
+    RedisError,
+    RedisSessionBackend,
+    SessionBackend,
+    SqliteSessionBackend,
+)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """テスト用のRedis互換サーバー（PING / AUTH / SELECT / GET / SET [PX|EX] / DEL のみ）"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.password = password
+        self.data = {}  # key -> (value, expires_at)
+        self.commands = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://:{self.password}@{host}:{port}/1" if self.password else f"redis://{host}:{port}"
+
+    def drop_connections(self):
+        """全ての接続を切断（サーバーの再起動・アイドルタイムアウトの代わり）"""
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(2)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.connections.add(self.connection)
+        authenticated = server.password is None
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                args = []
+                for _ in range(int(line[1:-2])):
+                    size = int(self.rfile.readline()[1:-2])
+                    args.append(self.rfile.read(size + 2)[:-2])
+                command = args[0].upper().decode()
+                with server.lock:
+                    server.commands.append(command)
+                    if command == "AUTH":
+                        authenticated = args[-1].decode() == server.password
+                        reply = b"+OK\r\n" if authenticated else b"-WRONGPASS invalid password\r\n"
+                    elif not authenticated:
+                        reply = b"-NOAUTH Authentication required.\r\n"
+                    elif command in ("PING", "SELECT"):
+                        reply = b"+OK\r\n"
+                    elif command == "GET":
+                        value, expires_at = server.data.get(args[1], (None, 0))
+                        if value is None or (expires_at and time.monotonic() > expires_at):
+                            reply = b"$-1\r\n"
+                        else:
+                            reply = b"$%d\r\n%s\r\n" % (len(value), value)
+                    elif command == "SET":
+                        expires_at = 0
+                        if len(args) == 5:
+                            scale = 1000 if args[3].upper() == b"PX" else 1
+                            expires_at = time.monotonic() + int(args[4]) / scale
+                        server.data[args[1]] = (args[2], expires_at)
+                        reply = b"+OK\r\n"
+                    elif command == "DEL":
+                        reply = b":%d\r\n" % (server.data.pop(args[1], None) is not None)
+                    else:
+                        reply = b"-ERR unknown command\r\n"
+                self.wfile.write(reply)
+        except (OSError, ValueError):
+            return
+        finally:
+            server.connections.discard(self.connection)
+
+
+class CountingBackend:
+    """バックエンドの get / set の呼び出し回数を数えるラッパー"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.gets = self.sets = 0
+
+    def get(self, session_id):
+        self.gets += 1
+        return self.backend.get(session_id)
+
+    def set(self, session_id, data, ttl_seconds):
+        self.sets += 1
+        self.backend.set(session_id, data, ttl_seconds)
+
+    def delete(self, session_id):
+        self.backend.delete(session_id)
+
+
+def test_redis_backend():
+    """RESPでの保存・取得・削除・期限切れ・認証・切断後の再接続"""
+    server = FakeRedisServer(password="secret")
+    try:
+        backend = RedisSessionBackend(server.url)
+        data = bytes(range(256)) + b"\r\n$-1\r\n"
+        assert backend.get("a") is None
+        backend.set("a", data, 0)
+        assert backend.get("a") == data
+        backend.delete("a")
+        assert backend.get("a") is None
+
+        backend.set("b", b"x", 0.05)
+        assert backend.get("b") == b"x"
+        time.sleep(0.1)
+        assert backend.get("b") is None
+
+        backend.set("c", b"y", 0)
+        server.drop_connections()
+        assert backend.get("c") == b"y"
+        assert server.commands.count("AUTH") == 2 and "SELECT" in server.commands
+
+        try:
+            RedisSessionBackend(server.url.replace("secret", "wrong")).get("c")
+            raise AssertionError("accepted wrong password")
+        except RedisError:
+            pass
+    finally:
+        server.stop()
+    print("Redis backend: OK")
+
+
+def test_sessions_shared_between_workers():
+    """バックエンドを共有する複数のワーカー（と再起動後のワーカー）で、1つのプロセスと同じ診断になる"""
+    db = SessionLocal()
+    server = FakeRedisServer()
+    rng = random.Random(0)
+    try:
+        for backend in [InMemorySessionBackend(), RedisSessionBackend(server.url)]:
+            counting = CountingBackend(backend)
+            workers = [SessionStore(backend=counting) for _ in range(2)]
+            steps = 0
+
+            for visa_type in ["E", "B", "ALL"]:
+                for _ in range(5):
+                    reference = SessionStore().create(db, visa_type)
+                    expected = reference.start()
+                    session = workers[0].create(db, visa_type)
+                    session.start()
+                    workers[0].update(session)
+                    session_id = session.session_id
+                    question = expected["next_question"]
+
+                    for step in range(25):
+                        if question is None:
+                            break
+                        if rng.random() < 0.1:
+                            workers.append(SessionStore(backend=counting))  # 再起動したワーカー
+                        worker = rng.choice(workers)
+                        gets, sets = counting.gets, counting.sets
+                        session = worker.get(session_id, db)
+                        assert session is worker._get_local(session_id)
+
+                        if step > 2 and rng.random() < 0.2:
+                            expected, result = reference.back(db, 1), session.back(db, 1)
+                            question = expected["current_question"]
+                        else:
+                            value = rng.choice([True, False, None])
+                            expected = reference.answer(db, question, value)
+                            result = session.answer(db, question, value)
+                            question = None if expected["is_finished"] else expected["next_question"]
+                        worker.update(session)
+                        assert (counting.gets - gets, counting.sets - sets) == (1, 1)
+                        assert {k: v for k, v in result.items() if k != "session_id"} == {
+                            k: v for k, v in expected.items() if k != "session_id"
+                        }
+                        assert session.engine.save_snapshot() == reference.engine.save_snapshot()
+                        steps += 1
+
+            print(f"{type(backend).__name__}: {steps} steps across {len(workers)} workers")
+    finally:
+        server.stop()
+        db.close()
+
+
+def test_sqlite_backend_transactions():
+    """SQLiteへの書き込み（期限切れの行の削除と保存）は1つのトランザクションで、失敗したら全てロールバックする"""
+    try:
+        SessionBackend()
+        assert False, "SessionBackend is abstract"
+    except TypeError:
+        pass
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = SqliteSessionBackend(os.path.join(tmp, "sessions.db"))
+        backend.set("expired", b"old", 0.001)
+        backend.set("kept", b"data", 0)
+        time.sleep(0.01)
+
+        backend._sets = backend._SWEEP_INTERVAL - 1  # 次の set で期限切れの行を削除する
+        try:
+            backend.set("broken", None, 0)  # data は NOT NULL
+            assert False, "expected IntegrityError"
+        except sqlite3.IntegrityError:
+            pass
+        connection = backend._connection()
+        assert not connection.in_transaction
+        assert connection.execute("SELECT COUNT(*) FROM sessions WHERE session_id = 'expired'").fetchone()[0] == 1
+
+        backend._sets = backend._SWEEP_INTERVAL - 1
+        backend.set("new", b"data", 0)
+        assert not connection.in_transaction
+        assert len(backend) == 2 and backend.get("kept") == b"data" and backend.get("new") == b"data"
+        backend.delete("kept")
+        assert not connection.in_transaction and backend.get("kept") is None
+        connection.close()
+    print("SQLite backend transactions: OK")
+
+
+def test_backend_endpoints():
+    """バックエンドの使用時、プロセス内のセッションが消えても（再起動）診断と可視化を続けられる"""
+    client = TestClient(app)
+    previous = session_store.backend
+    session_store.backend = InMemorySessionBackend()
+    try:
+        result = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+        session_id = result["session_id"]
+        status = client.get("/api/consultation/visualization/status", params={"session_id": session_id}).json()
+        version = status["version"]
+
+        for step in range(5):
+            if result["is_finished"] or not result["next_question"]:
+                break
+            session_store._discard(session_id)  # 再起動
+            result = client.post(
+                "/api/consultation/answer",
+                json={"session_id": session_id, "question": result["next_question"], "answer": True},
+            ).json()
+            session_store._discard(session_id)
+            response = client.get(
+                "/api/consultation/visualization/status", params={"session_id": session_id, "since": version}
+            )
+            assert response.status_code == 200
+            status = response.json()
+            assert status["version"] > version and not status["full"]
+            version = status["version"]
+
+        session_store.delete(session_id)
+        response = client.post(
+            "/api/consultation/answer", json={"session_id": session_id, "question": "x", "answer": True}
+        )
+        assert response.status_code == 404
+    finally:
+        session_store.backend = previous
+    print("Backend endpoints: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_redis_backend()
+        test_sessions_shared_between_workers()
+        test_sqlite_backend_transactions()
+        test_backend_endpoints()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,184 @@
+"""状態トークン（ステートレスモード）のテスト"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models.database import SessionLocal
+from app.services import session_codec
+from app.services.consultation_service import SessionStore, restore_session, session_store
+from app.services.session_codec import StateCodec, StateTokenError, pack_state, unpack_state
+
+
+def with_codec(test):
+    """テストの間だけステートレスモードを有効にする"""
+    def run():
+        previous = session_codec.state_codec
+        session_codec.state_codec = StateCodec(b"test-secret")
+        try:
+            test()
+        finally:
+            session_codec.state_codec = previous
+    run.__name__ = test.__name__
+    return run
+
+
+def session_state(session):
+    engine = session.engine
+    return (
+        engine.save_snapshot(),
+        engine._fingerprint,
+        engine.trail_depth,
+        session.answer_steps,
+        session.question_history,
+        session.current_question_fact,
+        session.current_visa_type,
+    )
+
+
+@with_codec
+def test_restored_session_matches():
+    """トークンから再構築したセッションが元のセッションと同じ状態になり、その後の回答・戻る操作も一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    sizes = []
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(10):
+            session = SessionStore().create(db, visa_type)
+            result = session.start()
+            for step in range(25):
+                if result.get("is_finished") or not result.get("next_question"):
+                    break
+                if step > 2 and rng.random() < 0.2:
+                    result = session.back(db, rng.randint(1, 2))
+                    question = result["current_question"]
+                else:
+                    question = result["next_question"]
+                token = result["state"]
+                sizes.append(len(token))
+
+                # 別のワーカー：ストアにセッションがない状態でトークンから再構築する
+                session_store.delete(session.session_id)
+                restored = restore_session(db, token)
+                assert restored is not session
+                assert session_state(restored) == session_state(session)
+                assert restore_session(db, token) is restored  # 同じトークンは再構築しない
+                assert session_store.get_issued(session.session_id, token) is restored
+
+                value = rng.choice([True, False, None])
+                result = session.answer(db, question, value)
+                other = restored.answer(db, question, value)
+                assert {k: v for k, v in other.items() if k != "state"} == {
+                    k: v for k, v in result.items() if k != "state"
+                }
+                assert session_state(restored) == session_state(session)
+                assert session_store.get_issued(session.session_id, token) is None  # 古いトークン
+
+    print(f"State tokens: {len(sizes)} restored, {max(sizes)} chars at most")
+    db.close()
+
+
+@with_codec
+def test_invalid_tokens():
+    """改ざん・別の鍵・期限切れのトークンは拒否する"""
+    db = SessionLocal()
+    session = SessionStore().create(db, "E")
+    result = session.start()
+    result = session.answer(db, result["next_question"], True)
+    token = result["state"]
+
+    tampered = token[:10] + ("A" if token[10] != "A" else "B") + token[11:]
+    for bad in [tampered, token[:-2], "", "not a token"]:
+        try:
+            restore_session(db, bad)
+        except StateTokenError:
+            continue
+        raise AssertionError(f"accepted invalid token: {bad!r}")
+
+    knowledge_base = session.engine.knowledge_base
+    other_secret = StateCodec(b"other-secret").encode(session.to_state(), knowledge_base)
+    expired = StateCodec(b"test-secret", max_age_seconds=1)
+    try:
+        session_codec.state_codec.decode(other_secret, lambda v, version: knowledge_base)
+        raise AssertionError("accepted token signed with another secret")
+    except StateTokenError:
+        pass
+    old_time = time.time
+    try:
+        time.time = lambda: old_time() + 10
+        expired.decode(token, lambda v, version: knowledge_base)
+        raise AssertionError("accepted expired token")
+    except StateTokenError:
+        pass
+    finally:
+        time.time = old_time
+
+    # 正しく署名されていても、回答の列が上限より長い状態は再生せずに拒否する
+    state = session.to_state()
+    limit = session_codec.CONSULTATION_STATE_MAX_ANSWERS
+    data = pack_state(state._replace(answers=state.answers * limit), knowledge_base)
+    assert len(unpack_state(data, lambda v, version: knowledge_base)[1].answers) == limit
+    long_log = StateCodec(b"test-secret").encode(state._replace(answers=state.answers * (limit + 1)), knowledge_base)
+    try:
+        session_codec.state_codec.decode(long_log, lambda v, version: knowledge_base)
+        raise AssertionError("accepted too many answers")
+    except StateTokenError:
+        pass
+    print("Invalid tokens: OK")
+    db.close()
+
+
+@with_codec
+def test_stateless_endpoints():
+    """状態トークンだけで（どのワーカーのストアにもセッションがなくても）、セッションと同じ診断を続けられる"""
+    client = TestClient(app)
+    rng = random.Random(1)
+    stateless = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+    stateful = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+    state, result = stateless["state"], stateless
+
+    def strip(response):
+        return {k: v for k, v in response.items() if k not in ("session_id", "state")}
+
+    for step in range(15):
+        if result["is_finished"] or not result["next_question"]:
+            break
+        question, value = result["next_question"], rng.choice([True, False, None])
+        session_store.delete(stateless["session_id"])  # 別のワーカーに届いた場合
+        result = client.post(
+            "/api/consultation/answer", json={"state": state, "question": question, "answer": value}
+        ).json()
+        expected = client.post(
+            "/api/consultation/answer",
+            json={"session_id": stateful["session_id"], "question": question, "answer": value},
+        ).json()
+        assert strip(result) == strip(expected)
+        state = result["state"]
+
+        session_store.delete(stateless["session_id"])
+        status = client.get("/api/consultation/visualization/status", params={"state": state})
+        assert status.status_code == 200 and status.json()["full"]
+
+    back = client.post("/api/consultation/back", json={"state": state}).json()
+    assert back["current_question"] and back["state"] != state
+
+    assert client.post("/api/consultation/back", json={"state": state[:-3]}).status_code == 400
+    print("Stateless endpoints: OK")
+
+
+if __name__ == "__main__":
+    try:
+        test_restored_session_matches()
+        test_invalid_tokens()
+        test_stateless_endpoints()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,125 @@
+"""診断開始時のテンプレート（回答前の状態の共有と複製）のテスト"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import ConsultationSession, SessionStore
+from app.services.knowledge_base import compile_knowledge_base
+from app.services.session_template import session_template_registry
+
+
+def session_state(session):
+    engine = session.engine
+    return (
+        engine.save_snapshot(),
+        engine._fingerprint,
+        engine.trail_depth,
+        session.question_history,
+        session.current_question_fact,
+        session.current_visa_type,
+    )
+
+
+def test_template_sessions_match():
+    """テンプレートから作ったセッションが、テンプレートなしで作ったセッションと同じ診断・可視化になる"""
+    db = SessionLocal()
+    store = SessionStore()
+    rng = random.Random(0)
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(10):
+            session = store.create(db, visa_type)
+            reference = ConsultationSession("reference", db, visa_type)
+            assert session._template is not None and reference._template is None
+
+            result, expected = session.start(), reference.start()
+            assert {k: v for k, v in result.items() if k != "session_id"} == {
+                k: v for k, v in expected.items() if k != "session_id"
+            }
+            assert session_state(session) == session_state(reference)
+            assert session.get_visualization(db) == reference.get_visualization(db)
+
+            question = result["next_question"]
+            for step in range(20):
+                if question is None:
+                    break
+                if step > 1 and rng.random() < 0.2:
+                    # 最初まで戻ると、テンプレートの可視化を使う
+                    steps = rng.choice([1, len(session.question_history)])
+                    question = session.back(db, steps)["current_question"]
+                    assert reference.back(db, steps)["current_question"] == question
+                else:
+                    value = rng.choice([True, False, None])
+                    result, expected = session.answer(db, question, value), reference.answer(db, question, value)
+                    assert {k: v for k, v in result.items() if k != "session_id"} == {
+                        k: v for k, v in expected.items() if k != "session_id"
+                    }
+                    question = None if result["is_finished"] else result["next_question"]
+                assert session_state(session) == session_state(reference)
+                since = session.visualization_version
+                assert session.get_visualization_status(db, since - 1) == reference.get_visualization_status(
+                    db, since - 1
+                )
+                assert session.get_visualization_delta(db, None) == reference.get_visualization_delta(db, None)
+    db.close()
+    print("Template sessions: OK")
+
+
+def test_template_is_not_modified():
+    """複製したエンジンへの回答は、テンプレートと他のセッションに影響しない"""
+    db = SessionLocal()
+    store = SessionStore()
+    template = session_template_registry.get(db, "E")
+    initial = template.engine.save_snapshot(), template.engine._fingerprint
+
+    first, second = store.create(db, "E"), store.create(db, "E")
+    assert first.engine is not second.engine and first._template is second._template is template
+    first_question = first.start()["next_question"]
+    second.start()
+    for _ in range(5):
+        result = first.answer(db, first_question, True)
+        if result["is_finished"]:
+            break
+        first_question = result["next_question"]
+
+    assert (template.engine.save_snapshot(), template.engine._fingerprint) == initial
+    assert (second.engine.save_snapshot(), second.engine._fingerprint) == initial
+    assert second.engine.trail_depth == 0 and not second.answer_steps
+    db.close()
+    print("Template isolation: OK")
+
+
+def test_template_versions():
+    """テンプレートは知識ベースのバージョンごとに1度だけ作り、別のバージョンの知識ベースには使わない"""
+    db = SessionLocal()
+    template = session_template_registry.get(db, "B")
+    assert session_template_registry.get(db, "B") is template
+    assert session_template_registry.find(db, template.knowledge_base) is template
+
+    other = compile_knowledge_base(db, "B")  # レジストリにない知識ベース（同じ内容でも別のインスタンス）
+    assert session_template_registry.find(db, other) is None
+    session = ConsultationSession("other", db, "B", knowledge_base=other)
+    assert session._template is None and session.engine.knowledge_base is other
+
+    start = time.perf_counter()
+    count = 200
+    for _ in range(count):
+        ConsultationSession("timing", db, "B", template=template).start()
+    print(f"Template start: {(time.perf_counter() - start) / count * 1e6:.1f} us per session")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_template_sessions_match()
+        test_template_is_not_modified()
+        test_template_versions()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
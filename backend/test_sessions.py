@@ -0,0 +1,216 @@
+"""複数セッションの同時診断とセッションストアの追い出しのテスト"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.consultation_service import SessionStore
+from app.services.session_backend import SqliteSessionBackend
+
+
+def run_consultation(session, db, answers):
+    """回答パターンに従って診断を進め、質問の列を返す"""
+    questions = []
+    result = session.start()
+    step = 0
+    while result["next_question"] and not result["is_finished"] and step < 30:
+        questions.append(result["next_question"])
+        result = session.answer(db, result["next_question"], answers[step % len(answers)])
+        step += 1
+    return questions, result["conclusions"]
+
+
+def test_concurrent_sessions_are_independent():
+    """2つのセッションを交互に進めても、それぞれ単独で進めた場合と同じ結果になる"""
+    db = SessionLocal()
+    store = SessionStore()
+
+    expected_yes = run_consultation(store.create(db, "E"), db, [True])
+    expected_mixed = run_consultation(store.create(db, "E"), db, [None, True])
+
+    session_yes = store.create(db, "E")
+    session_mixed = store.create(db, "E")
+    result_yes = session_yes.start()
+    result_mixed = session_mixed.start()
+    questions_yes, questions_mixed = [], []
+    step = 0
+    while step < 30 and (result_yes["next_question"] or result_mixed["next_question"]):
+        if result_yes["next_question"] and not result_yes["is_finished"]:
+            questions_yes.append(result_yes["next_question"])
+            result_yes = session_yes.answer(db, result_yes["next_question"], True)
+        if result_mixed["next_question"] and not result_mixed["is_finished"]:
+            questions_mixed.append(result_mixed["next_question"])
+            result_mixed = session_mixed.answer(db, result_mixed["next_question"], [None, True][step % 2])
+        step += 1
+
+    print(f"Session A questions: {len(questions_yes)}, Session B questions: {len(questions_mixed)}")
+    assert (questions_yes, result_yes["conclusions"]) == expected_yes
+    assert (questions_mixed, result_mixed["conclusions"]) == expected_mixed
+    db.close()
+
+
+def test_lru_and_ttl_eviction():
+    """件数上限でLRU、TTL切れで追い出される"""
+    db = SessionLocal()
+
+    store = SessionStore(ttl_seconds=0, max_sessions=2)
+    first = store.create(db, "E")
+    second = store.create(db, "E")
+    store.get(first.session_id)  # first becomes most recently used
+    third = store.create(db, "E")
+    store.update(third)
+    assert store.get(second.session_id) is None
+    assert store.get(first.session_id) is first
+    assert store.get(third.session_id) is third
+
+    store = SessionStore(ttl_seconds=0.01)
+    session = store.create(db, "E")
+    time.sleep(0.02)
+    assert store.get(session.session_id) is None
+    assert len(store) == 0
+
+    # メモリ上限を超えると古いセッションから追い出される
+    store = SessionStore(ttl_seconds=0, max_bytes=1)
+    old = store.create(db, "E")
+    old.start()
+    store.update(old)
+    new = store.create(db, "E")
+    new.start()
+    store.update(new)
+    assert store.get(old.session_id) is None
+    assert store.get(new.session_id) is new
+
+    print("Eviction: OK")
+    db.close()
+
+
+def test_idle_sessions_spill_to_disk():
+    """上限を超えた・アイドルのセッションはディスクに退避され、次のアクセスで同じ状態に戻る"""
+    db = SessionLocal()
+    path = os.path.join(tempfile.mkdtemp(), "sessions.db")
+    spill = SqliteSessionBackend(path)
+    store = SessionStore(ttl_seconds=0, max_sessions=3, spill=spill, idle_seconds=0)
+    reference = SessionStore()
+
+    def advance(session, steps, answers):
+        result = session.start()
+        for step in range(steps):
+            if not result["next_question"] or result["is_finished"]:
+                break
+            result = session.answer(db, result["next_question"], answers[step % len(answers)])
+        return result
+
+    sessions, expected = [], []
+    for index in range(5):
+        answers = [True, None, False][index % 3:] + [True]
+        session = store.create(db, "E")
+        expected.append((advance(session, 3 + index, answers), answers))
+        store.update(session)
+        sessions.append(session)
+        twin = reference.create(db, "E")
+        advance(twin, 3 + index, answers)
+        expected[-1] += (twin,)
+
+    # 件数の上限を超えた古いセッションは退避される
+    assert len(store) == 3 and len(spill) == 2 and store.spilled == 2
+    for session, (result, answers, twin) in zip(sessions, expected):
+        restored = store.get(session.session_id, db)
+        assert restored is not None
+        assert restored.engine.save_snapshot() == twin.engine.save_snapshot()
+        assert restored.question_history == twin.question_history
+        if result["next_question"] and not result["is_finished"]:
+            answered = restored.answer(db, result["next_question"], True)
+            assert answered == {**twin.answer(db, result["next_question"], True), "session_id": restored.session_id}
+            store.update(restored)
+    assert store.rehydrated >= 2
+
+    # アイドル時間を過ぎたセッションは退避される（リクエストの処理中のものは除く）
+    store = SessionStore(ttl_seconds=0, spill=spill, idle_seconds=0.05)
+    idle, busy = store.create(db, "E"), store.create(db, "E")
+    idle.start()
+    busy.start()
+    held, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with busy.lock:
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    held.wait()
+    time.sleep(0.06)
+    store.create(db, "E")
+    release.set()
+    thread.join()
+    assert store._get_local(idle.session_id) is None and store._get_local(busy.session_id) is busy
+    assert store.get(idle.session_id, db).engine.save_snapshot() == idle.engine.save_snapshot()
+
+    # 削除したセッションは退避先からも消える
+    store.delete(idle.session_id)
+    assert store.get(idle.session_id, db) is None
+
+    print(f"Spill: {store.spilled} idle, {len(spill)} on disk")
+    db.close()
+
+
+class FailingSpill(SqliteSessionBackend):
+    """書き込みに失敗する退避先（書き込み時にストアのロックが取られていたかを記録する）"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.store = None
+        self.locked = []
+
+    def set(self, session_id, data, ttl_seconds):
+        self.locked.append(self.store._lock.locked())
+        raise OSError("disk full")
+
+
+def test_spill_failure_keeps_session():
+    """退避先への書き込みはストアのロックの外で行い、失敗してもリクエストはエラーにならずセッションはメモリに残る"""
+    db = SessionLocal()
+    spill = FailingSpill(os.path.join(tempfile.mkdtemp(), "sessions.db"))
+    store = SessionStore(ttl_seconds=0, max_sessions=1, spill=spill, idle_seconds=0)
+    spill.store = store
+    first = store.create(db, "E")
+    first.start()
+    store.update(first)
+    second = store.create(db, "E")
+    second.start()
+    store.update(second)  # 上限を超えた first の退避に失敗する
+
+    assert spill.locked and not any(spill.locked)
+    assert store.spilled == 0 and not store._spilling
+    assert store.get(first.session_id, db) is first and store.get(second.session_id, db) is second
+    acquired = []
+
+    def try_lock():
+        acquired.append(first.lock.acquire(blocking=False))
+        if acquired[-1]:
+            first.lock.release()
+
+    thread = threading.Thread(target=try_lock)
+    thread.start()
+    thread.join()
+    assert acquired == [True]  # 退避しなかったセッションのロックも解放されている
+    print(f"Spill failure: {len(spill.locked)} failed writes, sessions kept")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_concurrent_sessions_are_independent()
+        test_lru_and_ttl_eviction()
+        test_idle_sessions_spill_to_disk()
+        test_spill_failure_keeps_session()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,133 @@
+"""前向き推論の評価順序（依存の深さ順・1パス）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.models.database import SessionLocal
+from app.services.knowledge_base import KnowledgeBase, compile_knowledge_base
+from app.services.rule_compiler import interpret_conditions_hold
+from rule_factories import make_engine, make_rule, random_knowledge_base
+
+
+def test_dependencies_come_first():
+    """非巡回の知識ベースでは、条件を導出するルールが必ず先に評価される"""
+    db = SessionLocal()
+
+    for visa_type in ["E", "B"]:
+        kb = compile_knowledge_base(db, visa_type)
+        assert kb.is_acyclic
+        for rule in kb.rules:
+            for condition in rule.conditions:
+                for dependency in kb.rules_by_conclusion_id[condition.fact_id]:
+                    assert dependency.position < rule.position
+                    assert dependency.depth < rule.depth
+        print(f"{visa_type}: max depth {max(rule.depth for rule in kb.rules)}")
+
+    db.close()
+
+
+def test_single_pass_chain():
+    """優先度が依存関係と逆順でも1回の forward_chain で末端まで導出される"""
+    kb, engine = make_engine([
+        make_rule("r1", ["C"], "D", priority=30),
+        make_rule("r2", ["B"], "C", priority=20),
+        make_rule("r3", ["A"], "B", priority=10),
+    ])
+    assert kb.is_acyclic
+    assert [rule.rule_id for rule in kb.evaluation_order] == ["r3", "r2", "r1"]
+
+    engine.add_fact("A", True)
+    engine.forward_chain()
+    assert engine.fired_rules == ["r3", "r2", "r1"]
+    assert engine.facts["D"] is True
+    print("Single pass: OK")
+
+
+def test_cyclic_kb_falls_back_to_iteration():
+    """循環のある知識ベースは優先度順のまま、固定点まで繰り返し評価する"""
+    kb, engine = make_engine([
+        make_rule("r1", ["B"], "A", priority=30),
+        make_rule("r2", ["A", "X"], "B", operator="OR", priority=20),
+        make_rule("r3", ["Y"], "X", priority=10),
+    ])
+    assert not kb.is_acyclic
+    assert [rule.rule_id for rule in kb.evaluation_order] == ["r1", "r2", "r3"]
+
+    engine.add_fact("Y", True)
+    engine.forward_chain()
+    assert engine.fired_rules == ["r3", "r2", "r1"]
+    assert engine.facts["A"] is True
+    print("Cyclic fallback: OK")
+
+
+def full_rescan(engine):
+    """基準の前向き推論：発火するルールがなくなるまで、全てのルールを評価順序で評価し直す"""
+    rules = sorted(engine._get_applicable_rules(), key=lambda rule: rule.position)
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            if not engine._fired >> rule.index & 1 and interpret_conditions_hold(rule, engine._known, engine._values):
+                engine._fire_rule(rule.index)
+                changed = True
+    engine._agenda = set()
+
+
+def assert_same_as_full_rescan(kb, rng, sequences, matcher=None):
+    """ランダムな回答の列で、アジェンダの forward_chain と全ルールの再評価の導出・発火が一致する"""
+    facts = sorted({condition.fact_name for rule in kb.rules for condition in rule.conditions})
+    steps = fired = 0
+    for _ in range(sequences):
+        _, agenda = make_engine(kb, matcher=matcher)
+        _, reference = make_engine(kb, matcher=matcher)
+        for _ in range(rng.randint(1, 40)):
+            # 次の質問だけでなく、導出済みの事実を上書きする回答も混ぜる
+            fact_name = agenda.get_next_question() if rng.random() < 0.7 else None
+            fact_name = fact_name or rng.choice(facts)
+            value = rng.random() < 0.6
+            for engine in (agenda, reference):
+                engine.add_fact(fact_name, value)
+            agenda.forward_chain()
+            full_rescan(reference)
+            assert dict(agenda.facts) == dict(reference.facts), kb.visa_type
+            assert set(agenda.fired_rules) == set(reference.fired_rules), kb.visa_type
+            steps += 1
+        fired += len(agenda.fired_rules)
+    return steps, fired
+
+
+def test_agenda_matches_full_rescan():
+    """アジェンダ（変化した事実のルールのみ・ヒープ）の前向き推論が、全ルールの再評価と同じ事実・発火になる"""
+    rng = random.Random(0)
+    steps = fired = 0
+    for _ in range(100):
+        rules, _ = random_knowledge_base(rng)
+        kb = KnowledgeBase("T", rules)
+        for matcher in ("naive", "rete"):
+            counts = assert_same_as_full_rescan(kb, rng, 3, matcher)
+            steps, fired = steps + counts[0], fired + counts[1]
+
+    db = SessionLocal()
+    for visa_type in ["E", "L", "B"]:
+        kb = compile_knowledge_base(db, visa_type)
+        for matcher in ("naive", "rete"):
+            counts = assert_same_as_full_rescan(kb, rng, 30, matcher)
+            steps, fired = steps + counts[0], fired + counts[1]
+    db.close()
+    assert fired
+    print(f"Agenda vs full rescan: {steps} steps, {fired} fired rules")
+
+
+if __name__ == "__main__":
+    try:
+        test_dependencies_come_first()
+        test_single_pass_chain()
+        test_cyclic_kb_falls_back_to_iteration()
+        test_agenda_matches_full_rescan()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
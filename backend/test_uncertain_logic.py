@@ -0,0 +1,79 @@
+"""get_uncertain_facts_logic（知識ベースの転置インデックスによる集計）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from sqlalchemy import event
+
+from app.models.database import SessionLocal, engine as db_engine
+from app.models.models import Rule
+from app.services.consultation_service import apply_answer
+from app.services.inference_engine import InferenceEngine
+from app.services.knowledge_base import ALL_VISA_TYPES
+
+
+def reference_logic(db, visa_type, uncertain_facts):
+    """DBのルールを直接走査した結果（ルールのid順、条件の登録順）"""
+    visa_types = ALL_VISA_TYPES if visa_type == "ALL" else [visa_type]
+    groups = []
+    for rule in db.query(Rule).filter(Rule.visa_type.in_(visa_types)).order_by(Rule.id).all():
+        conditions = [c.fact_name for c in sorted(rule.conditions, key=lambda c: c.id) if c.fact_name in uncertain_facts]
+        if conditions and rule.rule_id not in {g["rule_id"] for g in groups}:
+            groups.append({
+                "rule_id": rule.rule_id,
+                "conclusion": rule.conclusion,
+                "operator": rule.operator,
+                "uncertain_conditions": conditions,
+            })
+    return {"groups": groups}
+
+
+def test_matches_db_scan_without_queries():
+    """DBを走査した結果と一致し、DBへのクエリを発行しない"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    queries = []
+
+    def count_query(*args):
+        queries.append(args[2])
+
+    checked = 0
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(40):
+            engine = InferenceEngine(db, visa_type)
+            for step in range(30):
+                fact_name = engine.get_next_question()
+                if fact_name is None:
+                    break
+                value = rng.choice([True, False, None, None])
+                apply_answer(engine, fact_name, value)
+                if value is not None:
+                    engine.forward_chain()
+            if not engine.uncertain_facts:
+                continue
+
+            event.listen(db_engine, "before_cursor_execute", count_query)
+            try:
+                logic = engine.get_uncertain_facts_logic()
+            finally:
+                event.remove(db_engine, "before_cursor_execute", count_query)
+
+            assert queries == []
+            assert logic == reference_logic(db, visa_type, set(engine.uncertain_facts))
+            checked += 1
+
+    assert checked > 0
+    print(f"Uncertain facts logic: {checked} consultations OK")
+    db.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_matches_db_scan_without_queries()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
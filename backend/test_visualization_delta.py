@@ -0,0 +1,102 @@
+"""可視化の差分（/api/consultation/visualization/delta）のテスト"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.models.database import SessionLocal
+from app.services.consultation_service import SessionStore
+
+
+def merge(client_rules, delta):
+    """クライアント側のマージ（frontend の fetchVisualization と同じ）"""
+    rules = [] if delta["full"] else list(client_rules)
+    for rule in delta["rules"]:
+        rule = dict(rule)
+        index = rule.pop("index")
+        if index < len(rules):
+            rules[index] = rule
+        else:
+            rules.append(rule)
+    return rules
+
+
+def test_delta_matches_full_visualization():
+    """差分をマージした結果が、毎回の全件の可視化と一致する"""
+    db = SessionLocal()
+    rng = random.Random(0)
+    total_full = total_delta = 0
+
+    for visa_type in ["E", "B", "ALL"]:
+        for _ in range(20):
+            session = SessionStore().create(db, visa_type)
+            result = session.start()
+            delta = session.get_visualization_delta(db, None)
+            assert delta["full"]
+            rules, version = merge([], delta), delta["version"]
+
+            for step in range(25):
+                if result.get("is_finished") or not result.get("next_question"):
+                    break
+                if step > 2 and rng.random() < 0.2:
+                    question = session.back(db, rng.randint(1, 2))["current_question"]
+                else:
+                    question = result["next_question"]
+                result = session.answer(db, question, rng.choice([True, False, None]))
+
+                delta = session.get_visualization_delta(db, version)
+                full = session.get_visualization(db)
+                if delta is None:
+                    assert full["version"] == version
+                else:
+                    assert not delta["full"]
+                    rules, version = merge(rules, delta), delta["version"]
+                    assert delta["fired_rules"] == full["fired_rules"]
+                    total_delta += len(delta["rules"])
+                assert rules == full["rules"]
+                total_full += len(full["rules"])
+
+                # 変化がなければ差分はない
+                assert session.get_visualization_delta(db, version) is None
+
+    print(f"Visualization delta: {total_delta} rules sent instead of {total_full}")
+    db.close()
+
+
+def test_delta_endpoint():
+    """変化がなければ 304、回答後は変化したルールのみが返る"""
+    client = TestClient(app)
+    start = client.post("/api/consultation/start", json={"visa_type": "E"}).json()
+    session_id = start["session_id"]
+
+    full = client.get("/api/consultation/visualization/delta", params={"session_id": session_id}).json()
+    assert full["full"] and len(full["rules"]) > 0
+    version = full["version"]
+
+    response = client.get("/api/consultation/visualization/delta", params={"session_id": session_id, "since": version})
+    assert response.status_code == 304
+
+    client.post("/api/consultation/answer", json={"session_id": session_id, "question": start["next_question"], "answer": True})
+    delta = client.get("/api/consultation/visualization/delta", params={"session_id": session_id, "since": version}).json()
+    assert not delta["full"] and delta["version"] > version
+    assert 0 < len(delta["rules"]) <= len(full["rules"])
+
+    # 古すぎる・不明なバージョンには全件を返す
+    stale = client.get("/api/consultation/visualization/delta", params={"session_id": session_id, "since": 10**6}).json()
+    assert stale["full"] and len(stale["rules"]) == len(full["rules"])
+    print(f"Delta endpoint: {len(delta['rules'])}/{len(full['rules'])} rules after one answer")
+
+
+if __name__ == "__main__":
+    try:
+        test_delta_matches_full_visualization()
+        test_delta_endpoint()
+        print("\nAll tests passed")
+    except Exception as e:
+        print(f"\nERROR: {e}")
+        import traceback
+        traceback.print_exc()
@@ -1,12 +1,39 @@
-import { useState } from 'react'
+import { useRef, useState } from 'react'
 import VisaTypeSelection from '../components/consultation/VisaTypeSelection'
 import DiagnosisPanel from '../components/consultation/DiagnosisPanel'
 import VisualizationPanel from '../components/consultation/VisualizationPanel'
 
 const API_BASE_URL = import.meta.env.VITE_API_URL || '/api'
 
+const CONDITION_STATUSES = { 0: 'unknown', 1: 'satisfied', 2: 'not_satisfied', 3: 'uncertain' }
+const RULE_CONCLUSION_DERIVED = 1
+const RULE_FIRED = 2
+const RULE_FIREABLE = 4
+
+// ルールグラフ（静的な構造）とコンパクトな状態 [index, flags, 条件の状態のコード] から可視化用のルールを組み立てる
+const expandRuleStatus = (graphRule, [, flags, codes]) => ({
+  rule_id: graphRule.rule_id,
+  operator: graphRule.operator,
+  conclusion: graphRule.conclusion,
+  conditions: graphRule.conditions.map((condition, i) => ({
+    ...condition,
+    status: CONDITION_STATUSES[codes[i]],
+  })),
+  conclusion_derived: (flags & RULE_CONCLUSION_DERIVED) !== 0,
+  is_fired: (flags & RULE_FIRED) !== 0,
+  is_fireable: (flags & RULE_FIREABLE) !== 0,
+})
+
+// WebSocketチャネルのURL（API_BASE_URL と同じホスト・パス）
+const channelUrl = () => {
+  const url = new URL(`${API_BASE_URL}/consultation/ws`, window.location.href)
+  url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
+  return url.href
+}
+
 function ConsultationPage() {
   const [selectedVisaType, setSelectedVisaType] = useState(null)
+  const [sessionId, setSessionId] = useState(null)
   const [currentQuestion, setCurrentQuestion] = useState(null)
   const [isDerivable, setIsDerivable] = useState(true)
   const [conclusions, setConclusions] = useState([])
@@ -22,18 +49,86 @@ function ConsultationPage() {
   const [currentVisaType, setCurrentVisaType] = useState(null)
   const [allVisaMode, setAllVisaMode] = useState(false)
   const [allConclusions, setAllConclusions] = useState({})
+  const [lookahead, setLookahead] = useState(null) // 現在の質問への回答ごとの次の質問（先読み）
+  const graphRef = useRef(null) // 現在のセッションのルールグラフ（知識ベースのバージョンごとにHTTPキャッシュされる）
+  const channelRef = useRef(null) // 診断のWebSocketチャネル（接続できない場合はHTTPで送る）
+  const stateRef = useRef(null) // 状態トークン（ステートレスモードのサーバーのみ返す。HTTPのリクエストにそのまま付ける）
+  // サーバーで反映済みの回答数（直前の応答の step）。回答・戻る操作に付けて送り、チャネルで反映済みの操作をHTTPで再送しても繰り返させない
+  const stepRef = useRef(0)
+
+  const openChannel = () =>
+    new Promise((resolve) => {
+      if (typeof WebSocket === 'undefined') {
+        resolve(null)
+        return
+      }
+      const socket = new WebSocket(channelUrl())
+      const channel = { socket, pending: new Map(), nextId: 1 }
+      socket.onopen = () => resolve(channel)
+      socket.onerror = () => resolve(null)
+      socket.onmessage = (event) => {
+        const reply = JSON.parse(event.data)
+        const pending = channel.pending.get(reply.id)
+        if (pending) {
+          channel.pending.delete(reply.id)
+          pending(reply)
+        }
+      }
+      socket.onclose = () => {
+        channel.pending.forEach((pending) => pending(null))
+        channel.pending.clear()
+        if (channelRef.current === channel) {
+          channelRef.current = null
+        }
+      }
+    })
+
+  const closeChannel = () => {
+    if (channelRef.current) {
+      channelRef.current.socket.close()
+      channelRef.current = null
+    }
+  }
+
+  // チャネルで送信し、応答（回答の結果と可視化の差分）を返す。チャネルがなければ null
+  const sendChannel = async (message) => {
+    const channel = channelRef.current
+    if (!channel || channel.socket.readyState !== WebSocket.OPEN) {
+      return null
+    }
+    const id = channel.nextId++
+    const reply = await new Promise((resolve) => {
+      channel.pending.set(id, resolve)
+      channel.socket.send(JSON.stringify({ ...message, id }))
+    })
+    if (reply && reply.type === 'error') {
+      throw new Error(typeof reply.detail === 'string' ? reply.detail : JSON.stringify(reply.detail))
+    }
+    return reply
+  }
 
   const startConsultation = async (visaType) => {
     setLoading(true)
     setError(null)
     setSelectedVisaType(visaType)
     try {
-      const response = await fetch(`${API_BASE_URL}/consultation/start`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ visa_type: visaType }),
-      })
-      const data = await response.json()
+      closeChannel()
+      channelRef.current = await openChannel()
+      const reply = await sendChannel({ type: 'start', visa_type: visaType, lookahead: true })
+      let data
+      if (reply) {
+        data = reply.consultation
+      } else {
+        const response = await fetch(`${API_BASE_URL}/consultation/start`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ visa_type: visaType, lookahead: true }),
+        })
+        data = await response.json()
+      }
+      setSessionId(data.session_id)
+      stateRef.current = data.state || null
+      stepRef.current = data.step || 0
       setCurrentQuestion(data.next_question)
       setIsDerivable(data.is_derivable !== undefined ? data.is_derivable : true)
       setQuestionHistory(data.next_question ? [data.next_question] : [])
@@ -44,7 +139,12 @@ function ConsultationPage() {
       setCurrentVisaType(data.current_visa_type || null)
       setAllVisaMode(data.all_visa_mode || false)
       setAllConclusions(data.all_conclusions || {})
-      await fetchVisualization()
+      setLookahead(data.lookahead || null)
+      if (reply) {
+        await applyVisualization(reply.visualization)
+      } else {
+        await fetchVisualization(data.session_id, null)
+      }
     } catch (err) {
       setError('診断の開始に失敗しました: ' + err.message)
       console.error('Error starting consultation:', err)
@@ -53,11 +153,51 @@ function ConsultationPage() {
     }
   }
 
-  const fetchVisualization = async () => {
+  const fetchGraph = async (visaType, version) => {
+    const graph = graphRef.current
+    if (graph && graph.visa_type === visaType && graph.version === version) {
+      return graph
+    }
+    const response = await fetch(`${API_BASE_URL}/consultation/graph/${encodeURIComponent(visaType)}/${version}`)
+    graphRef.current = await response.json()
+    return graphRef.current
+  }
+
+  // 可視化の状態（/visualization/status の形式、変化がなければ null）をルールグラフと合わせて反映する
+  const applyVisualization = async (data) => {
+    if (!data) {
+      return
+    }
+    const graph = await fetchGraph(data.graph_visa_type, data.graph_version)
+    setVisualizationData((prev) => {
+      const rules = data.full || !prev ? [] : [...prev.rules]
+      data.rules.forEach((status) => {
+        rules[status[0]] = expandRuleStatus(graph.rules[status[0]], status)
+      })
+      return {
+        rules,
+        fired_rules: data.fired_rules.map((index) => graph.rules[index].rule_id),
+        current_question_fact: data.current_question_fact,
+        version: data.version,
+      }
+    })
+  }
+
+  // 前回受け取った version 以降に変わったルールの状態だけを取得する（HTTPで送った場合）
+  const fetchVisualization = async (id = sessionId, since = visualizationData?.version) => {
     try {
-      const response = await fetch(`${API_BASE_URL}/consultation/visualization`)
-      const data = await response.json()
-      setVisualizationData(data)
+      const params = new URLSearchParams({ session_id: id })
+      if (stateRef.current) {
+        params.set('state', stateRef.current)
+      }
+      if (since !== undefined && since !== null) {
+        params.set('since', since)
+      }
+      const response = await fetch(`${API_BASE_URL}/consultation/visualization/status?${params}`)
+      if (response.status === 304) {
+        return
+      }
+      await applyVisualization(await response.json())
     } catch (err) {
       console.error('Error fetching visualization:', err)
     }
@@ -66,13 +206,29 @@ function ConsultationPage() {
   const handleAnswer = async (question, answer) => {
     setLoading(true)
     setError(null)
+    // 先読みした次の質問をすぐに表示し、応答で確定する
+    const predicted = lookahead && lookahead[answer === true ? 'yes' : answer === false ? 'no' : 'unknown']
+    if (predicted && !predicted.is_finished) {
+      setCurrentQuestion(predicted.next_question)
+      setIsDerivable(predicted.is_derivable)
+    }
+    setLookahead(null)
     try {
-      const response = await fetch(`${API_BASE_URL}/consultation/answer`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ question, answer }),
-      })
-      const data = await response.json()
+      const step = stepRef.current
+      const reply = await sendChannel({ type: 'answer', question, answer, lookahead: true, step })
+      let data
+      if (reply) {
+        data = reply.consultation
+      } else {
+        const response = await fetch(`${API_BASE_URL}/consultation/answer`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ session_id: sessionId, state: stateRef.current, question, answer, lookahead: true, step }),
+        })
+        data = await response.json()
+      }
+      stateRef.current = data.state || null
+      stepRef.current = data.step || 0
 
       setCurrentQuestion(data.next_question)
       setIsDerivable(data.is_derivable !== undefined ? data.is_derivable : true)
@@ -85,12 +241,17 @@ function ConsultationPage() {
       setCurrentVisaType(data.current_visa_type || null)
       setAllVisaMode(data.all_visa_mode || false)
       setAllConclusions(data.all_conclusions || {})
+      setLookahead(data.lookahead || null)
 
       if (data.next_question && !questionHistory.includes(data.next_question)) {
         setQuestionHistory([...questionHistory, data.next_question])
       }
 
-      await fetchVisualization()
+      if (reply) {
+        await applyVisualization(reply.visualization)
+      } else {
+        await fetchVisualization()
+      }
     } catch (err) {
       setError('回答の送信に失敗しました: ' + err.message)
       console.error('Error answering question:', err)
@@ -102,11 +263,23 @@ function ConsultationPage() {
   const handleBack = async () => {
     setLoading(true)
     setError(null)
+    setLookahead(null)
     try {
-      const response = await fetch(`${API_BASE_URL}/consultation/back`, {
-        method: 'POST',
-      })
-      const data = await response.json()
+      const step = stepRef.current
+      const reply = await sendChannel({ type: 'back', step })
+      let data
+      if (reply) {
+        data = reply
+      } else {
+        const response = await fetch(`${API_BASE_URL}/consultation/back`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ session_id: sessionId, state: stateRef.current, step }),
+        })
+        data = await response.json()
+      }
+      stateRef.current = data.state || null
+      stepRef.current = data.step || 0
 
       if (data.current_question) {
         setCurrentQuestion(data.current_question)
@@ -122,7 +295,11 @@ function ConsultationPage() {
         setUncertainFactsLogic({})
       }
 
-      await fetchVisualization()
+      if (reply) {
+        await applyVisualization(reply.visualization)
+      } else {
+        await fetchVisualization()
+      }
     } catch (err) {
       setError('前の質問に戻れませんでした: ' + err.message)
       console.error('Error going back:', err)
@@ -132,7 +309,11 @@ function ConsultationPage() {
   }
 
   const handleRestart = () => {
+    closeChannel()
+    stateRef.current = null
+    stepRef.current = 0
     setSelectedVisaType(null)
+    setSessionId(null)
     setCurrentQuestion(null)
     setQuestionHistory([])
     setConclusions([])
@@ -146,6 +327,7 @@ function ConsultationPage() {
     setCurrentVisaType(null)
     setAllVisaMode(false)
     setAllConclusions({})
+    setLookahead(null)
   }
 
   return (